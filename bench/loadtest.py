@@ -0,0 +1,358 @@
+"""Offline load test for bot.app.
+
+Boots the FastAPI app (with its lifespan) against a temporary SQLite database
+(or --database-url, e.g. a scratch Postgres for a smoke run),
+with the Bot API and WayForPay replaced by a local stub server, then replays
+synthetic traffic and reports throughput, latency percentiles and DB query
+counts per scenario.
+
+    python -m bench.loadtest --count 2000 --rate 500 --concurrency 50
+    python -m bench.loadtest --scenarios start,check --json bench_output.json
+    python -m bench.loadtest --count 200 --database-url postgresql+asyncpg://bench@localhost/bench
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict, field
+from typing import Awaitable, Callable
+
+SCENARIOS = ("start", "buy", "check", "redirect", "callback", "expiry", "reconcile")
+
+SECRET = "bench-secret"
+MERCHANT = "bench_merchant"
+
+
+def configure_env(db_url: str, stub_url: str, webhook_mode: str) -> None:
+    # Must run before anything from `bot` is imported: settings are read at import time.
+    os.environ.update({
+        "BOT_TOKEN": "42:BENCH",
+        "CHANNEL_ID": "-1001",
+        "BASE_URL": "https://bench.test",
+        "WFP_MERCHANT": MERCHANT,
+        "WFP_SECRET": SECRET,
+        "WFP_DOMAIN": "bench.test",
+        "WFP_API_URL": f"{stub_url}/wfp",
+        "TG_JOIN_REQUEST_URL": "https://t.me/+bench",
+        "DATABASE_URL": db_url,
+        "DB_QUERY_STATS": "true",
+        "WEBHOOK_MODE": webhook_mode,
+    })
+
+
+@dataclass
+class Result:
+    scenario: str
+    requests: int
+    errors: int
+    seconds: float
+    throughput: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    db_queries: int
+    queries_per_request: float
+    extra: dict = field(default_factory=dict)
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = max(0, math.ceil(p * len(sorted_values)) - 1)
+    return sorted_values[idx]
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    msg = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": msg}
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.update_id = 0
+        self.order_refs: list[str] = []
+
+    def next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def user(self) -> int:
+        return 100_000 + random.randrange(self.args.users)
+
+    async def seed(self, scenarios: list[str]) -> None:
+        from datetime import datetime, timedelta
+        from bot.db import Session, User, Subscription, Payment, PaymentToken
+
+        now = datetime.utcnow()
+        n = self.args.count
+        async with Session() as s:
+            uids = range(100_000, 100_000 + self.args.users)
+            s.add_all(User(id=u, username=f"user{u}") for u in uids)
+            await s.flush()  # users before their FK rows (enforced on Postgres)
+            s.add_all(Subscription(user_id=u, status="expired", updated_at=now) for u in uids)
+            await s.flush()
+            if "redirect" in scenarios or "callback" in scenarios:
+                for i in range(n):
+                    u = 100_000 + i % self.args.users
+                    ref = f"bench-{i}"
+                    self.order_refs.append(ref)
+                    s.add(Payment(user_id=u, order_ref=ref, amount=200, currency="UAH", status="pending", created_at=now))
+                    s.add(PaymentToken(user_id=u, token=f"tok-{i}", status="pending", created_at=now))
+            if "reconcile" in scenarios:
+                # Платежи без callback: старше PAYMENT_RECONCILE_MIN_AGE, ждут CHECK_STATUS
+                for i in range(self.args.reconcile_rows):
+                    u = 100_000 + i % self.args.users
+                    s.add(Payment(
+                        user_id=u, order_ref=f"lost-{i}", amount=200, currency="UAH",
+                        status="pending", created_at=now - timedelta(hours=1),
+                    ))
+            await s.commit()
+
+    async def seed_expiry(self) -> None:
+        # Seeded right before the scenario so nothing else gets to expire these rows first
+        from datetime import datetime, timedelta
+        from bot.db import Session, User, Subscription
+
+        now = datetime.utcnow()
+        base = 1_000_000
+        async with Session() as s:
+            s.add_all(User(id=base + i, username=f"exp{i}") for i in range(self.args.expiry_rows))
+            await s.flush()
+            for i in range(self.args.expiry_rows):
+                s.add(Subscription(user_id=base + i, status="active", paid_until=now - timedelta(days=1), updated_at=now))
+            await s.commit()
+
+    async def run(self, name: str, count: int, fn: Callable[[int], Awaitable[bool]]) -> Result:
+        from bot.db import query_stats
+
+        rate, concurrency = self.args.rate, self.args.concurrency
+        sem = asyncio.Semaphore(concurrency)
+        latencies: list[float] = []
+        errors = 0
+        q0 = query_stats.total
+        start = time.perf_counter()
+
+        async def one(i: int) -> None:
+            nonlocal errors
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            async with sem:
+                t = time.perf_counter()
+                try:
+                    ok = await fn(i)
+                except Exception:
+                    logging.getLogger("bench").exception("%s #%d failed", name, i)
+                    ok = False
+                latencies.append(time.perf_counter() - t)
+                if not ok:
+                    errors += 1
+
+        await asyncio.gather(*(one(i) for i in range(count)))
+        await self.drain()
+        elapsed = time.perf_counter() - start
+        queries = query_stats.total - q0
+        latencies.sort()
+        return Result(
+            scenario=name,
+            requests=count,
+            errors=errors,
+            seconds=round(elapsed, 3),
+            throughput=round(count / elapsed, 1) if elapsed else 0.0,
+            p50_ms=round(percentile(latencies, 0.50) * 1000, 2),
+            p95_ms=round(percentile(latencies, 0.95) * 1000, 2),
+            p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+            db_queries=queries,
+            queries_per_request=round(queries / count, 2) if count else 0.0,
+        )
+
+    async def drain(self) -> None:
+        # In queue mode the webhook answers before handling; wait for the workers too.
+        from bot import app as app_module
+
+        if app_module.updates is not None:
+            await asyncio.gather(*(q.join() for q in app_module.updates._queues))
+
+    def webhook(self, client, text: str) -> Callable[[int], Awaitable[bool]]:
+        async def fn(i: int) -> bool:
+            r = await client.post("/telegram/webhook", json=message_update(self.next_update_id(), self.user(), text))
+            return r.status_code < 400
+        return fn
+
+    def redirect(self, client) -> Callable[[int], Awaitable[bool]]:
+        async def fn(i: int) -> bool:
+            r = await client.get("/thanks", params={"orderReference": self.order_refs[i]})
+            return r.status_code in (302, 303, 307)
+        return fn
+
+    def callback(self, client) -> Callable[[int], Awaitable[bool]]:
+        from bot.payments.wayforpay import CALLBACK_SIGNATURE_FIELDS, hmac_md5_hex
+
+        async def fn(i: int) -> bool:
+            data = {
+                "merchantAccount": MERCHANT,
+                "orderReference": self.order_refs[i],
+                "amount": 200,
+                "currency": "UAH",
+                "authCode": "123456",
+                "cardPan": "41****1111",
+                "transactionStatus": "Approved",
+                "reasonCode": 1100,
+            }
+            data["merchantSignature"] = hmac_md5_hex(";".join(str(data[k]) for k in CALLBACK_SIGNATURE_FIELDS), SECRET)
+            r = await client.post("/payments/wayforpay/callback", json=data)
+            return r.status_code == 200 and r.json().get("status") == "accept"
+        return fn
+
+    async def expiry(self) -> Result:
+        from bot.app import bot as tg_bot
+        from bot.services import enforce_expirations
+
+        stats = []
+
+        async def fn(i: int) -> bool:
+            st = await enforce_expirations(tg_bot)
+            stats.append(st)
+            return st.expired == self.args.expiry_rows
+
+        await self.seed_expiry()
+        saved_rate, self.args.rate = self.args.rate, 0
+        try:
+            result = await self.run("expiry", 1, fn)
+        finally:
+            self.args.rate = saved_rate
+        result.extra = {"expired": stats[0].expired, "batches": stats[0].batches}
+        return result
+
+    async def reconcile(self) -> Result:
+        from bot.reconcile import reconcile_payments
+
+        stats = []
+
+        async def fn(i: int) -> bool:
+            st = await reconcile_payments()
+            stats.append(st)
+            return st.errors == 0 and st.paid == self.args.reconcile_rows
+
+        saved_rate, self.args.rate = self.args.rate, 0
+        try:
+            result = await self.run("reconcile", 1, fn)
+        finally:
+            self.args.rate = saved_rate
+        result.extra = {"checked": stats[0].checked, "paid": stats[0].paid, "batches": stats[0].batches}
+        return result
+
+
+async def main(args: argparse.Namespace) -> tuple[list[Result], dict[str, int]]:
+    from bench.stubs import StubServer
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    stub = StubServer(latency=args.stub_latency / 1000, merchant=MERCHANT, secret=SECRET)
+    stub_url = await stub.start()
+    tmp = tempfile.TemporaryDirectory(prefix="bot-bench-")
+    db_url = args.database_url or f"sqlite+aiosqlite:///{os.path.join(tmp.name, 'bench.sqlite3')}"
+    configure_env(db_url, stub_url, args.webhook_mode)
+
+    import httpx
+    from aiogram.client.telegram import TelegramAPIServer
+    from bot import app as app_module
+
+    app_module.bot.session.api = TelegramAPIServer.from_base(stub_url)
+    # Leader duties (deadline sync, catch-up expiry, reconcile jobs) would process the
+    # rows seeded for the expiry/reconcile scenarios in the background; those
+    # scenarios call the same code directly, so the harness runs without them.
+    app_module.leader.on_elected.clear()
+    app_module.leader.on_demoted.clear()
+    if args.database_url:
+        # The seed uses fixed ids: start from empty tables in the external database
+        from bot.db import Base, engine
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+    bench = Bench(args)
+    results: list[Result] = []
+    try:
+        async with app_module.app.router.lifespan_context(app_module.app):
+            await bench.seed(scenarios)
+            transport = httpx.ASGITransport(app=app_module.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                texts = {"start": "/start", "buy": "Оформить подписку", "check": "Проверить подписку"}
+                for name in scenarios:
+                    if name in texts:
+                        results.append(await bench.run(name, args.count, bench.webhook(client, texts[name])))
+                    elif name == "redirect":
+                        results.append(await bench.run(name, args.count, bench.redirect(client)))
+                    elif name == "callback":
+                        results.append(await bench.run(name, args.count, bench.callback(client)))
+                    elif name == "expiry":
+                        results.append(await bench.expiry())
+                    elif name == "reconcile":
+                        results.append(await bench.reconcile())
+            if not app_module.leader.is_leader:
+                # The only worker must hold the scheduler lease (catches DB-specific lease bugs)
+                raise SystemExit("leader lease was never acquired")
+    finally:
+        await stub.stop()
+        tmp.cleanup()
+    return results, dict(stub.calls)
+
+
+def print_table(results: list[Result]) -> None:
+    header = f"{'scenario':<10} {'reqs':>6} {'err':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'q/req':>6}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r.scenario:<10} {r.requests:>6} {r.errors:>5} {r.throughput:>9.1f} "
+            f"{r.p50_ms:>9.2f} {r.p95_ms:>9.2f} {r.p99_ms:>9.2f} {r.db_queries:>8} {r.queries_per_request:>6.2f}"
+        )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated: " + ", ".join(SCENARIOS))
+    p.add_argument("--count", type=int, default=500, help="requests per scenario")
+    p.add_argument("--rate", type=float, default=0, help="target requests/second per scenario (0 = as fast as possible)")
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--users", type=int, default=200, help="size of the synthetic user pool")
+    p.add_argument("--expiry-rows", type=int, default=5000, help="expired subscriptions seeded for the expiry scenario")
+    p.add_argument("--reconcile-rows", type=int, default=500, help="pending payments seeded for the reconcile scenario")
+    p.add_argument("--stub-latency", type=float, default=0, help="artificial stub latency, ms")
+    p.add_argument("--database-url", help="run against this database instead of a temporary SQLite; its tables are dropped first")
+    p.add_argument("--webhook-mode", choices=("inline", "queue"), default="inline")
+    p.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    p.add_argument("--seed", type=int, default=1)
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.ERROR)
+    results, stub_calls = asyncio.run(main(args))
+    print_table(results)
+    print("stub calls:", ", ".join(f"{k}={v}" for k, v in sorted(stub_calls.items())))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"results": [asdict(r) for r in results], "stub_calls": stub_calls}, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if any(r.errors for r in results) else 0)
@@ -0,0 +1,158 @@
+"""Throughput benchmark for bot.migrate.
+
+Seeds a temporary SQLite database with synthetic users, subscriptions,
+payments and tokens, then times export -> import -> verify and reports
+rows/second per table and the peak RSS of the process (memory should stay
+flat as --rows grows).
+
+    python -m bench.migrate --rows 200000 --batch 2000
+    python -m bench.migrate --format csv --target-url postgresql+asyncpg://bench@localhost/bench --copy
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+
+
+def configure_env(db_path: str) -> None:
+    # bot.db reads settings at import time
+    os.environ.update({
+        "BOT_TOKEN": "42:BENCH",
+        "CHANNEL_ID": "-1001",
+        "BASE_URL": "https://bench.test",
+        "WFP_MERCHANT": "bench_merchant",
+        "WFP_SECRET": "bench-secret",
+        "WFP_DOMAIN": "bench.test",
+        "TG_JOIN_REQUEST_URL": "https://t.me/+bench",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{db_path}",
+        "METRICS_ENABLED": "false",
+    })
+
+
+@dataclass
+class Phase:
+    phase: str
+    table: str
+    rows: int
+    seconds: float
+    rows_per_second: float
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+async def seed(engine, rows: int, chunk: int = 5000) -> None:
+    from bot.db import Base, User, Subscription, Payment, PaymentToken
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    start = datetime(2025, 1, 1)
+    for lo in range(0, rows, chunk):
+        ids = range(lo, min(rows, lo + chunk))
+        async with engine.begin() as conn:
+            await conn.execute(User.__table__.insert(), [
+                {"id": 5_000_000_000 + i, "username": f"user{i}", "balance": 0} for i in ids
+            ])
+            await conn.execute(Subscription.__table__.insert(), [
+                {
+                    "user_id": 5_000_000_000 + i,
+                    "status": random.choice(("active", "expired", "grace")),
+                    "paid_until": start + timedelta(minutes=i),
+                    "updated_at": start,
+                }
+                for i in ids
+            ])
+            await conn.execute(Payment.__table__.insert(), [
+                {
+                    "user_id": 5_000_000_000 + i,
+                    "order_ref": f"bench-{i}",
+                    "amount": 200,
+                    "currency": "UAH",
+                    "status": random.choice(("paid", "pending", "declined")),
+                    "created_at": start + timedelta(seconds=i),
+                    "product": "Подписка на 1 месяц",
+                }
+                for i in ids
+            ])
+            await conn.execute(PaymentToken.__table__.insert(), [
+                {"user_id": 5_000_000_000 + i, "token": f"tok-{i}", "status": "paid", "created_at": start}
+                for i in ids
+            ])
+
+
+async def main(args: argparse.Namespace) -> tuple[list[Phase], float]:
+    tmp = tempfile.TemporaryDirectory(prefix="bot-migrate-bench-")
+    configure_env(os.path.join(tmp.name, "source.sqlite3"))
+
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from bot import migrate
+
+    source = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp.name, 'source.sqlite3')}")
+    target_url = args.target_url or f"sqlite+aiosqlite:///{os.path.join(tmp.name, 'target.sqlite3')}"
+    target = create_async_engine(target_url)
+    dump = os.path.join(tmp.name, "dump")
+    tables = ["users", "subscriptions", "payments", "payment_tokens"]
+    phases: list[Phase] = []
+    try:
+        await seed(source, args.rows)
+        for name, run in (
+            ("export", lambda: migrate.export_tables(source, dump, args.format, args.batch, tables)),
+            ("import", lambda: migrate.import_tables(target, dump, args.batch, args.copy, tables)),
+        ):
+            for r in await run():
+                phases.append(Phase(name, r.table, r.rows, r.seconds, r.rate))
+        t0 = time.perf_counter()
+        problems = await migrate.verify_tables(target, dump, args.batch, tables)
+        if problems:
+            raise SystemExit(f"verify failed: {', '.join(problems)}")
+        total = sum(p.rows for p in phases if p.phase == "import")
+        elapsed = time.perf_counter() - t0
+        phases.append(Phase("verify", "*", total, elapsed, total / elapsed if elapsed else 0.0))
+    finally:
+        await source.dispose()
+        await target.dispose()
+        tmp.cleanup()
+    return phases, peak_rss_mb()
+
+
+def print_table(phases: list[Phase], rss: float) -> None:
+    header = f"{'phase':<8} {'table':<16} {'rows':>10} {'seconds':>9} {'rows/s':>11}"
+    print(header)
+    print("-" * len(header))
+    for p in phases:
+        print(f"{p.phase:<8} {p.table:<16} {p.rows:>10} {p.seconds:>9.2f} {p.rows_per_second:>11.0f}")
+    print(f"peak RSS: {rss:.1f} MB")
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--rows", type=int, default=50000, help="rows per table")
+    p.add_argument("--batch", type=int, default=1000)
+    p.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    p.add_argument("--target-url", help="import target (default: temporary SQLite)")
+    p.add_argument("--copy", action="store_true", help="use COPY for a Postgres/asyncpg target")
+    p.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    p.add_argument("--seed", type=int, default=1)
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.ERROR)
+    phases, rss = asyncio.run(main(args))
+    print_table(phases, rss)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"phases": [asdict(p) for p in phases], "peak_rss_mb": rss}, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,91 @@
+"""Local stand-ins for the Telegram Bot API and WayForPay used by the benchmarks."""
+from __future__ import annotations
+import asyncio
+import hashlib
+import hmac
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USERNAME = "bench_bot"
+# Same field order as bot.payments.wayforpay.CALLBACK_SIGNATURE_FIELDS
+SIGNATURE_FIELDS = (
+    "merchantAccount", "orderReference", "amount", "currency",
+    "authCode", "cardPan", "transactionStatus", "reasonCode",
+)
+
+
+class StubServer:
+    """One aiohttp server answering both Bot API (/bot<token>/<method>) and WayForPay (/wfp) calls."""
+
+    def __init__(self, latency: float = 0.0, wfp_status: str = "Approved", merchant: str = "", secret: str = ""):
+        self.latency = latency
+        self.merchant = merchant
+        self.secret = secret
+        self.wfp_status = wfp_status
+        self.calls: Counter[str] = Counter()
+        self._runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    async def _delay(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[f"tg.{method}"] += 1
+        await self._delay()
+        params = dict(await request.post()) if request.can_read_body else {}
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "getChatMember":
+            result = {"status": "left", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "U"}}
+        elif method == "sendMessage":
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": self.calls[f"tg.{method}"],
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def wayforpay(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        kind = payload.get("transactionType", "")
+        self.calls[f"wfp.{kind}"] += 1
+        await self._delay()
+        order_ref = payload.get("orderReference", "")
+        if kind == "CREATE_INVOICE":
+            return web.json_response({"reason": "Ok", "reasonCode": 1100, "invoiceUrl": f"https://secure.wayforpay.test/invoice/{order_ref}"})
+        if kind == "CHECK_STATUS":
+            data = {
+                "merchantAccount": self.merchant, "orderReference": order_ref, "amount": 200, "currency": "UAH",
+                "authCode": "", "cardPan": "", "transactionStatus": self.wfp_status, "reasonCode": 1100,
+            }
+            # Signed like a real response: the bot rejects unsigned CHECK_STATUS answers
+            base = ";".join(str(data[k]) for k in SIGNATURE_FIELDS)
+            data["merchantSignature"] = hmac.new(self.secret.encode(), base.encode(), hashlib.md5).hexdigest()
+            return web.json_response(data)
+        return web.json_response({"reason": "Unknown transactionType", "reasonCode": 1120})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_post("/wfp", self.wayforpay)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
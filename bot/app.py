@@ -1,37 +1,72 @@
 from __future__ import annotations
+import time
+_import_started = time.perf_counter()
 import logging
 import asyncio
 from urllib.parse import urlparse
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse
 from starlette.responses import JSONResponse
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.types import Update
 from aiogram.exceptions import TelegramRetryAfter
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
 
-from bot.db import init_db, Session, Payment, PaymentToken
-from bot.handlers_start import router as start_router
+from bot.db import init_db, query_listeners, query_stats
 from bot.handlers import router as handlers_router
-from bot.handlers_wipe import router as wipe_router
-from bot.handlers_buy import router as buy_router
-from bot.services import enforce_expirations
-from bot.payments.wayforpay import create_invoice
+from bot.services import enforce_expirations, redeem_payment_token, subscription_listeners, cache_sync
+from bot.deadlines import scheduler as deadlines
+from bot.users import registry
+from bot.broadcast import resume_broadcasts, stop_broadcasts
+from bot.leader import LeaderLease
+from bot.stats import ensure_stats
+from bot import joins
+from bot import state
+from bot.state import get_state, set_state
+from bot import metrics
+from bot.ingest import UpdateQueue
+from bot.throttling import setup_dispatcher as setup_throttling
+from bot.payments.wayforpay import (
+    WayForPayClient, set_client, parse_callback, verify_callback_signature, callback_response,
+)
+from bot.billing import process_callback, notify_payment
 from bot.config import settings
 
+# Корневой логгер: иначе под uvicorn он остаётся на WARNING и INFO (разбивка старта и т.п.) теряется.
+# basicConfig ничего не делает, если логирование уже настроено снаружи.
+logging.basicConfig(level=settings.LOG_LEVEL.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 log = logging.getLogger("app")
+_imports_done = time.perf_counter()
 
 bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 BOT_USERNAME: str | None = None
 dp = Dispatcher()
-dp.include_router(start_router)
 dp.include_router(handlers_router)
-dp.include_router(wipe_router)
-dp.include_router(buy_router)
+if settings.THROTTLE_ENABLED:
+    throttling = setup_throttling(dp)
+    metrics.Gauge("bot_throttle_buckets", "Token buckets held by the anti-flood middleware", fn=lambda: len(throttling))
+if settings.METRICS_ENABLED:
+    metrics.setup_dispatcher(dp)
+    query_listeners.append(metrics.observe_query)
+    if settings.DB_QUERY_STATS:
+        metrics.StatementHistogram("db_statement_seconds", "SQL execution time per statement", source=query_stats.snapshot)
+
+updates: UpdateQueue | None = None
+if settings.WEBHOOK_MODE == "queue":
+    updates = UpdateQueue(
+        dp, bot,
+        workers=settings.WEBHOOK_WORKERS,
+        maxsize=settings.WEBHOOK_QUEUE_SIZE,
+        overflow=settings.WEBHOOK_OVERFLOW,
+    )
+    metrics.Gauge("bot_update_queue_depth", "Updates waiting in the webhook queue", fn=lambda: updates.depth)
+metrics.Gauge("bot_users_pending", "User upserts waiting for the next flush", fn=lambda: registry.pending)
+metrics.Gauge("bot_deadlines_tracked", "Subscriptions tracked by the deadline scheduler", fn=lambda: len(deadlines))
+subscription_listeners.append(deadlines.schedule)
+subscription_listeners.append(joins.on_subscription_changed)
+metrics.Gauge("bot_join_queue_depth", "Join request decisions waiting for the Bot API", fn=lambda: joins.worker.depth)
 
 def normalize_base_url(u: str) -> str:
     u = (u or "").strip()
@@ -39,34 +74,181 @@ def normalize_base_url(u: str) -> str:
         u = "https://" + u
     return u.rstrip("/")
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+async def register_webhook(force: bool = False) -> bool:
+    """Ставит вебхук, если он не совпадает. Без force при FAST_START верим сохранённому
+    в app_state адресу и не ходим в Bot API; его перепроверяет фоновая задача."""
+    base = normalize_base_url(settings.BASE_URL)
+    webhook_url = f"{base}/telegram/webhook"
+    if not force and settings.FAST_START and await get_state(state.WEBHOOK_URL) == webhook_url:
+        return False
+    info = await bot.get_webhook_info()
+    if info.url != webhook_url:
+        try:
+            await bot.set_webhook(webhook_url)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            await bot.set_webhook(webhook_url)
+    await set_state(state.WEBHOOK_URL, webhook_url)
+    return True
+
+async def refresh_bot_username() -> None:
+    global BOT_USERNAME
+    me = await bot.get_me()
+    BOT_USERNAME = me.username
+    await set_state(state.BOT_USERNAME, me.username)
+
+async def load_bot_username() -> None:
+    # Имя бота общее для всех воркеров: берём из БД, get_me — только если его там ещё нет
     global BOT_USERNAME
-    await init_db()
+    BOT_USERNAME = await get_state(state.BOT_USERNAME)
+    if not BOT_USERNAME:
+        await refresh_bot_username()
+
+async def refresh_identity() -> None:
+    await register_webhook(force=True)
+    await refresh_bot_username()
+
+leader = LeaderLease("scheduler")
+scheduler = None  # AsyncIOScheduler, только у лидера
+
+async def start_leader_duties() -> None:
+    """Вебхук, дедлайны, рассылки и периодические задачи — только в одном воркере."""
+    global scheduler
+    # Отложен только apscheduler — он нужен одному лидеру. bot.retention и bot.membership
+    # к этому моменту уже загружены (billing и handlers_buy импортируют их сразу),
+    # а bot.reconcile тянет лишь уже загруженные billing и wayforpay
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.interval import IntervalTrigger
+    from apscheduler.triggers.cron import CronTrigger
+    from bot.retention import compact
+    from bot.reconcile import reconcile_payments
+    from bot.membership import MembershipReconciler
+
+    timer = metrics.StartupTimer("leader")
     try:
-        base = normalize_base_url(settings.BASE_URL)
-        webhook_url = f"{base}/telegram/webhook"
-        info = await bot.get_webhook_info()
-        if info.url != webhook_url:
-            try:
-                await bot.set_webhook(webhook_url)
-            except TelegramRetryAfter as e:
-                await asyncio.sleep(e.retry_after)
-                await bot.set_webhook(webhook_url)
+        with timer.step("webhook"):
+            await register_webhook()
     except Exception as e:
         log.exception("Ошибка webhook: %s", e)
+    if not settings.FAST_START or not BOT_USERNAME:
+        try:
+            with timer.step("get_me"):
+                await refresh_bot_username()
+        except Exception as e:
+            log.exception("Не удалось получить username бота: %s", e)
+
+    # Догоняем истёкшие за время простоя, дальше каждая подписка обрабатывается в момент своего дедлайна
     try:
-        me = await bot.get_me()
-        BOT_USERNAME = me.username
+        with timer.step("expiry"):
+            await metrics.timed_job("expiry", enforce_expirations, rows=lambda st: st.affected)(bot=bot)
+        with timer.step("deadlines"):
+            await deadlines.start(bot)
     except Exception as e:
-        log.exception("Не удалось получить username бота: %s", e)
+        log.exception("Не удалось запустить планировщик дедлайнов: %s", e)
+
+    try:
+        with timer.step("stats"):
+            await ensure_stats()
+    except Exception as e:
+        log.exception("Не удалось заполнить статистику: %s", e)
+
+    try:
+        with timer.step("broadcasts"):
+            await resume_broadcasts(bot)
+    except Exception as e:
+        log.exception("Не удалось возобновить рассылки: %s", e)
 
     scheduler = AsyncIOScheduler(timezone="UTC")
-    scheduler.add_job(enforce_expirations, CronTrigger(hour=9, minute=0), kwargs={"bot": bot})
-    scheduler.add_job(enforce_expirations, CronTrigger(hour="*/6"), kwargs={"bot": bot})
+    if settings.FAST_START and settings.IDENTITY_REFRESH_INTERVAL > 0:
+        scheduler.add_job(
+            refresh_identity, IntervalTrigger(minutes=settings.IDENTITY_REFRESH_INTERVAL),
+            max_instances=1, coalesce=True,
+        )
+    scheduler.add_job(
+        resume_broadcasts, IntervalTrigger(seconds=settings.BROADCAST_POLL_INTERVAL),
+        kwargs={"bot": bot}, max_instances=1, coalesce=True,
+    )
+    scheduler.add_job(
+        deadlines.sync, IntervalTrigger(seconds=settings.DEADLINE_SYNC_INTERVAL),
+        max_instances=1, coalesce=True,
+    )
+    scheduler.add_job(
+        metrics.timed_job("join_requests", joins.sweep_join_requests, rows=lambda n: n),
+        IntervalTrigger(seconds=settings.JOIN_SWEEP_INTERVAL),
+        max_instances=1, coalesce=True,
+    )
+    if settings.PAYMENT_RECONCILE_INTERVAL > 0:
+        scheduler.add_job(
+            metrics.timed_job("payments_reconcile", reconcile_payments, rows=lambda st: st.affected),
+            IntervalTrigger(minutes=settings.PAYMENT_RECONCILE_INTERVAL),
+            kwargs={"bot": bot}, max_instances=1, coalesce=True,
+        )
+    if settings.RETENTION_HOUR >= 0:
+        scheduler.add_job(
+            metrics.timed_job("retention", compact, rows=lambda st: st.affected),
+            CronTrigger(hour=settings.RETENTION_HOUR, minute=30),
+            max_instances=1, coalesce=True,
+        )
+    if settings.MEMBERSHIP_RECONCILE_INTERVAL > 0:
+        reconciler = MembershipReconciler(bot)
+        scheduler.add_job(
+            metrics.timed_job("membership", reconciler.run, rows=lambda st: st.affected),
+            IntervalTrigger(minutes=settings.MEMBERSHIP_RECONCILE_INTERVAL),
+            max_instances=1, coalesce=True,
+        )
+    if not leader.holds():
+        # Запуск занял дольше аренды: её мог забрать другой воркер
+        log.warning("Аренда лидерства истекла во время запуска, планировщик не запущен")
+        scheduler = None
+        return
     scheduler.start()
+    timer.log(log)
+
+async def stop_leader_duties() -> None:
+    global scheduler
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+        scheduler = None
+    await deadlines.stop()
+    await stop_broadcasts()
+
+leader.on_elected.append(start_leader_duties)
+leader.on_demoted.append(stop_leader_duties)
+metrics.Gauge("bot_is_leader", "1 if this worker holds the scheduler lease", fn=lambda: int(leader.is_leader))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # До yield только то, без чего нельзя принимать апдейты; сеть к Telegram — в фоне у лидера
+    timer = metrics.StartupTimer("startup", started=_import_started)
+    timer.record("imports", _imports_done - _import_started)
+    with timer.step("init_db"):
+        migrated = await init_db()
+    if not migrated:
+        log.info("Схема БД актуальна, проверка пропущена")
+    wfp = WayForPayClient()
+    set_client(wfp)
+    registry.start()
+    cache_sync.start()
+    joins.worker.start(bot)
+    if updates:
+        updates.start()
+    try:
+        with timer.step("bot_username"):
+            await load_bot_username()
+    except Exception as e:
+        log.exception("Не удалось получить username бота: %s", e)
+    leader.start()
+    timer.log(log)
 
     yield
+    await leader.stop()
+    if updates:
+        await updates.stop()
+    await joins.worker.stop()
+    await cache_sync.stop()
+    await registry.stop()
+    set_client(None)
+    await wfp.aclose()
     await bot.session.close()
 
 app = FastAPI(title="TG Subscription Bot", lifespan=lifespan)
@@ -77,7 +259,33 @@ async def root():
 
 @app.get("/healthz")
 async def healthz():
-    return {"ok": True}
+    if updates:
+        return {"ok": True, "leader": leader.is_leader, "updates": updates.stats()}
+    return {"ok": True, "leader": leader.is_leader}
+
+async def _redeem_and_redirect(order_ref: str):
+    r = await redeem_payment_token(order_ref)
+    if r.status == "no_payment":
+        return HTMLResponse("<h2>❌ Платеж не найден</h2>", status_code=404)
+    if r.status == "no_token":
+        return HTMLResponse("<h2>❌ Токен уже использован или не найден</h2>", status_code=404)
+
+    if not BOT_USERNAME:
+        try:
+            await load_bot_username()
+        except Exception as e:
+            log.exception("Не удалось получить username бота: %s", e)
+    if not BOT_USERNAME:
+        return HTMLResponse("<h2>⚠️ BOT_USERNAME не установлен</h2>", status_code=500)
+
+    invite_url = f"https://t.me/{BOT_USERNAME}?start={r.token}"
+    return RedirectResponse(invite_url)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    if not settings.METRICS_ENABLED:
+        return PlainTextResponse("metrics disabled", status_code=404)
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 @app.api_route("/thanks", methods=["GET", "POST", "HEAD"])
 async def thanks_page(request: Request):
@@ -92,41 +300,34 @@ async def thanks_page(request: Request):
     if not order_ref:
         return HTMLResponse("<h2>❌ Не передан orderReference</h2>", status_code=400)
 
-    async with Session() as s:
-        res = await s.execute(Payment.__table__.select().where(Payment.order_ref == order_ref))
-        pay = res.first()
-        if not pay:
-            return HTMLResponse("<h2>❌ Платеж не найден</h2>", status_code=404)
-
-        res = await s.execute(
-            PaymentToken.__table__.select()
-            .where(PaymentToken.user_id == pay.user_id, PaymentToken.status == "pending")
-            .order_by(PaymentToken.created_at.desc())
-        )
-        token_obj = res.first()
-        if not token_obj:
-            return HTMLResponse("<h2>❌ Токен уже использован или не найден</h2>", status_code=404)
-
-        await s.execute(
-            PaymentToken.__table__.update()
-            .where(PaymentToken.id == token_obj.id)
-            .values(status="paid")
-        )
-        await s.commit()
-
-        if not BOT_USERNAME:
-            return HTMLResponse("<h2>⚠️ BOT_USERNAME не установлен</h2>", status_code=500)
-
-        invite_url = f"https://t.me/{BOT_USERNAME}?start={token_obj.token}"
-        return RedirectResponse(invite_url)
+    return await _redeem_and_redirect(order_ref)
 
 @app.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
-    data = await request.json()
-    update = Update.model_validate(data)
-    await dp.feed_update(bot, update)
+    try:
+        data = await request.json()
+        update = Update.model_validate(data)
+    except Exception:
+        return JSONResponse({"ok": False}, status_code=400)
+    if updates is None:
+        await dp.feed_update(bot, update)
+    elif not updates.put(update):
+        # Перегрузка: пусть Telegram повторит доставку позже
+        return JSONResponse({"ok": False}, status_code=503)
     return JSONResponse({"ok": True})
 
+@app.post("/payments/wayforpay/callback")
+async def wfp_callback(request: Request, background: BackgroundTasks):
+    data = parse_callback(await request.body())
+    order_ref = data.get("orderReference")
+    if not order_ref or not verify_callback_signature(data):
+        log.warning("Отклонён callback WayForPay: %s", order_ref)
+        return JSONResponse({"ok": False}, status_code=400)
+    transition = await process_callback(order_ref, str(data.get("transactionStatus") or ""))
+    if transition:
+        background.add_task(notify_payment, bot, transition)
+    return JSONResponse(callback_response(order_ref))
+
 @app.post("/wfp/return")
 async def wfp_return(request: Request):
     try:
@@ -143,30 +344,4 @@ async def wfp_return(request: Request):
     if not order_ref:
         return HTMLResponse("<h2>❌ Не передан orderReference</h2>", status_code=400)
 
-    async with Session() as s:
-        res = await s.execute(Payment.__table__.select().where(Payment.order_ref == order_ref))
-        pay = res.first()
-        if not pay:
-            return HTMLResponse("<h2>❌ Платеж не найден</h2>", status_code=404)
-
-        res = await s.execute(
-            PaymentToken.__table__.select()
-            .where(PaymentToken.user_id == pay.user_id, PaymentToken.status == "pending")
-            .order_by(PaymentToken.created_at.desc())
-        )
-        token_obj = res.first()
-        if not token_obj:
-            return HTMLResponse("<h2>❌ Токен уже использован или не найден</h2>", status_code=404)
-
-        await s.execute(
-            PaymentToken.__table__.update()
-            .where(PaymentToken.id == token_obj.id)
-            .values(status="paid")
-        )
-        await s.commit()
-
-        if not BOT_USERNAME:
-            return HTMLResponse("<h2>⚠️ BOT_USERNAME не установлен</h2>", status_code=500)
-
-        invite_url = f"https://t.me/{BOT_USERNAME}?start={token_obj.token}"
-        return RedirectResponse(invite_url)
+    return await _redeem_and_redirect(order_ref)
@@ -0,0 +1,153 @@
+from __future__ import annotations
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
+from aiogram import Bot
+from sqlalchemy import select, update, exists, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from bot.db import Session, Payment, PaymentArchive, Subscription, dialect_insert
+from bot.cache import TTLCache
+from bot.services import SubInfo, invalidate_subscription, subscription_changed, _tz_aware_utc
+from bot.invoices import forget_invoice
+from bot.retention import restore_payment
+from bot import stats
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+# transactionStatus WayForPay -> статус платежа
+WFP_STATUSES = {
+    "Approved": "paid",
+    "Declined": "declined",
+    "Expired": "expired",
+    "Refunded": "refunded",
+    "Voided": "refunded",
+}
+
+# Разрешённые переходы; по неоплаченному счёту можно повторить оплату
+TRANSITIONS = {
+    "pending": {"paid", "declined", "expired"},
+    "declined": {"paid", "expired"},
+    "expired": {"paid"},
+    "paid": {"refunded"},
+}
+
+@dataclass
+class PaymentTransition:
+    order_ref: str
+    user_id: int
+    old: str
+    new: str
+    amount: Optional[int]
+    paid_until: Optional[datetime] = None
+    grace_until: Optional[datetime] = None
+
+# Повторные callback'и с тем же (orderReference, transactionStatus) не трогают БД
+_seen: TTLCache[tuple[str, str], bool] = TTLCache(maxsize=10000, ttl=24 * 3600)
+
+SETTLED = ("paid", "refunded")
+
+async def _is_first_payment(s: AsyncSession, user_id: int, order_ref: str) -> bool:
+    # Новая подписка — первый оплаченный платёж пользователя (так же считает stats.rebuild)
+    other = or_(
+        exists().where(Payment.user_id == user_id, Payment.status.in_(SETTLED), Payment.order_ref != order_ref),
+        exists().where(PaymentArchive.user_id == user_id, PaymentArchive.status.in_(SETTLED)),
+    )
+    return not (await s.execute(select(other))).scalar()
+
+async def _extend_subscription(s: AsyncSession, user_id: int, moment: datetime) -> tuple[datetime, Optional[datetime]]:
+    res = await s.execute(select(Subscription.status, Subscription.paid_until).where(Subscription.user_id == user_id))
+    old = res.first()
+    current = _tz_aware_utc(old.paid_until) if old else None
+    paid_until = max(moment, current or moment) + timedelta(days=settings.SUBSCRIPTION_DAYS)
+    grace_until = paid_until + timedelta(days=settings.GRACE_DAYS) if settings.GRACE_DAYS else None
+    values = {"status": "active", "paid_until": paid_until, "grace_until": grace_until, "updated_at": moment}
+    stmt = dialect_insert(Subscription).values(user_id=user_id, **values)
+    await s.execute(stmt.on_conflict_do_update(index_elements=[Subscription.user_id], set_=values))
+    await stats.status_changed(s, moment, old.status if old else None, "active")
+    return paid_until, grace_until
+
+async def apply_payment_status(
+    s: AsyncSession, order_ref: str, wfp_status: str, moment: Optional[datetime] = None,
+) -> Optional[PaymentTransition]:
+    """Переводит платёж по статусу WayForPay внутри транзакции вызывающего.
+
+    При оплате там же продлевается подписка. None — перехода нет
+    (неизвестный платёж, промежуточный или уже применённый статус).
+    """
+    new = WFP_STATUSES.get(wfp_status)
+    if new is None:
+        return None
+    moment = moment or datetime.now(UTC)
+    query = select(Payment.status, Payment.user_id, Payment.amount, Payment.created_at).where(Payment.order_ref == order_ref)
+    row = (await s.execute(query)).first()
+    if row is None and await restore_payment(s, order_ref):
+        log.info("Платёж %s возвращён из архива", order_ref)
+        row = (await s.execute(query)).first()
+    if row is None:
+        log.warning("Статус %s для неизвестного платежа %s", wfp_status, order_ref)
+        return None
+    if new not in TRANSITIONS.get(row.status, ()):
+        return None
+    values = {"status": new}
+    if new == "paid":
+        values["paid_at"] = moment
+    elif new == "refunded":
+        values["refunded_at"] = moment
+    res = await s.execute(
+        update(Payment)
+        .where(Payment.order_ref == order_ref, Payment.status == row.status)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if res.rowcount != 1:
+        return None  # платёж уже перевёл параллельный обработчик
+    transition = PaymentTransition(order_ref, row.user_id, row.status, new, row.amount)
+    # Дни агрегатов те же, что у stats.rebuild: оплата и возврат — по paid_at/refunded_at,
+    # отказ — по дате счёта и только пока платёж в статусе declined
+    created = row.created_at or moment
+    if row.status == "declined":
+        await stats.bump(s, created, declined=-1)
+    if new == "paid":
+        first = await _is_first_payment(s, row.user_id, order_ref)
+        transition.paid_until, transition.grace_until = await _extend_subscription(s, row.user_id, moment)
+        await stats.bump(s, moment, payments=1, revenue=row.amount or 0, new_subs=int(first), renewals=int(not first))
+    elif new == "refunded":
+        log.warning("Возврат по платежу %s пользователя %s", order_ref, row.user_id)
+        await stats.bump(s, moment, refunds=1, refunded=row.amount or 0)
+    elif new == "declined":
+        await stats.bump(s, created, declined=1)
+    return transition
+
+def after_commit(transitions: Iterable[PaymentTransition]) -> None:
+    # Локальные кэши обновляем только после фиксации транзакции
+    for t in transitions:
+        if t.paid_until:
+            subscription_changed(t.user_id, SubInfo("active", t.paid_until, t.grace_until))
+        else:
+            invalidate_subscription(t.user_id)
+        forget_invoice(t.user_id)
+
+async def process_callback(order_ref: str, wfp_status: str) -> Optional[PaymentTransition]:
+    key = (order_ref, wfp_status)
+    if _seen.get(key):
+        return None
+    async with Session() as s:
+        transition = await apply_payment_status(s, order_ref, wfp_status)
+        await s.commit()
+    _seen.set(key, True)
+    if transition:
+        after_commit([transition])
+        log.info("Платёж %s: %s -> %s", order_ref, transition.old, transition.new)
+    return transition
+
+async def notify_payment(bot: Bot, transition: PaymentTransition) -> None:
+    if transition.new != "paid" or not transition.paid_until:
+        return
+    until = transition.paid_until.strftime("%d.%m.%Y %H:%M")
+    try:
+        await bot.send_message(transition.user_id, f"✅ Оплата получена! Подписка активна до {until}")
+    except Exception:
+        log.exception("Не удалось уведомить пользователя %s об оплате", transition.user_id)
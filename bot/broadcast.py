@@ -0,0 +1,194 @@
+from __future__ import annotations
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+    TelegramNetworkError, TelegramServerError,
+)
+from sqlalchemy import select, update
+from bot.db import Session, Subscription, Broadcast
+from bot.ratelimit import TokenBucket
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+
+@dataclass
+class BroadcastResult:
+    broadcast_id: int
+    sent: int
+    failed: int
+    state: str
+
+class BroadcastRunner:
+    """Рассылка по подписчикам с общим token bucket, паузой на RetryAfter
+    и ограничением параллельных отправок.
+
+    Получатели читаются потоком (серверный курсор) в порядке user_id, прогресс
+    сохраняется после каждой пачки — прерванная рассылка продолжится со следующей.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: Optional[float] = None,
+        chat_interval: Optional[float] = None,
+        concurrency: Optional[int] = None,
+        chunk: Optional[int] = None,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate or settings.BROADCAST_RATE)
+        self.chat_interval = settings.BROADCAST_CHAT_INTERVAL if chat_interval is None else chat_interval
+        self.chunk = chunk or settings.BROADCAST_CHUNK
+        self._sem = asyncio.Semaphore(concurrency or settings.BROADCAST_CONCURRENCY)
+        self._last_sent: dict[int, float] = {}
+
+    async def _pace_chat(self, chat_id: int) -> None:
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            wait = last + self.chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    async def _send(self, chat_id: int, text: str) -> bool:
+        async with self._sem:
+            for _ in range(MAX_ATTEMPTS):
+                await self._pace_chat(chat_id)
+                await self.bucket.acquire()
+                self._last_sent[chat_id] = time.monotonic()
+                try:
+                    await self.bot.send_message(chat_id, text)
+                    return True
+                except TelegramRetryAfter as e:
+                    # Лимит общий на бота — останавливаем всех, а не только этот чат
+                    log.warning("Рассылка: RetryAfter %s с", e.retry_after)
+                    self.bucket.pause(e.retry_after)
+                except (TelegramForbiddenError, TelegramBadRequest):
+                    return False  # бот заблокирован / чат недоступен — не повторяем
+                except (TelegramNetworkError, TelegramServerError):
+                    await asyncio.sleep(1)
+                except TelegramAPIError as e:
+                    # NotFound, MigrateToChat и прочее — считаем неудачей, рассылку не прерываем
+                    log.warning("Рассылка: чат %s: %s", chat_id, e)
+                    return False
+            return False
+
+    async def _save(self, broadcast_id: int, **values) -> None:
+        async with Session() as s:
+            await s.execute(
+                update(Broadcast).where(Broadcast.id == broadcast_id)
+                .values(updated_at=datetime.utcnow(), **values)
+            )
+            await s.commit()
+
+    async def run(self, broadcast_id: int) -> BroadcastResult:
+        async with Session() as s:
+            b = await s.get(Broadcast, broadcast_id)
+        if b is None:
+            raise ValueError(f"Broadcast {broadcast_id} not found")
+        sent, failed, cursor = b.sent or 0, b.failed or 0, b.cursor or 0
+        if b.state != "running":
+            return BroadcastResult(broadcast_id, sent, failed, b.state)
+        statuses = [x for x in (b.statuses or "").split(",") if x]
+        query = (
+            select(Subscription.user_id)
+            .where(Subscription.status.in_(statuses), Subscription.user_id > cursor)
+            .order_by(Subscription.user_id)
+            .execution_options(yield_per=self.chunk)
+        )
+        async with Session() as s:
+            stream = await s.stream_scalars(query)
+            async for chunk in stream.partitions(self.chunk):
+                # Исключение одной отправки не должно обрывать пачку до сохранения прогресса
+                results = await asyncio.gather(*(self._send(uid, b.text) for uid in chunk), return_exceptions=True)
+                for uid, r in zip(chunk, results):
+                    if isinstance(r, BaseException):
+                        log.error("Рассылка %s: чат %s: %r", broadcast_id, uid, r)
+                ok = sum(r is True for r in results)
+                sent += ok
+                failed += len(results) - ok
+                cursor = chunk[-1]
+                self._last_sent.clear()
+                await self._save(broadcast_id, cursor=cursor, sent=sent, failed=failed)
+                state = await self._state(broadcast_id)
+                if state != "running":
+                    log.info("Рассылка %s остановлена (%s)", broadcast_id, state)
+                    return BroadcastResult(broadcast_id, sent, failed, state)
+        await self._save(broadcast_id, state="done")
+        log.info("Рассылка %s завершена: отправлено %d, ошибок %d", broadcast_id, sent, failed)
+        return BroadcastResult(broadcast_id, sent, failed, "done")
+
+    async def _state(self, broadcast_id: int) -> str:
+        async with Session() as s:
+            res = await s.execute(select(Broadcast.state).where(Broadcast.id == broadcast_id))
+            return res.scalar() or "cancelled"
+
+async def create_broadcast(text: str, statuses: Iterable[str] = ("active", "grace"), created_by: Optional[int] = None) -> int:
+    async with Session() as s:
+        b = Broadcast(text=text, statuses=",".join(statuses), created_by=created_by)
+        s.add(b)
+        await s.commit()
+        return b.id
+
+async def cancel_broadcast(broadcast_id: int) -> None:
+    async with Session() as s:
+        await s.execute(
+            update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.state == "running").values(state="cancelled")
+        )
+        await s.commit()
+
+# Рассылки, которые ведёт этот процесс (только лидер), по id
+_tasks: dict[int, asyncio.Task] = {}
+
+async def _run_and_report(bot: Bot, broadcast_id: int) -> None:
+    try:
+        result = await BroadcastRunner(bot).run(broadcast_id)
+    except Exception:
+        log.exception("Рассылка %s упала", broadcast_id)
+        return
+    async with Session() as s:
+        b = await s.get(Broadcast, broadcast_id)
+    if b and b.created_by:
+        try:
+            await bot.send_message(
+                b.created_by,
+                f"📣 Рассылка #{broadcast_id}: {result.state}, отправлено {result.sent}, ошибок {result.failed}",
+            )
+        except Exception:
+            log.warning("Не удалось отправить отчёт о рассылке %s", broadcast_id)
+
+def start_broadcast(bot: Bot, broadcast_id: int) -> asyncio.Task:
+    task = _tasks.get(broadcast_id)
+    if task is not None and not task.done():
+        return task
+    task = asyncio.create_task(_run_and_report(bot, broadcast_id))
+    _tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(broadcast_id, None))
+    return task
+
+async def stop_broadcasts() -> None:
+    """Прерывает рассылки этого процесса; прогресс сохранён, новый лидер их продолжит."""
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def resume_broadcasts(bot: Bot) -> list[int]:
+    """Запускает рассылки в состоянии running, которые ещё не идут в этом процессе.
+
+    Вызывается только у лидера: при избрании и периодически, так что
+    /broadcast в любом воркере лишь создаёт запись, а отправляет один лидер.
+    """
+    async with Session() as s:
+        res = await s.execute(select(Broadcast.id).where(Broadcast.state == "running"))
+        ids = [i for i in res.scalars() if i not in _tasks]
+    for broadcast_id in ids:
+        log.info("Запускаем рассылку %s", broadcast_id)
+        start_broadcast(bot, broadcast_id)
+    return ids
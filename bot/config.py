@@ -13,8 +13,89 @@ class Settings(BaseSettings):
     PRODUCT_NAME: str = Field(default="Channel subscription (1 month)")
     LANG: str = Field(default="ua")
     DATABASE_URL: str = Field(default="sqlite+aiosqlite:///./bot.sqlite3")
+    DB_ECHO: bool = Field(default=False)
+    DB_POOL_SIZE: int = Field(default=5)
+    DB_MAX_OVERFLOW: int = Field(default=10)
+    DB_POOL_TIMEOUT: float = Field(default=30.0)
+    DB_POOL_RECYCLE: int = Field(default=1800)  # секунды, только для серверных БД
+    DB_QUERY_STATS: bool = Field(default=False)  # гистограммы времени по тексту SQL (db_statement_seconds на /metrics)
+    DB_SLOW_QUERY_MS: float = Field(default=0)  # 0 — журнал медленных запросов выключен
+    METRICS_ENABLED: bool = Field(default=True)  # /metrics в формате Prometheus
+    LOG_LEVEL: str = Field(default="INFO")  # уровень корневого логгера приложения
+    SQLITE_AUTO_VACUUM: str = Field(default="INCREMENTAL")  # для новых БД; см. bot.retention
+    SQLITE_JOURNAL_MODE: str = Field(default="WAL")
+    SQLITE_SYNCHRONOUS: str = Field(default="NORMAL")
+    SQLITE_BUSY_TIMEOUT: int = Field(default=5000)  # мс
+    SQLITE_MMAP_SIZE: int = Field(default=268435456)
+    SQLITE_CACHE_SIZE: int = Field(default=-65536)  # отрицательное — в КиБ
     PAYMENT_URL: str = Field(default="https://secure.wayforpay.com/payment/sd11e605b4ab0")
     TG_JOIN_REQUEST_URL: str = Field(...)
+    EXPIRY_BATCH_SIZE: int = Field(default=500)
+    SUB_CACHE_SIZE: int = Field(default=10000)
+    SUB_CACHE_TTL: float = Field(default=60.0)  # секунды
+    SUB_CACHE_SYNC_INTERVAL: float = Field(default=2.0)  # секунды: сброс кэша по изменениям из других воркеров, 0 — выкл.
+    USER_FLUSH_INTERVAL: float = Field(default=2.0)  # секунды
+    USER_FLUSH_BATCH: int = Field(default=500)
+    USER_REGISTRY_SIZE: int = Field(default=100000)
+    WEBHOOK_MODE: str = Field(default="queue")  # queue | inline
+    WEBHOOK_WORKERS: int = Field(default=4)
+    WEBHOOK_QUEUE_SIZE: int = Field(default=1000)
+    WEBHOOK_OVERFLOW: str = Field(default="reject")  # reject (503, Telegram повторит) | drop
+    WFP_API_URL: str = Field(default="https://api.wayforpay.com/api")
+    WFP_TIMEOUT: float = Field(default=15.0)
+    WFP_CONNECT_TIMEOUT: float = Field(default=5.0)
+    WFP_MAX_CONNECTIONS: int = Field(default=20)
+    WFP_CONCURRENCY: int = Field(default=10)
+    WFP_RETRIES: int = Field(default=2)
+    WFP_BREAKER_THRESHOLD: int = Field(default=5)
+    WFP_BREAKER_RESET: float = Field(default=30.0)  # секунды
+    SUBSCRIPTION_DAYS: int = Field(default=30)
+    GRACE_DAYS: int = Field(default=0)
+    REMINDER_DAYS: list[int] = Field(default_factory=lambda: [3, 1])  # за сколько дней напоминать
+    ADMIN_IDS: list[int] = Field(default_factory=list)  # JSON: [123, 456]
+    BROADCAST_RATE: float = Field(default=25.0)  # сообщений в секунду на весь бот (лимит Telegram ~30)
+    BROADCAST_CHAT_INTERVAL: float = Field(default=1.0)  # секунды между сообщениями в один чат
+    BROADCAST_CONCURRENCY: int = Field(default=8)
+    BROADCAST_CHUNK: int = Field(default=200)
+    BROADCAST_POLL_INTERVAL: int = Field(default=5)  # секунды: как часто лидер подхватывает новые рассылки
+    INVOICE_TTL: int = Field(default=1800)  # секунды, сколько переиспользуем неоплаченный счёт
+    INVOICE_CACHE_SIZE: int = Field(default=10000)
+    MEMBERSHIP_CACHE_SIZE: int = Field(default=10000)
+    MEMBERSHIP_CACHE_TTL: float = Field(default=300.0)  # секунды
+    MEMBERSHIP_RECONCILE_INTERVAL: int = Field(default=10)  # минуты, 0 — сверка выключена
+    MEMBERSHIP_RATE: float = Field(default=10.0)  # запросов к Bot API в секунду
+    MEMBERSHIP_BATCH: int = Field(default=200)
+    MEMBERSHIP_LOOKBACK_HOURS: int = Field(default=24)  # глубина первой сверки после старта
+    MEMBERSHIP_SWEEP_LIMIT: int = Field(default=1000)  # подписок полного обхода за проход, 0 — только изменённые
+    LEADER_LEASE_TTL: float = Field(default=30.0)  # секунды; столько живёт аренда пропавшего лидера
+    LEADER_RENEW_INTERVAL: float = Field(default=10.0)  # секунды
+    DEADLINE_SYNC_INTERVAL: float = Field(default=15.0)  # секунды, подхват изменений других воркеров
+    JOIN_RATE: float = Field(default=20.0)  # одобрений/отклонений заявок в секунду на воркер
+    JOIN_BATCH: int = Field(default=50)
+    JOIN_PENDING_TTL_HOURS: int = Field(default=48)  # через сколько отклонять неоплаченную заявку
+    JOIN_SWEEP_INTERVAL: int = Field(default=60)  # секунды
+    PAYMENT_RETENTION_DAYS: int = Field(default=90)  # закрытые платежи (paid/declined/expired/refunded)
+    PENDING_PAYMENT_RETENTION_DAYS: int = Field(default=7)  # брошенные неоплаченные счета
+    TOKEN_RETENTION_DAYS: int = Field(default=30)
+    RETENTION_BATCH: int = Field(default=500)
+    RETENTION_PAUSE: float = Field(default=0.05)  # секунды между пачками, чтобы не держать блокировку записи
+    RETENTION_HOUR: int = Field(default=4)  # час (UTC) ежедневного запуска, -1 — выключено
+    RETENTION_VACUUM_PAGES: int = Field(default=2000)  # страниц за один incremental_vacuum, 0 — все свободные
+    THROTTLE_ENABLED: bool = Field(default=True)
+    THROTTLE_RATE: float = Field(default=1.0)  # апдейтов в секунду на пользователя
+    THROTTLE_BURST: float = Field(default=5.0)
+    THROTTLE_COMMAND_RATE: float = Field(default=0.5)  # на одну команду/кнопку пользователя
+    THROTTLE_COMMAND_BURST: float = Field(default=2.0)
+    THROTTLE_POLICY: str = Field(default="reply_once")  # drop | delay | reply_once
+    THROTTLE_MAX_DELAY: float = Field(default=2.0)  # секунды; delay держит воркер очереди апдейтов
+    THROTTLE_IDLE_TTL: float = Field(default=600.0)  # секунды до удаления неиспользуемых бакетов
+    PAYMENT_RECONCILE_INTERVAL: int = Field(default=10)  # минуты, 0 — сверка с WayForPay выключена
+    PAYMENT_RECONCILE_LOOKBACK_HOURS: int = Field(default=48)
+    PAYMENT_RECONCILE_MIN_AGE: int = Field(default=300)  # секунды: свежие счета ещё ждут callback
+    PAYMENT_RECONCILE_BATCH: int = Field(default=100)
+    PAYMENT_RECONCILE_CONCURRENCY: int = Field(default=5)  # одновременных CHECK_STATUS
+    FAST_START: bool = Field(default=True)  # не проверять схему/вебхук/имя бота при старте, если они уже сохранены
+    IDENTITY_REFRESH_INTERVAL: int = Field(default=60)  # минуты, фоновая сверка вебхука и имени бота
 
     class Config:
         env_file = ".env"
@@ -1,46 +1,352 @@
+import time
+import asyncio
+import hashlib
+import logging
+from bisect import bisect_left
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
-from datetime import datetime
+from sqlalchemy import BigInteger, Column, Integer, String, Date, DateTime, ForeignKey, Index, event, inspect, select, text
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.exc import OperationalError, ProgrammingError, IntegrityError
+from datetime import datetime, timezone
 from bot.config import settings
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True)
+log = logging.getLogger(__name__)
+
+def _engine_options(url: str) -> dict:
+    u = make_url(url)
+    opts: dict = {"echo": settings.DB_ECHO}
+    if u.get_backend_name() == "sqlite":
+        if u.database in (None, "", ":memory:"):
+            return opts  # StaticPool, размеры пула неприменимы
+        opts["connect_args"] = {"timeout": settings.SQLITE_BUSY_TIMEOUT / 1000}
+    else:
+        opts["pool_pre_ping"] = True
+        opts["pool_recycle"] = settings.DB_POOL_RECYCLE
+    opts.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+    )
+    return opts
+
+engine = create_async_engine(settings.DATABASE_URL, **_engine_options(settings.DATABASE_URL))
 Session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
+@event.listens_for(engine.sync_engine, "connect")
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cur = dbapi_connection.cursor()
+    # Действует только для новой БД (до первой таблицы); у существующей режим меняет лишь VACUUM
+    cur.execute(f"PRAGMA auto_vacuum={settings.SQLITE_AUTO_VACUUM}")
+    cur.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    cur.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cur.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}")
+    cur.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    cur.execute(f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+class QueryStats:
+    """Гистограммы времени выполнения по тексту SQL (параметризованному)."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    OTHER = "<other>"
+
+    def __init__(self, max_statements: int = 200):
+        self.max_statements = max_statements
+        self._stats: dict[str, list] = {}
+
+    def record(self, statement: str, elapsed: float) -> None:
+        entry = self._stats.get(statement)
+        if entry is None:
+            if len(self._stats) >= self.max_statements:
+                statement = self.OTHER
+            entry = self._stats.setdefault(statement, [[0] * (len(self.BUCKETS) + 1), 0, 0.0, 0.0])
+        buckets = entry[0]
+        buckets[bisect_left(self.BUCKETS, elapsed)] += 1
+        entry[1] += 1
+        entry[2] += elapsed
+        if elapsed > entry[3]:
+            entry[3] = elapsed
+
+    @property
+    def total(self) -> int:
+        return sum(e[1] for e in self._stats.values())
+
+    def snapshot(self) -> list[dict]:
+        out = []
+        for statement, (buckets, count, total, worst) in self._stats.items():
+            out.append({
+                "statement": statement,
+                "count": count,
+                "total": total,
+                "max": worst,
+                "buckets": dict(zip([*map(str, self.BUCKETS), "+Inf"], buckets)),
+            })
+        return sorted(out, key=lambda e: e["total"], reverse=True)
+
+    def reset(self) -> None:
+        self._stats.clear()
+
+query_stats = QueryStats()
+# Получатели (statement, elapsed) для каждого выполненного запроса
+query_listeners: list = []
+if settings.DB_QUERY_STATS:
+    query_listeners.append(query_stats.record)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    for listener in query_listeners:
+        listener(statement, elapsed)
+    if settings.DB_SLOW_QUERY_MS and elapsed * 1000 >= settings.DB_SLOW_QUERY_MS:
+        log.warning("Медленный запрос %.1f мс: %s", elapsed * 1000, " ".join(statement.split())[:500])
+
+if settings.DB_QUERY_STATS or settings.DB_SLOW_QUERY_MS or settings.METRICS_ENABLED:
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
 Base = declarative_base()
 
+# Telegram id не помещаются в int4: в Postgres — BIGINT, в SQLite DDL прежний
+TelegramId = BigInteger().with_variant(Integer, "sqlite")
+
+class UTCDateTime(TypeDecorator):
+    """Наивный UTC в колонке TIMESTAMP WITHOUT TIME ZONE.
+
+    Код передаёт и datetime.now(UTC), и наивные utcnow(): SQLite молча отбрасывает
+    tzinfo, а asyncpg на aware-значении для naive-колонки падает с DataError.
+    Здесь aware приводится к UTC и теряет tzinfo; читаются значения наивными, как раньше.
+    """
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime) and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
 class User(Base):
     __tablename__ = "users"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(TelegramId, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     balance = Column(Integer, default=0)
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
-    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    user_id = Column(TelegramId, ForeignKey("users.id"), primary_key=True)
     status = Column(String, default="expired")
-    paid_until = Column(DateTime, nullable=True)
-    grace_until = Column(DateTime, nullable=True)
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    paid_until = Column(UTCDateTime, nullable=True)
+    grace_until = Column(UTCDateTime, nullable=True)
+    updated_at = Column(UTCDateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_subscriptions_status_paid_until", "status", "paid_until"),
+        Index("ix_subscriptions_updated_at", "updated_at", "user_id"),
+    )
 
 class Payment(Base):
     __tablename__ = "payments"
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(TelegramId, ForeignKey("users.id"))
     order_ref = Column(String, unique=True)
     amount = Column(Integer)
     currency = Column(String)
     status = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(UTCDateTime, default=datetime.utcnow)
+    product = Column(String, nullable=True)
+    invoice_url = Column(String, nullable=True)
+    expires_at = Column(UTCDateTime, nullable=True)
+    paid_at = Column(UTCDateTime, nullable=True)  # момент перехода в paid (день выручки в статистике)
+    refunded_at = Column(UTCDateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_payments_user_status_created", "user_id", "status", "created_at"),
+        Index("ix_payments_status_created", "status", "created_at"),
+    )
 
 class PaymentToken(Base):
     __tablename__ = "payment_tokens"
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer)
+    user_id = Column(TelegramId)
     token = Column(String, unique=True)
     status = Column(String, default="pending")
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(UTCDateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_payment_tokens_user_status_created", "user_id", "status", "created_at"),
+        Index("ix_payment_tokens_created", "created_at"),
+    )
+
+# Архив: закрытые/брошенные платежи и использованные/просроченные токены
+# переносятся сюда задачей bot.retention, чтобы горячие таблицы оставались маленькими.
+# id архива свой: строки сопоставляются с горячими по order_ref / token.
+class PaymentArchive(Base):
+    __tablename__ = "payments_archive"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(TelegramId, index=True)
+    order_ref = Column(String, unique=True)
+    amount = Column(Integer)
+    currency = Column(String)
+    status = Column(String)
+    created_at = Column(UTCDateTime)
+    product = Column(String, nullable=True)
+    invoice_url = Column(String, nullable=True)
+    expires_at = Column(UTCDateTime, nullable=True)
+    paid_at = Column(UTCDateTime, nullable=True)
+    refunded_at = Column(UTCDateTime, nullable=True)
+    archived_at = Column(UTCDateTime, default=datetime.utcnow)
+
+class PaymentTokenArchive(Base):
+    __tablename__ = "payment_tokens_archive"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(TelegramId, index=True)
+    token = Column(String, unique=True)
+    status = Column(String)
+    created_at = Column(UTCDateTime)
+    archived_at = Column(UTCDateTime, default=datetime.utcnow)
+
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+    id = Column(Integer, primary_key=True)
+    text = Column(String, nullable=False)
+    statuses = Column(String, default="active,grace")  # статусы подписки получателей
+    state = Column(String, default="running")  # running | done | cancelled
+    cursor = Column(TelegramId, default=0)  # последний обработанный user_id
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    created_by = Column(TelegramId, nullable=True)
+    created_at = Column(UTCDateTime, default=datetime.utcnow)
+    updated_at = Column(UTCDateTime, default=datetime.utcnow)
+
+class JoinRequest(Base):
+    __tablename__ = "join_requests"
+    user_id = Column(TelegramId, primary_key=True)
+    chat_id = Column(TelegramId, nullable=False)
+    status = Column(String, default="pending")  # pending | approved | declined | cancelled
+    created_at = Column(UTCDateTime, default=datetime.utcnow)
+    updated_at = Column(UTCDateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_join_requests_status_created", "status", "created_at"),
+    )
+
+class DailyStats(Base):
+    # Агрегаты за сутки (UTC), обновляются инкрементально в bot.stats
+    __tablename__ = "daily_stats"
+    day = Column(Date, primary_key=True)
+    payments = Column(Integer, default=0, nullable=False)  # оплаченных платежей
+    revenue = Column(Integer, default=0, nullable=False)
+    new_subs = Column(Integer, default=0, nullable=False)  # первая оплата пользователя
+    renewals = Column(Integer, default=0, nullable=False)
+    refunds = Column(Integer, default=0, nullable=False)
+    refunded = Column(Integer, default=0, nullable=False)  # сумма возвратов
+    declined = Column(Integer, default=0, nullable=False)
+    graced = Column(Integer, default=0, nullable=False)
+    expired = Column(Integer, default=0, nullable=False)
+
+class StatCounter(Base):
+    # Текущие значения, которые не раскладываются по дням (число активных подписок)
+    __tablename__ = "stat_counters"
+    name = Column(String, primary_key=True)
+    value = Column(Integer, default=0, nullable=False)
+
+class Lease(Base):
+    __tablename__ = "leases"
+    name = Column(String, primary_key=True)  # например "scheduler"
+    holder = Column(String, nullable=False)
+    expires_at = Column(UTCDateTime, nullable=False)
+
+class AppState(Base):
+    # Общие для всех воркеров значения: username бота и т.п.
+    __tablename__ = "app_state"
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=True)
+    updated_at = Column(UTCDateTime, default=datetime.utcnow)
+
+def dialect_insert(table):
+    # INSERT с поддержкой ON CONFLICT для текущего диалекта (SQLite / Postgres)
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+def _add_missing_columns(conn) -> None:
+    # Новые nullable-колонки в существующих таблицах (create_all их не добавляет)
+    insp = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name not in existing and col.nullable:
+                col_type = col.type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}"))
+
+def _create_missing_indexes(conn) -> None:
+    # create_all не добавляет новые индексы к уже существующим таблицам
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+SCHEMA_VERSION_KEY = "schema_version"
+
+def schema_version() -> str:
+    """Хэш DDL всех таблиц и индексов для текущего диалекта: меняется вместе с моделями."""
+    h = hashlib.sha1()
+    for table in Base.metadata.sorted_tables:
+        h.update(str(CreateTable(table).compile(dialect=engine.dialect)).encode())
+        for index in sorted(table.indexes, key=lambda i: i.name or ""):
+            h.update(str(CreateIndex(index).compile(dialect=engine.dialect)).encode())
+    return h.hexdigest()[:16]
+
+async def _stored_schema_version() -> str | None:
+    try:
+        async with engine.connect() as conn:
+            res = await conn.execute(
+                select(AppState.value).where(AppState.key == SCHEMA_VERSION_KEY)
+            )
+            return res.scalar()
+    except (OperationalError, ProgrammingError):
+        return None  # app_state ещё нет — новая БД
+
+def _save_schema_version(conn, version: str) -> None:
+    conn.execute(
+        dialect_insert(AppState)
+        .values(key=SCHEMA_VERSION_KEY, value=version, updated_at=datetime.utcnow())
+        .on_conflict_do_update(index_elements=[AppState.key], set_={"value": version, "updated_at": datetime.utcnow()})
+    )
+
+# Ключ pg_advisory_xact_lock, под которым воркеры по очереди создают схему
+INIT_LOCK_KEY = 0x7467_7375_6273
+INIT_ATTEMPTS = 5
 
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+async def init_db() -> bool:
+    """Создаёт/дополняет схему. Возвращает False, если схема уже актуальна и проверка пропущена."""
+    version = schema_version()
+    if settings.FAST_START and await _stored_schema_version() == version:
+        return False
+    # Несколько воркеров стартуют одновременно: в Postgres схему создаёт один под
+    # advisory-локом, в SQLite проигравший гонку получает "already exists" и повторяет.
+    for attempt in range(1, INIT_ATTEMPTS + 1):
+        try:
+            async with engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": INIT_LOCK_KEY})
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(_add_missing_columns)
+                await conn.run_sync(_create_missing_indexes)
+                await conn.run_sync(_save_schema_version, version)
+            return True
+        except (OperationalError, ProgrammingError, IntegrityError) as e:
+            if attempt == INIT_ATTEMPTS:
+                raise
+            log.warning("init_db: попытка %d не удалась (%s), повтор", attempt, e.orig)
+            await asyncio.sleep(0.2 * attempt)
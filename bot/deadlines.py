@@ -0,0 +1,208 @@
+from __future__ import annotations
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from aiogram import Bot
+from sqlalchemy import select, or_, and_
+from bot.db import Session, Subscription
+from bot.expiry import ACTIVE_STATUSES, expire_users
+from bot.services import SubInfo, get_subscription_status, invalidate_subscription, _tz_aware_utc
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+REMIND = "remind"
+EXPIRE = "expire"  # paid_until или grace_until
+
+# Дольше не спим, даже если ближайший дедлайн далеко: страховка от перевода часов
+MAX_SLEEP = 300.0
+RETRY_DELAY = 30.0
+
+class DeadlineScheduler:
+    """Очередь с приоритетом ближайших дедлайнов подписок.
+
+    Для каждого пользователя хранится версия расписания: при изменении дат
+    старые записи в куче не удаляются, а пропускаются при срабатывании.
+    """
+
+    def __init__(self, reminder_days: list[int]):
+        self.reminder_days = sorted({d for d in reminder_days if d > 0}, reverse=True)
+        self._heap: list[tuple[float, int, int, str, int]] = []
+        self._versions: dict[int, int] = {}
+        self._seq = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.bot: Optional[Bot] = None
+        self.fired = 0
+        self._mark: Optional[tuple[datetime, int]] = None
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def _push(self, when: datetime, user_id: int, kind: str, version: int) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (when.timestamp(), self._seq, user_id, kind, version))
+
+    def schedule(self, user_id: int, info: SubInfo) -> None:
+        if not self.running:
+            return
+        if info.status not in ACTIVE_STATUSES or not info.paid_until:
+            self._versions.pop(user_id, None)
+            return
+        version = self._versions.get(user_id, 0) + 1
+        self._versions[user_id] = version
+        moment = datetime.now(UTC)
+        if info.status == "active":
+            for days in self.reminder_days:
+                at = info.paid_until - timedelta(days=days)
+                if at > moment:
+                    self._push(at, user_id, REMIND, version)
+            self._push(info.paid_until, user_id, EXPIRE, version)
+        if info.grace_until and info.grace_until > info.paid_until:
+            self._push(info.grace_until, user_id, EXPIRE, version)
+        if len(self._heap) > 4 * len(self._versions) + 1000:
+            self._compact()
+        if self._wake is not None:
+            self._wake.set()
+
+    def _compact(self) -> None:
+        # Выбрасываем записи устаревших версий, накопившиеся от переназначений
+        self._heap = [e for e in self._heap if self._versions.get(e[2]) == e[4]]
+        heapq.heapify(self._heap)
+
+    async def load(self) -> int:
+        """Загрузка активных подписок диапазонным запросом по индексу (status, paid_until)."""
+        query = (
+            select(Subscription.user_id, Subscription.status, Subscription.paid_until, Subscription.grace_until)
+            .where(Subscription.status.in_(ACTIVE_STATUSES), Subscription.paid_until.is_not(None))
+            .execution_options(yield_per=1000)
+        )
+        count = 0
+        async with Session() as s:
+            stream = await s.stream(query)
+            async for row in stream:
+                self.schedule(row.user_id, SubInfo(
+                    status=row.status,
+                    paid_until=_tz_aware_utc(row.paid_until),
+                    grace_until=_tz_aware_utc(row.grace_until),
+                ))
+                count += 1
+        return count
+
+    async def sync(self, batch: int = 1000) -> int:
+        """Подхватывает подписки, изменённые другими воркерами (индекс по updated_at).
+
+        Изменения в своём процессе приходят через subscription_listeners сразу,
+        повторное планирование для них безвредно.
+        """
+        if not self.running or self._mark is None:
+            return 0
+        count = 0
+        while True:
+            ts, uid = self._mark
+            query = (
+                select(Subscription.user_id, Subscription.status, Subscription.paid_until,
+                       Subscription.grace_until, Subscription.updated_at)
+                .where(or_(
+                    Subscription.updated_at > ts,
+                    and_(Subscription.updated_at == ts, Subscription.user_id > uid),
+                ))
+                .order_by(Subscription.updated_at, Subscription.user_id)
+                .limit(batch)
+            )
+            async with Session() as s:
+                rows = (await s.execute(query)).all()
+            for row in rows:
+                self.schedule(row.user_id, SubInfo(
+                    status=row.status,
+                    paid_until=_tz_aware_utc(row.paid_until),
+                    grace_until=_tz_aware_utc(row.grace_until),
+                ))
+            count += len(rows)
+            if rows:
+                self._mark = (rows[-1].updated_at, rows[-1].user_id)
+            if len(rows) < batch:
+                return count
+
+    def _pop_due(self, now_ts: float) -> list[tuple[int, str]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            _, _, user_id, kind, version = heapq.heappop(self._heap)
+            if self._versions.get(user_id) == version:
+                due.append((user_id, kind))
+        return due
+
+    async def _fire(self, due: list[tuple[int, str]]) -> None:
+        self.fired += len(due)
+        expiring = sorted({user_id for user_id, kind in due if kind == EXPIRE})
+        if expiring:
+            changed = await expire_users(expiring)
+            for user_id, new_status in changed:
+                invalidate_subscription(user_id)
+                if new_status == "expired":
+                    self._versions.pop(user_id, None)
+            if changed:
+                log.info("Дедлайны: изменён статус у %d подписок", len(changed))
+        for user_id, kind in due:
+            if kind == REMIND:
+                await self._remind(user_id)
+
+    async def _remind(self, user_id: int) -> None:
+        info = await get_subscription_status(user_id)
+        if info.status != "active" or not info.paid_until or self.bot is None:
+            return
+        until = info.paid_until.strftime("%d.%m.%Y %H:%M")
+        try:
+            await self.bot.send_message(
+                user_id, f"⏰ Ваша подписка закончится {until} (UTC). Продлите её, чтобы не потерять доступ.",
+            )
+        except Exception:
+            log.warning("Не удалось отправить напоминание пользователю %s", user_id)
+
+    async def _run(self) -> None:
+        assert self._wake is not None
+        while True:
+            now_ts = datetime.now(UTC).timestamp()
+            due = self._pop_due(now_ts)
+            if due:
+                try:
+                    await self._fire(due)
+                except Exception:
+                    log.exception("Ошибка обработки дедлайнов, повтор через %.0f с", RETRY_DELAY)
+                    retry_at = datetime.fromtimestamp(now_ts + RETRY_DELAY, UTC)
+                    for user_id, kind in due:
+                        if kind == EXPIRE and user_id in self._versions:
+                            self._push(retry_at, user_id, kind, self._versions[user_id])
+                continue
+            delay = MAX_SLEEP if not self._heap else min(MAX_SLEEP, self._heap[0][0] - now_ts)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 0.0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, bot: Bot) -> int:
+        self.bot = bot
+        self._mark = (datetime.now(UTC), 0)
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        count = await self.load()
+        log.info("Дедлайны: загружено %d подписок, %d событий", count, len(self._heap))
+        return count
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._heap.clear()
+        self._versions.clear()
+        self._mark = None
+
+scheduler = DeadlineScheduler(settings.REMINDER_DAYS)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+import time
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional
+from sqlalchemy import select, update, and_, or_
+from bot.db import Session, Subscription
+from bot import stats
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("active", "grace")
+
+@dataclass
+class ExpiryStats:
+    graced: int = 0
+    expired: int = 0
+    batches: int = 0
+    duration: float = 0.0
+    started_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+    @property
+    def affected(self) -> int:
+        return self.graced + self.expired
+
+def _to_expired(moment: datetime):
+    # Доступ закончился: оплата истекла и льготного периода нет (или он тоже истёк)
+    return and_(
+        Subscription.status.in_(ACTIVE_STATUSES),
+        Subscription.paid_until < moment,
+        or_(Subscription.grace_until.is_(None), Subscription.grace_until < moment),
+    )
+
+def _to_grace(moment: datetime):
+    # Оплата истекла, но льготный период ещё идёт
+    return and_(
+        Subscription.status == "active",
+        Subscription.paid_until < moment,
+        Subscription.grace_until >= moment,
+    )
+
+async def _count_flips(s, new_status: str, count: int, moment: datetime) -> None:
+    # В expired попадают и active, и grace — для счётчика доступа это одно и то же
+    if count:
+        await stats.status_changed(s, moment, "active", new_status, count)
+
+async def _flip_batch(condition, new_status: str, moment: datetime, limit: int) -> tuple[int, list[int]]:
+    # Короткая транзакция на пачку: выбираем ключи по индексу (status, paid_until)
+    # и переключаем их одним UPDATE с тем же условием, чтобы не задеть строки,
+    # которые успели продлить между SELECT и UPDATE. Возвращает число выбранных
+    # и id реально переключённых — только они идут в счётчики и дальше.
+    async with Session() as s:
+        res = await s.execute(select(Subscription.user_id).where(condition).limit(limit))
+        ids = list(res.scalars())
+        if not ids:
+            return 0, []
+        res = await s.execute(
+            update(Subscription)
+            .where(Subscription.user_id.in_(ids), condition)
+            .values(status=new_status, updated_at=moment)
+            .returning(Subscription.user_id)
+            .execution_options(synchronize_session=False)
+        )
+        changed = list(res.scalars())
+        await _count_flips(s, new_status, len(changed), moment)
+        await s.commit()
+        return len(ids), changed
+
+async def iter_expirations(
+    moment: Optional[datetime] = None,
+    batch_size: Optional[int] = None,
+    stats: Optional[ExpiryStats] = None,
+) -> AsyncIterator[tuple[int, str]]:
+    """Переводит просроченные подписки в grace/expired пачками и отдаёт (user_id, новый статус)."""
+    moment = moment or datetime.now(timezone.utc)
+    batch_size = batch_size or settings.EXPIRY_BATCH_SIZE
+    stats = stats if stats is not None else ExpiryStats(started_at=moment)
+    t0 = time.perf_counter()
+    try:
+        for new_status, condition in (("expired", _to_expired(moment)), ("grace", _to_grace(moment))):
+            while True:
+                selected, ids = await _flip_batch(condition, new_status, moment, batch_size)
+                if not selected:
+                    break
+                stats.batches += 1
+                if new_status == "expired":
+                    stats.expired += len(ids)
+                else:
+                    stats.graced += len(ids)
+                for user_id in ids:
+                    yield user_id, new_status
+                if selected < batch_size:
+                    break
+    finally:
+        stats.duration = time.perf_counter() - t0
+
+async def expire_users(user_ids: list[int], moment: Optional[datetime] = None) -> list[tuple[int, str]]:
+    """Те же переходы, но только для указанных пользователей (срабатывание дедлайна)."""
+    moment = moment or datetime.now(timezone.utc)
+    changed: list[tuple[int, str]] = []
+    async with Session() as s:
+        for new_status, condition in (("expired", _to_expired(moment)), ("grace", _to_grace(moment))):
+            res = await s.execute(
+                update(Subscription)
+                .where(Subscription.user_id.in_(user_ids), condition)
+                .values(status=new_status, updated_at=moment)
+                .returning(Subscription.user_id)
+                .execution_options(synchronize_session=False)
+            )
+            ids = list(res.scalars())
+            await _count_flips(s, new_status, len(ids), moment)
+            changed.extend((user_id, new_status) for user_id in ids)
+        await s.commit()
+    return changed
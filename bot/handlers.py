@@ -1,20 +1,19 @@
 from __future__ import annotations
 
-from aiogram import Router, F, Bot
-
-from aiogram.types import CallbackQuery
+from aiogram import Router
 
 from .handlers_start import router as start_router
 from .handlers_buy import router as buy_router
 from .handlers_wipe import router as wipe_router
-
-from bot.config import settings
-from bot.services import get_subscription_status, is_member_of_channel, ensure_user
-from bot.handlers_buy import cmd_buy 
+from .handlers_broadcast import router as broadcast_router
+from .handlers_join import router as join_router
+from .handlers_stats import router as stats_router
 
 router = Router(name="root")
 
 router.include_router(start_router)
 router.include_router(buy_router)
 router.include_router(wipe_router)
-
+router.include_router(broadcast_router)
+router.include_router(join_router)
+router.include_router(stats_router)
@@ -0,0 +1,29 @@
+from __future__ import annotations
+import logging
+from aiogram import Router, F
+from aiogram.types import Message
+from aiogram.filters import Command, CommandObject
+from bot.broadcast import create_broadcast, cancel_broadcast
+from bot.config import settings
+
+router = Router(name="broadcast")
+router.message.filter(F.from_user.id.in_(settings.ADMIN_IDS))
+log = logging.getLogger(__name__)
+
+@router.message(Command(commands=["broadcast"]))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    """Рассылка всем активным подписчикам: /broadcast текст"""
+    if not command.args:
+        await message.answer("Использование: /broadcast текст сообщения")
+        return
+    broadcast_id = await create_broadcast(command.args, created_by=message.from_user.id)
+    # Отправляет лидер: он подхватит запись при ближайшем опросе
+    await message.answer(f"📣 Рассылка #{broadcast_id} поставлена в очередь")
+
+@router.message(Command(commands=["broadcast_cancel"]))
+async def cmd_broadcast_cancel(message: Message, command: CommandObject):
+    if not command.args or not command.args.strip().isdigit():
+        await message.answer("Использование: /broadcast_cancel номер")
+        return
+    await cancel_broadcast(int(command.args))
+    await message.answer(f"⛔️ Рассылка #{command.args.strip()} будет остановлена")
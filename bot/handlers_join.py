@@ -0,0 +1,35 @@
+from __future__ import annotations
+import logging
+from aiogram import Router, F
+from aiogram.types import ChatJoinRequest
+from aiogram.exceptions import TelegramAPIError
+from bot.services import ensure_user, get_access
+from bot.joins import worker, register_join_request, approve_if_waiting, APPROVE
+from bot.handlers_start import main_kb
+from bot.config import settings
+
+router = Router(name="join")
+log = logging.getLogger(__name__)
+
+@router.chat_join_request(F.chat.id == settings.CHANNEL_ID)
+async def on_join_request(request: ChatJoinRequest):
+    await ensure_user(request.from_user)
+    user_id = request.from_user.id
+    _, active = await get_access(user_id)
+    if active:
+        worker.submit(APPROVE, request.chat.id, user_id)
+        return
+    await register_join_request(user_id, request.chat.id)
+    # Оплата могла пройти, пока заявка записывалась
+    _, active = await get_access(user_id)
+    if active:
+        approve_if_waiting(user_id)
+        return
+    try:
+        await request.bot.send_message(
+            request.user_chat_id,
+            "📝 Заявку на вступление получено. Оформите подписку — после оплаты заявка будет одобрена автоматически.",
+            reply_markup=main_kb(),
+        )
+    except TelegramAPIError:
+        log.info("Не удалось написать пользователю %s по заявке", user_id)
@@ -4,7 +4,7 @@ from aiogram.filters import CommandStart
 from bot.services import ensure_user
 from bot.config import settings
 
-router = Router()
+router = Router(name="start")
 
 WELCOME = (
     "👋 <b>Вітаємо у навчальному боті HMT 2026 | Історія України!</b>\n\n"
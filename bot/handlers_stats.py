@@ -0,0 +1,35 @@
+from __future__ import annotations
+import logging
+from aiogram import Router, F
+from aiogram.types import Message
+from aiogram.filters import Command
+from bot.stats import summary, rebuild
+from bot.config import settings
+
+router = Router(name="stats")
+router.message.filter(F.from_user.id.in_(settings.ADMIN_IDS))
+log = logging.getLogger(__name__)
+
+def _line(title: str, t: dict) -> str:
+    return (
+        f"<b>{title}</b>: оплат {t['payments']} на {t['revenue']} {settings.CURRENCY}, "
+        f"новых {t['new_subs']}, продлений {t['renewals']}, истекло {t['expired']}, возвратов {t['refunds']}"
+    )
+
+@router.message(Command(commands=["stats"]))
+async def cmd_stats(message: Message):
+    """Сводка из daily_stats: без сканирования платежей и подписок."""
+    s = await summary()
+    rate = f"{s.renewal_rate:.0%}" if s.renewal_rate is not None else "—"
+    await message.answer("\n".join([
+        f"📊 Активных подписок: <b>{s.active}</b>",
+        _line("Сегодня", s.today),
+        _line("7 дней", s.week),
+        _line("30 дней", s.month),
+        f"Продлевают (30 дней): {rate}",
+    ]))
+
+@router.message(Command(commands=["stats_rebuild"]))
+async def cmd_stats_rebuild(message: Message):
+    days = await rebuild()
+    await message.answer(f"♻️ Статистика пересчитана: {days} дней")
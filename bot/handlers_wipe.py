@@ -1,11 +1,16 @@
 from __future__ import annotations
 import logging
-from aiogram import Router, Message
+from aiogram import Router
+from aiogram.types import Message
 from aiogram.filters import Command
-from bot.db import Session, User, Subscription, Payment, PaymentToken
-from bot.services import ensure_user
+from sqlalchemy import select
+from bot.db import Session, User, Subscription, Payment, PaymentToken, PaymentArchive, PaymentTokenArchive
+from bot.services import ensure_user, invalidate_subscription
+from bot.users import registry
+from bot.invoices import forget_invoice
+from bot import stats
 
-router = Router()
+router = Router(name="wipe")
 log = logging.getLogger(__name__)
 
 @router.message(Command(commands=["wipe"]))
@@ -14,9 +19,18 @@ async def cmd_wipe(message: Message):
     await ensure_user(message.from_user)
     user_id = message.from_user.id
     async with Session() as s:
+        res = await s.execute(select(Subscription.status).where(Subscription.user_id == user_id))
+        status = res.scalar()
+        if status in stats.ACCESS_STATUSES:
+            await stats.bump_counter(s, stats.ACTIVE, -1)
         await s.execute(Payment.__table__.delete().where(Payment.user_id == user_id))
         await s.execute(PaymentToken.__table__.delete().where(PaymentToken.user_id == user_id))
+        await s.execute(PaymentArchive.__table__.delete().where(PaymentArchive.user_id == user_id))
+        await s.execute(PaymentTokenArchive.__table__.delete().where(PaymentTokenArchive.user_id == user_id))
         await s.execute(Subscription.__table__.delete().where(Subscription.user_id == user_id))
         await s.execute(User.__table__.delete().where(User.id == user_id))
         await s.commit()
+    registry.forget(user_id)
+    forget_invoice(user_id)
+    invalidate_subscription(user_id)
     await message.answer("🧹 Ваши данные успешно удалены.")
@@ -0,0 +1,109 @@
+from __future__ import annotations
+import asyncio
+import logging
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from bot.cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("reject", "drop")
+
+def _chat_key(update: Update) -> int:
+    # Ключ шардирования: апдейты одного чата всегда попадают к одному воркеру
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+class UpdateQueue:
+    """Очередь входящих апдейтов с пулом воркеров.
+
+    Каждый воркер владеет своей ограниченной очередью, апдейт попадает
+    в очередь по chat id — так сохраняется порядок внутри чата.
+    Повторные доставки с тем же update_id отбрасываются.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int, maxsize: int, overflow: str = "reject"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.dp = dp
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.overflow = overflow
+        per_worker = max(1, maxsize // self.workers)
+        self._queues: list[asyncio.Queue[Update]] = [asyncio.Queue(per_worker) for _ in range(self.workers)]
+        self._seen: TTLCache[int, bool] = TTLCache(maxsize=max(maxsize * 4, 1000), ttl=3600)
+        self._tasks: list[asyncio.Task] = []
+        self.accepted = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def put(self, update: Update) -> bool:
+        """Ставит апдейт в очередь. False — очередь переполнена и Telegram должен повторить."""
+        if self._seen.get(update.update_id):
+            self.duplicates += 1
+            return True
+        queue = self._queues[_chat_key(update) % self.workers]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            if self.overflow == "drop":
+                self.dropped += 1
+                log.warning("Очередь апдейтов переполнена, update %s отброшен", update.update_id)
+                return True
+            self.rejected += 1
+            return False
+        self._seen.set(update.update_id, True)
+        self.accepted += 1
+        return True
+
+    async def _worker(self, queue: asyncio.Queue[Update]) -> None:
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                self.failed += 1
+                log.exception("Ошибка обработки update %s", update.update_id)
+            finally:
+                queue.task_done()
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("Не дождались обработки %d апдейтов", self.depth)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "capacity": sum(q.maxsize for q in self._queues),
+            "workers": self.workers,
+            "overflow": self.overflow,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
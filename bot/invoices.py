@@ -0,0 +1,90 @@
+from __future__ import annotations
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import select
+from bot.db import Session, Payment
+from bot.cache import TTLCache, SingleFlight
+from bot.payments.wayforpay import create_invoice
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+# Не отдаём счёт, который истечёт раньше, чем пользователь успеет оплатить
+REUSE_MARGIN = timedelta(minutes=2)
+
+@dataclass(frozen=True)
+class PendingInvoice:
+    url: str
+    order_ref: str
+    amount: int
+    product: str
+    expires_at: datetime
+
+    def usable_for(self, amount: int, product: str, moment: datetime) -> bool:
+        return self.amount == amount and self.product == product and self.expires_at - REUSE_MARGIN > moment
+
+_cache: TTLCache[int, PendingInvoice] = TTLCache(maxsize=settings.INVOICE_CACHE_SIZE, ttl=settings.INVOICE_TTL)
+_inflight: SingleFlight[tuple[int, int, str], PendingInvoice] = SingleFlight()
+
+def _aware(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=UTC) if dt.tzinfo is None else dt
+
+def forget_invoice(user_id: int) -> None:
+    _cache.pop(user_id)
+
+async def _find_pending(user_id: int, amount: int, product: str, moment: datetime) -> Optional[PendingInvoice]:
+    async with Session() as s:
+        res = await s.execute(
+            select(Payment.order_ref, Payment.invoice_url, Payment.expires_at)
+            .where(
+                Payment.user_id == user_id,
+                Payment.status == "pending",
+                Payment.amount == amount,
+                Payment.product == product,
+                Payment.invoice_url.is_not(None),
+                Payment.expires_at > moment + REUSE_MARGIN,
+            )
+            .order_by(Payment.created_at.desc())
+            .limit(1)
+        )
+        row = res.first()
+    if not row:
+        return None
+    return PendingInvoice(row.invoice_url, row.order_ref, amount, product, _aware(row.expires_at))
+
+async def _load_or_create(user_id: int, amount: int, product: str) -> PendingInvoice:
+    moment = datetime.now(UTC)
+    inv = await _find_pending(user_id, amount, product, moment)
+    if inv is None:
+        url, order_ref = await create_invoice(
+            user_id=user_id, amount=amount, product_name=product, order_timeout=settings.INVOICE_TTL,
+        )
+        inv = PendingInvoice(url, order_ref, amount, product, moment + timedelta(seconds=settings.INVOICE_TTL))
+        async with Session() as s:
+            s.add(Payment(
+                user_id=user_id,
+                order_ref=order_ref,
+                amount=amount,
+                currency="UAH",
+                status="pending",
+                created_at=moment,
+                product=product,
+                invoice_url=url,
+                expires_at=inv.expires_at,
+            ))
+            await s.commit()
+    _cache.set(user_id, inv, ttl=(inv.expires_at - REUSE_MARGIN - moment).total_seconds())
+    return inv
+
+async def get_invoice(user_id: int, amount: int, product: str) -> PendingInvoice:
+    """Действующий неоплаченный счёт пользователя или новый, если такого нет.
+
+    Повторные нажатия отдаются из памяти, одновременные — ждут один запрос к WayForPay.
+    """
+    inv = _cache.get(user_id)
+    if inv is not None and inv.usable_for(amount, product, datetime.now(UTC)):
+        return inv
+    return await _inflight.run((user_id, amount, product), lambda: _load_or_create(user_id, amount, product))
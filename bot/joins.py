@@ -0,0 +1,175 @@
+from __future__ import annotations
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError
+from sqlalchemy import select, update, func
+from bot.db import Session, JoinRequest, Subscription, dialect_insert
+from bot.expiry import ACTIVE_STATUSES
+from bot.services import SubInfo
+from bot.membership import forget_member
+from bot.ratelimit import TokenBucket
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+APPROVE = "approve"
+DECLINE = "decline"
+MAX_ATTEMPTS = 5
+
+# Заявки этого процесса, ждущие оплаты: user_id -> chat_id.
+# Заявки, поданные через другие воркеры, подхватывает sweep_join_requests у лидера.
+_waiting: dict[int, int] = {}
+
+class JoinWorker:
+    """Очередь одобрений/отклонений заявок на вступление.
+
+    Решения копятся в очереди и обрабатываются пачками до batch штук:
+    вызовы Bot API идут через общий token bucket, итог записывается
+    в join_requests одним UPDATE на пачку.
+    """
+
+    def __init__(self, rate: Optional[float] = None, batch: Optional[int] = None):
+        self.bucket = TokenBucket(rate or settings.JOIN_RATE)
+        self.batch = batch or settings.JOIN_BATCH
+        self.bot: Optional[Bot] = None
+        self.processed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, action: str, chat_id: int, user_id: int) -> bool:
+        if self._queue is None or user_id in self._queued:
+            return False
+        self._queued.add(user_id)
+        self._queue.put_nowait((action, chat_id, user_id))
+        return True
+
+    async def _call(self, action: str, chat_id: int, user_id: int) -> str:
+        method = self.bot.approve_chat_join_request if action == APPROVE else self.bot.decline_chat_join_request
+        for _ in range(MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await method(chat_id, user_id)
+                return "approved" if action == APPROVE else "declined"
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except (TelegramBadRequest, TelegramForbiddenError) as e:
+                # HIDE_REQUESTER_MISSING: заявку отозвали или уже обработали вручную
+                log.info("Заявка %s: %s не выполнено: %s", user_id, action, e)
+                return "cancelled"
+        return "pending"
+
+    async def _process(self, items: list[tuple[str, int, int]]) -> None:
+        results = await asyncio.gather(*(self._call(*item) for item in items), return_exceptions=True)
+        outcome: dict[str, list[int]] = {}
+        for (action, _, user_id), result in zip(items, results):
+            self._queued.discard(user_id)
+            if isinstance(result, Exception):
+                log.warning("Заявка %s: ошибка %s: %s", user_id, action, result)
+                continue
+            if result == "approved":
+                forget_member(user_id)
+            outcome.setdefault(result, []).append(user_id)
+        self.processed += len(items)
+        moment = datetime.now(UTC)
+        async with Session() as s:
+            for status, user_ids in outcome.items():
+                if status == "pending":
+                    continue
+                await s.execute(
+                    update(JoinRequest)
+                    .where(JoinRequest.user_id.in_(user_ids), JoinRequest.status == "pending")
+                    .values(status=status, updated_at=moment)
+                )
+            await s.commit()
+
+    async def _run(self) -> None:
+        assert self._queue is not None
+        while True:
+            items = [await self._queue.get()]
+            while len(items) < self.batch and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            try:
+                await self._process(items)
+            except Exception:
+                log.exception("Ошибка обработки пачки заявок (%d)", len(items))
+
+    def start(self, bot: Bot) -> None:
+        self.bot = bot
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._queue = None
+        self._queued.clear()
+
+worker = JoinWorker()
+
+async def register_join_request(user_id: int, chat_id: int) -> None:
+    """Запоминает заявку без доступа: одобрим после оплаты или отклоним по истечении JOIN_PENDING_TTL."""
+    moment = datetime.now(UTC)
+    stmt = dialect_insert(JoinRequest).values(
+        user_id=user_id, chat_id=chat_id, status="pending", created_at=moment, updated_at=moment,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[JoinRequest.user_id],
+        set_={"chat_id": chat_id, "status": "pending", "created_at": moment, "updated_at": moment},
+    )
+    async with Session() as s:
+        await s.execute(stmt)
+        await s.commit()
+    _waiting[user_id] = chat_id
+
+def approve_if_waiting(user_id: int) -> None:
+    chat_id = _waiting.pop(user_id, None)
+    if chat_id is not None:
+        worker.submit(APPROVE, chat_id, user_id)
+
+def on_subscription_changed(user_id: int, info: SubInfo) -> None:
+    # Оплата прошла в этом процессе — одобряем заявку сразу, не дожидаясь sweep
+    if info.has_access:
+        approve_if_waiting(user_id)
+
+async def sweep_join_requests() -> int:
+    """Задача лидера: одобряет ожидающие заявки оплативших (в т.ч. через другие воркеры)
+    и отклоняет те, что ждут дольше JOIN_PENDING_TTL."""
+    moment = datetime.now(UTC)
+    access_until = func.coalesce(Subscription.grace_until, Subscription.paid_until)
+    async with Session() as s:
+        paid = (await s.execute(
+            select(JoinRequest.user_id, JoinRequest.chat_id)
+            .join(Subscription, Subscription.user_id == JoinRequest.user_id)
+            .where(
+                JoinRequest.status == "pending",
+                Subscription.status.in_(ACTIVE_STATUSES),
+                access_until >= moment,
+            )
+        )).all()
+        stale = (await s.execute(
+            select(JoinRequest.user_id, JoinRequest.chat_id)
+            .where(
+                JoinRequest.status == "pending",
+                JoinRequest.created_at < moment - timedelta(hours=settings.JOIN_PENDING_TTL_HOURS),
+            )
+        )).all()
+    paid_ids = {row.user_id for row in paid}
+    count = 0
+    for row in paid:
+        _waiting.pop(row.user_id, None)
+        count += worker.submit(APPROVE, row.chat_id, row.user_id)
+    for row in stale:
+        if row.user_id not in paid_ids:
+            _waiting.pop(row.user_id, None)
+            count += worker.submit(DECLINE, row.chat_id, row.user_id)
+    return count
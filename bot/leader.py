@@ -0,0 +1,126 @@
+from __future__ import annotations
+import os
+import time
+import socket
+import asyncio
+import logging
+from contextlib import suppress
+from uuid import uuid4
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+from sqlalchemy import update, or_
+from bot.db import Session, Lease, dialect_insert
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+class LeaderLease:
+    """Аренда лидерства в таблице leases.
+
+    Лидер продлевает запись каждые renew секунд; если он пропал, через ttl её
+    забирает другой воркер. Фоновые задачи (планировщик, вебхук, дедлайны)
+    запускаются в on_elected и останавливаются в on_demoted. on_elected идут
+    отдельной задачей, чтобы долгий запуск не останавливал продление аренды.
+    """
+
+    def __init__(self, name: str, ttl: Optional[float] = None, renew: Optional[float] = None):
+        self.name = name
+        self.ttl = ttl or settings.LEADER_LEASE_TTL
+        self.renew = renew or settings.LEADER_RENEW_INTERVAL
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:6]}"
+        self.is_leader = False
+        self.on_elected: list[Callable[[], Awaitable[None]]] = []
+        self.on_demoted: list[Callable[[], Awaitable[None]]] = []
+        self._valid_until = 0.0  # time.monotonic(), до которого аренда точно наша
+        self._task: Optional[asyncio.Task] = None
+        self._duties: Optional[asyncio.Task] = None
+
+    def holds(self) -> bool:
+        """Лидер, и подтверждённая аренда ещё не истекла."""
+        return self.is_leader and time.monotonic() < self._valid_until
+
+    async def try_acquire(self) -> bool:
+        moment = datetime.now(UTC)
+        expires = moment + timedelta(seconds=self.ttl)
+        started = time.monotonic()
+        async with Session() as s:
+            res = await s.execute(
+                update(Lease)
+                .where(Lease.name == self.name, or_(Lease.holder == self.holder, Lease.expires_at < moment))
+                .values(holder=self.holder, expires_at=expires)
+            )
+            acquired = res.rowcount == 1
+            if not acquired:
+                res = await s.execute(
+                    dialect_insert(Lease)
+                    .values(name=self.name, holder=self.holder, expires_at=expires)
+                    .on_conflict_do_nothing(index_elements=[Lease.name])
+                )
+                acquired = res.rowcount == 1
+            await s.commit()
+        if acquired:
+            self._valid_until = started + self.ttl
+        return acquired
+
+    async def release(self) -> None:
+        async with Session() as s:
+            await s.execute(
+                update(Lease)
+                .where(Lease.name == self.name, Lease.holder == self.holder)
+                .values(expires_at=datetime.now(UTC))
+            )
+            await s.commit()
+
+    async def _notify(self, callbacks: list) -> None:
+        for cb in callbacks:
+            try:
+                await cb()
+            except Exception:
+                log.exception("Лидерство %s: ошибка в %s", self.name, getattr(cb, "__name__", cb))
+
+    async def _set_leader(self, value: bool) -> None:
+        if value == self.is_leader:
+            return
+        self.is_leader = value
+        log.info("Лидерство %s: %s (%s)", self.name, "получено" if value else "потеряно", self.holder)
+        if value:
+            self._duties = asyncio.create_task(self._notify(self.on_elected))
+            return
+        if self._duties is not None and not self._duties.done():
+            # Запуск обязанностей ещё идёт — обрываем, пока их не начал новый лидер
+            self._duties.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._duties
+        self._duties = None
+        await self._notify(self.on_demoted)
+
+    async def _run(self) -> None:
+        while True:
+            # Аренда успела истечь между продлениями: её мог взять и отдать другой
+            # воркер, поэтому обязанности перезапускаются как при новом избрании
+            lapsed = self.is_leader and not self.holds()
+            try:
+                acquired = await self.try_acquire()
+            except Exception:
+                log.exception("Лидерство %s: не удалось продлить аренду", self.name)
+                # Без связи с БД остаёмся лидером, пока не истекла уже подтверждённая аренда
+                acquired = self.holds()
+            if lapsed:
+                await self._set_leader(False)
+            await self._set_leader(acquired)
+            await asyncio.sleep(self.renew)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.is_leader:
+            await self._set_leader(False)
+            try:
+                await self.release()
+            except Exception:
+                log.warning("Лидерство %s: не удалось освободить аренду", self.name)
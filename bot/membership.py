@@ -0,0 +1,173 @@
+from __future__ import annotations
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from aiogram import Bot
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
+from sqlalchemy import select, or_, and_
+from bot.db import Session, Subscription
+from bot.cache import TTLCache, SingleFlight
+from bot.ratelimit import TokenBucket
+from bot.services import _sub_info
+from bot.state import get_state, set_state, MEMBERSHIP_CURSOR
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+# Администраторов канала сверка не трогает
+PRIVILEGED = {ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR}
+
+_cache: TTLCache[int, str] = TTLCache(maxsize=settings.MEMBERSHIP_CACHE_SIZE, ttl=settings.MEMBERSHIP_CACHE_TTL)
+_inflight: SingleFlight[int, str] = SingleFlight()
+
+async def _fetch_status(bot: Bot, user_id: int) -> str:
+    try:
+        member = await bot.get_chat_member(settings.CHANNEL_ID, user_id)
+    except TelegramBadRequest:
+        status = ChatMemberStatus.LEFT  # пользователь неизвестен каналу
+    else:
+        status = member.status
+        if status == ChatMemberStatus.RESTRICTED and not getattr(member, "is_member", False):
+            status = ChatMemberStatus.LEFT
+    _cache.set(user_id, status)
+    return status
+
+async def get_member_status(bot: Bot, user_id: int) -> str:
+    """Статус пользователя в канале: из кэша или один get_chat_member на все одновременные запросы."""
+    status = _cache.get(user_id)
+    if status is not None:
+        return status
+    return await _inflight.run(user_id, lambda: _fetch_status(bot, user_id))
+
+async def is_member_of_channel(bot: Bot, user_id: int) -> bool:
+    status = await get_member_status(bot, user_id)
+    return status in PRIVILEGED or status in {ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED}
+
+def forget_member(user_id: int) -> None:
+    _cache.pop(user_id)
+
+@dataclass
+class ReconcileStats:
+    checked: int = 0
+    swept: int = 0
+    removed: int = 0
+    unbanned: int = 0
+    errors: int = 0
+
+    @property
+    def affected(self) -> int:
+        return self.removed + self.unbanned
+
+class MembershipReconciler:
+    """Сверяет доступ по подписке с участием в канале.
+
+    Каждый проход сначала смотрит подписки, изменившиеся после прошлого (по индексу
+    updated_at), затем продолжает полный обход всех подписок по user_id — не больше
+    sweep_limit строк за раз, курсор хранится в app_state. Полный обход находит
+    старые хвосты и тех, кто вступил без изменения подписки. Истёкших удаляет из
+    канала (ban + unban, чтобы после оплаты можно было вступить снова), оплативших —
+    разбанивает.
+    """
+
+    def __init__(
+        self, bot: Bot, rate: Optional[float] = None, batch: Optional[int] = None, sweep_limit: Optional[int] = None,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate or settings.MEMBERSHIP_RATE)
+        self.batch = batch or settings.MEMBERSHIP_BATCH
+        self.sweep_limit = settings.MEMBERSHIP_SWEEP_LIMIT if sweep_limit is None else sweep_limit
+        self._mark: tuple[datetime, int] = (
+            datetime.now(UTC) - timedelta(hours=settings.MEMBERSHIP_LOOKBACK_HOURS), 0,
+        )
+
+    async def _call(self, method, *args, **kwargs):
+        while True:
+            await self.bucket.acquire()
+            try:
+                return await method(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+
+    async def _reconcile_one(self, sub: Subscription, stats: ReconcileStats) -> None:
+        user_id = sub.user_id
+        if user_id in settings.ADMIN_IDS:
+            return
+        has_access = _sub_info(sub).has_access
+        try:
+            await self.bucket.acquire()
+            status = await get_member_status(self.bot, user_id)
+            if status in PRIVILEGED:
+                return
+            if has_access and status == ChatMemberStatus.KICKED:
+                await self._call(self.bot.unban_chat_member, settings.CHANNEL_ID, user_id, only_if_banned=True)
+                _cache.set(user_id, ChatMemberStatus.LEFT)
+                stats.unbanned += 1
+            elif not has_access and status in {ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED}:
+                await self._call(self.bot.ban_chat_member, settings.CHANNEL_ID, user_id)
+                await self._call(self.bot.unban_chat_member, settings.CHANNEL_ID, user_id, only_if_banned=True)
+                _cache.set(user_id, ChatMemberStatus.LEFT)
+                stats.removed += 1
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            stats.errors += 1
+            log.warning("Сверка канала: пользователь %s: %s", user_id, e)
+
+    async def _changed(self, stats: ReconcileStats) -> None:
+        while True:
+            ts, uid = self._mark
+            async with Session() as s:
+                res = await s.execute(
+                    select(Subscription)
+                    .where(or_(
+                        Subscription.updated_at > ts,
+                        and_(Subscription.updated_at == ts, Subscription.user_id > uid),
+                    ))
+                    .order_by(Subscription.updated_at, Subscription.user_id)
+                    .limit(self.batch)
+                )
+                subs = list(res.scalars())
+            if not subs:
+                break
+            await asyncio.gather(*(self._reconcile_one(sub, stats) for sub in subs))
+            stats.checked += len(subs)
+            last = subs[-1]
+            self._mark = (last.updated_at, last.user_id)
+            if len(subs) < self.batch:
+                break
+
+    async def _sweep(self, stats: ReconcileStats) -> None:
+        cursor = int(await get_state(MEMBERSHIP_CURSOR) or 0)
+        left = self.sweep_limit
+        while left > 0:
+            limit = min(self.batch, left)
+            async with Session() as s:
+                res = await s.execute(
+                    select(Subscription).where(Subscription.user_id > cursor).order_by(Subscription.user_id).limit(limit)
+                )
+                subs = list(res.scalars())
+            await asyncio.gather(*(self._reconcile_one(sub, stats) for sub in subs))
+            stats.swept += len(subs)
+            left -= len(subs)
+            if len(subs) < limit:
+                cursor = 0  # обход завершён, следующий начнётся сначала
+                log.info("Сверка канала: полный обход подписок завершён")
+            else:
+                cursor = subs[-1].user_id
+            await set_state(MEMBERSHIP_CURSOR, str(cursor))
+            if cursor == 0:
+                break
+
+    async def run(self) -> ReconcileStats:
+        stats = ReconcileStats()
+        await self._changed(stats)
+        if self.sweep_limit > 0:
+            await self._sweep(stats)
+        if stats.checked or stats.swept:
+            log.info(
+                "Сверка канала: изменённых %d, обход %d, удалено %d, разбанено %d, ошибок %d",
+                stats.checked, stats.swept, stats.removed, stats.unbanned, stats.errors,
+            )
+        return stats
@@ -0,0 +1,238 @@
+from __future__ import annotations
+import time
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+# Простейшие метрики в текстовом формате Prometheus без внешних зависимостей.
+# Запись — несколько операций со словарём, поэтому их можно держать включёнными в проде.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        REGISTRY.append(self)
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> list[str]:
+        return self._header() + [
+            f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self._values.items()
+        ]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+        self._fn = fn
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+    def render(self) -> list[str]:
+        if self._fn is not None:
+            self._values[()] = self._fn()
+        return self._header() + [
+            f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self._values.items()
+        ]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for k, (counts, total) in self._values.items():
+            acc = 0
+            for bound, c in zip((*self.buckets, "+Inf"), counts):
+                acc += c
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, k)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, k)} {acc}")
+        return lines
+
+class StatementHistogram(_Metric):
+    """Гистограммы db.QueryStats по тексту SQL. Число запросов ограничено
+    QueryStats.max_statements, поэтому и число серий ограничено."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, source: Callable[[], list[dict]], max_len: int = 200):
+        super().__init__(name, help, ("statement",))
+        self._source = source
+        self.max_len = max_len
+
+    def render(self) -> list[str]:
+        # Запросы, совпавшие после сжатия пробелов и обрезки, сливаем в одну серию
+        merged: Dict[tuple, list] = {}
+        for entry in self._source():
+            key = (" ".join(entry["statement"].split())[: self.max_len],)
+            counts = list(entry["buckets"].values())
+            acc = merged.setdefault(key, [list(entry["buckets"]), [0] * len(counts), 0.0])
+            acc[1] = [a + b for a, b in zip(acc[1], counts)]
+            acc[2] += entry["total"]
+        lines = self._header()
+        for k, (bounds, counts, total) in merged.items():
+            acc = 0
+            for bound, c in zip(bounds, counts):
+                acc += c
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, k)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, k)} {acc}")
+        return lines
+
+REGISTRY: list[_Metric] = []
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+UPDATES = Counter("bot_updates_total", "Telegram updates processed", ["type"])
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Full update processing time", ["type"])
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler execution time", ["router", "handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler exceptions", ["router", "handler"])
+DB_QUERIES = Counter("db_queries_total", "SQL statements executed", ["op"])
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds", "SQL statement execution time", ["op"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+WFP_REQUESTS = Counter("wfp_requests_total", "WayForPay API requests", ["type", "outcome"])
+WFP_SECONDS = Histogram("wfp_request_seconds", "WayForPay API request time (with retries)", ["type"])
+JOB_RUNS = Counter("scheduler_job_runs_total", "Scheduled job runs", ["job", "outcome"])
+JOB_SECONDS = Histogram("scheduler_job_seconds", "Scheduled job duration", ["job"], buckets=(0.01, 0.1, 0.5, 1, 5, 15, 60, 300))
+JOB_ROWS = Gauge("scheduler_job_rows", "Rows affected by the last job run", ["job"])
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Duration of startup steps", ["phase", "step"])
+
+def observe_query(statement: str, elapsed: float) -> None:
+    op = statement.lstrip()[:8].split(None, 1)[0].upper() if statement else "?"
+    DB_QUERIES.inc(op)
+    DB_QUERY_SECONDS.observe(elapsed, op)
+
+def timed_job(name: str, fn: Callable[..., Awaitable[Any]], rows: Optional[Callable[[Any], int]] = None):
+    """Оборачивает задачу планировщика: длительность, исход и число затронутых строк."""
+    async def run(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception:
+            JOB_RUNS.inc(name, "error")
+            raise
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - t0, name)
+        JOB_RUNS.inc(name, "ok")
+        if rows is not None:
+            JOB_ROWS.set(rows(result), name)
+        return result
+    run.__name__ = f"timed_{name}"
+    return run
+
+class StartupTimer:
+    """Разбивка времени старта по шагам: в лог одной строкой и в метрику bot_startup_seconds."""
+
+    def __init__(self, phase: str, started: Optional[float] = None):
+        self.phase = phase
+        self.started = started if started is not None else time.perf_counter()
+        self.steps: list[tuple[str, float]] = []
+
+    def record(self, step: str, elapsed: float) -> None:
+        self.steps.append((step, elapsed))
+        STARTUP_SECONDS.set(elapsed, self.phase, step)
+
+    @contextmanager
+    def step(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def log(self, logger: logging.Logger) -> None:
+        total = time.perf_counter() - self.started
+        STARTUP_SECONDS.set(total, self.phase, "total")
+        parts = ", ".join(f"{name}={elapsed * 1000:.0f}ms" for name, elapsed in self.steps)
+        logger.info("%s: %.0f ms (%s)", self.phase, total * 1000, parts)
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: полное время обработки апдейта."""
+
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        kind = event.event_type if isinstance(event, Update) else type(event).__name__
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - t0, kind)
+            UPDATES.inc(kind)
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner-middleware: срабатывает только для найденного хендлера, метки — роутер и функция."""
+
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        router = data.get("event_router")
+        obj = data.get("handler")
+        labels = (
+            router.name if router is not None else "?",
+            getattr(getattr(obj, "callback", None), "__qualname__", "?"),
+        )
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(*labels)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, *labels)
+
+def setup_dispatcher(dp) -> None:
+    dp.update.outer_middleware(UpdateTimingMiddleware())
+    timing = HandlerTimingMiddleware()
+    for observer in dp.observers.values():
+        if observer.event_name != "update":
+            observer.middleware(timing)
@@ -0,0 +1,388 @@
+"""Потоковый экспорт/импорт таблиц и перенос SQLite -> Postgres.
+
+    python -m bot.migrate export --url sqlite+aiosqlite:///./bot.sqlite3 --dir dump
+    python -m bot.migrate import --url postgresql+asyncpg://... --dir dump [--copy]
+    python -m bot.migrate verify --url postgresql+asyncpg://... --dir dump
+
+Таблицы читаются keyset-пагинацией по первичному ключу пачками --batch строк,
+так что память не зависит от размера таблицы. Прогресс экспорта пишется в
+manifest.json, импорта — в таблицу migrate_progress целевой БД в той же
+транзакции, что и пачка: прерванный запуск продолжается с того же места. Контрольная сумма не зависит от порядка строк
+(сумма хэшей канонического JSON), поэтому verify сверяет её с любой БД.
+"""
+from __future__ import annotations
+import os
+import csv
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Iterator, Optional
+from sqlalchemy import (
+    Table, Column, MetaData, String, BigInteger, select, func, text, tuple_,
+    Date, DateTime, Integer, Float, Numeric, Boolean,
+)
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from bot.db import Base
+
+log = logging.getLogger("migrate")
+
+FORMATS = ("jsonl", "csv")
+MANIFEST = "manifest.json"
+CSV_NULL = "\\N"
+CHECKSUM_MOD = 2 ** 64
+
+# Прогресс импорта живёт в целевой БД, вне Base.metadata: не попадает ни в схему бота, ни в дамп
+progress_table = Table(
+    "migrate_progress", MetaData(),
+    Column("table_name", String, primary_key=True),
+    Column("rows", BigInteger, nullable=False),
+    Column("file_offset", BigInteger, nullable=False),
+    Column("done", Boolean, nullable=False),
+)
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def _decoder(column):
+    t = column.type
+    if isinstance(t, TypeDecorator):
+        t = t.impl_instance
+    if isinstance(t, DateTime):
+        return datetime.fromisoformat
+    if isinstance(t, Date):
+        return date.fromisoformat
+    if isinstance(t, Integer):
+        return int
+    if isinstance(t, (Float, Numeric)):
+        return float
+    if isinstance(t, Boolean):
+        return lambda v: v if isinstance(v, bool) else str(v).lower() in ("1", "true", "t")
+    return None
+
+def _row_hash(row: dict) -> int:
+    line = json.dumps(row, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return int.from_bytes(hashlib.sha1(line.encode()).digest()[:8], "big")
+
+def _save_json(path: str, data: dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+def _load_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _tables(names: Optional[list[str]]) -> list[Table]:
+    tables = list(Base.metadata.sorted_tables)  # родительские таблицы раньше дочерних
+    if names:
+        unknown = set(names) - {t.name for t in tables}
+        if unknown:
+            raise SystemExit(f"Unknown tables: {', '.join(sorted(unknown))}")
+        tables = [t for t in tables if t.name in names]
+    return tables
+
+def _key(table: Table, row: dict) -> list:
+    return [row[c.name] for c in table.primary_key.columns]
+
+def _after(table: Table, last_key: Optional[list]):
+    pk = list(table.primary_key.columns)
+    if last_key is None:
+        return None
+    values = [_decoder(c)(v) if _decoder(c) and v is not None else v for c, v in zip(pk, last_key)]
+    if len(pk) == 1:
+        return pk[0] > values[0]
+    return tuple_(*pk) > tuple_(*values)
+
+async def iter_rows(conn: AsyncConnection, table: Table, batch: int, last_key: Optional[list] = None) -> AsyncIterator[list[dict]]:
+    """Пачки строк таблицы в порядке первичного ключа, с места после last_key."""
+    pk = list(table.primary_key.columns)
+    while True:
+        query = select(table).order_by(*pk).limit(batch)
+        cond = _after(table, last_key)
+        if cond is not None:
+            query = query.where(cond)
+        rows = [{k: _encode(v) for k, v in r._mapping.items()} for r in (await conn.execute(query))]
+        if not rows:
+            return
+        yield rows
+        last_key = _key(table, rows[-1])
+        if len(rows) < batch:
+            return
+
+@dataclass
+class TableResult:
+    table: str
+    rows: int
+    seconds: float
+
+    @property
+    def rate(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+# ---------- export ----------
+
+def _writer(f, fmt: str, table: Table, write_header: bool):
+    columns = [c.name for c in table.columns]
+    if fmt == "jsonl":
+        def write(rows: list[dict]) -> None:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+        return write
+
+    class _Bytes:
+        def write(self, s: str) -> None:
+            f.write(s.encode())
+    w = csv.writer(_Bytes(), lineterminator="\n")
+    if write_header:
+        w.writerow(columns)
+
+    def write(rows: list[dict]) -> None:
+        for row in rows:
+            w.writerow([CSV_NULL if row[c] is None else row[c] for c in columns])
+    return write
+
+async def export_tables(engine: AsyncEngine, directory: str, fmt: str = "jsonl", batch: int = 1000,
+                        names: Optional[list[str]] = None) -> list[TableResult]:
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST)
+    manifest = _load_json(manifest_path)
+    if manifest and manifest.get("format") != fmt:
+        raise SystemExit(f"{directory} already holds a {manifest.get('format')} export")
+    manifest["format"] = fmt
+    manifest.setdefault("tables", {})
+    results = []
+    for table in _tables(names):
+        state = manifest["tables"].setdefault(table.name, {
+            "file": f"{table.name}.{fmt}", "rows": 0, "bytes": 0, "checksum": 0, "last_key": None, "done": False,
+        })
+        if state["done"]:
+            continue
+        path = os.path.join(directory, state["file"])
+        t0 = time.perf_counter()
+        exported = 0
+        with open(path, "ab") as f:
+            # Хвост после последнего сохранённого прогресса — от прерванной пачки
+            f.truncate(state["bytes"])
+            f.seek(state["bytes"])
+            write = _writer(f, fmt, table, write_header=state["bytes"] == 0)
+            async with engine.connect() as conn:
+                async for rows in iter_rows(conn, table, batch, state["last_key"]):
+                    write(rows)
+                    f.flush()
+                    state["rows"] += len(rows)
+                    state["checksum"] = (state["checksum"] + sum(map(_row_hash, rows))) % CHECKSUM_MOD
+                    state["last_key"] = _key(table, rows[-1])
+                    state["bytes"] = f.tell()
+                    exported += len(rows)
+                    _save_json(manifest_path, manifest)
+        state["done"] = True
+        _save_json(manifest_path, manifest)
+        results.append(TableResult(table.name, exported, time.perf_counter() - t0))
+        log.info("export %s: %d rows", table.name, state["rows"])
+    return results
+
+# ---------- import ----------
+
+def _read_batches(path: str, fmt: str, table: Table, offset: int, batch: int) -> Iterator[tuple[list[dict], int]]:
+    """Пачки строк файла начиная с offset и смещение конца каждой пачки."""
+    columns = [c.name for c in table.columns]
+    decoders = {c.name: _decoder(c) for c in table.columns}
+
+    def decode(row: dict) -> dict:
+        out = {}
+        for k, v in row.items():
+            dec = decoders.get(k)
+            out[k] = dec(v) if dec and v is not None else v
+        return out
+
+    with open(path, "rb") as f:
+        pos = [0]
+
+        def lines():
+            for raw in iter(f.readline, b""):
+                pos[0] += len(raw)
+                yield raw.decode()
+
+        if fmt == "csv":
+            header = next(csv.reader([f.readline().decode()]))
+            if header != columns:
+                raise SystemExit(f"{path}: columns {header} do not match table {table.name}")
+            if offset == 0:
+                offset = f.tell()
+            f.seek(offset)
+            pos[0] = offset
+            records = ({k: (None if v == CSV_NULL else v) for k, v in zip(columns, values)} for values in csv.reader(lines()))
+        else:
+            f.seek(offset)
+            pos[0] = offset
+            records = (json.loads(line) for line in lines() if line.strip())
+        rows: list[dict] = []
+        for record in records:
+            rows.append(decode(record))
+            if len(rows) >= batch:
+                yield rows, pos[0]
+                rows = []
+        if rows:
+            yield rows, pos[0]
+
+def _insert(conn: AsyncConnection, table: Table):
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+async def _write_batch(conn: AsyncConnection, table: Table, rows: list[dict], copy: bool) -> None:
+    if copy and conn.dialect.name == "postgresql" and conn.dialect.driver == "asyncpg":
+        raw = await conn.get_raw_connection()
+        columns = [c.name for c in table.columns]
+        await raw.driver_connection.copy_records_to_table(
+            table.name, records=[tuple(r.get(c) for c in columns) for r in rows], columns=columns,
+        )
+        return
+    # ON CONFLICT — на случай строк, уже бывших в целевой БД до импорта. executemany с одним скомпилированным
+    # INSERT: SQLAlchemy сам склеивает его в многострочные VALUES (insertmanyvalues)
+    await conn.execute(_insert(conn, table).on_conflict_do_nothing(), rows)
+
+async def _save_progress(conn: AsyncConnection, table: Table, state: dict) -> None:
+    values = {"rows": state["rows"], "file_offset": state["offset"], "done": state["done"]}
+    await conn.execute(
+        _insert(conn, progress_table)
+        .values(table_name=table.name, **values)
+        .on_conflict_do_update(index_elements=["table_name"], set_=values)
+    )
+
+async def _load_progress(conn: AsyncConnection) -> dict[str, dict]:
+    res = await conn.execute(select(progress_table))
+    return {r.table_name: {"rows": r.rows, "offset": r.file_offset, "done": r.done} for r in res}
+
+async def _reset_sequences(conn: AsyncConnection, table: Table) -> None:
+    if conn.dialect.name != "postgresql":
+        return
+    for column in table.primary_key.columns:
+        if not isinstance(column.type, Integer):
+            continue
+        await conn.execute(text(
+            f"SELECT setval(seq, GREATEST(COALESCE(MAX({column.name}), 1), 1), MAX({column.name}) IS NOT NULL) "
+            f"FROM {table.name}, (SELECT pg_get_serial_sequence(:t, :c) AS seq) s WHERE seq IS NOT NULL GROUP BY seq"
+        ), {"t": table.name, "c": column.name})
+
+async def import_tables(engine: AsyncEngine, directory: str, batch: int = 1000, copy: bool = False,
+                        names: Optional[list[str]] = None) -> list[TableResult]:
+    manifest = _load_json(os.path.join(directory, MANIFEST))
+    if not manifest:
+        raise SystemExit(f"{directory}: no {MANIFEST}")
+    fmt = manifest["format"]
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(progress_table.create, checkfirst=True)
+        progress = await _load_progress(conn)
+    results = []
+    for table in _tables(names):
+        exported = manifest["tables"].get(table.name)
+        if not exported:
+            continue
+        if not exported["done"]:
+            raise SystemExit(f"{table.name}: export is incomplete, re-run export first")
+        state = progress.setdefault(table.name, {"rows": 0, "offset": 0, "done": False})
+        if state["done"]:
+            continue
+        t0 = time.perf_counter()
+        imported = 0
+        path = os.path.join(directory, exported["file"])
+        for rows, offset in _read_batches(path, fmt, table, state["offset"], batch):
+            # Пачка и её прогресс в одной транзакции целевой БД: после сбоя продолжим
+            # ровно со следующей, поэтому и COPY (без ON CONFLICT) не получит дублей
+            new_state = {"rows": state["rows"] + len(rows), "offset": offset, "done": False}
+            async with engine.begin() as conn:
+                await _write_batch(conn, table, rows, copy)
+                await _save_progress(conn, table, new_state)
+            state.update(new_state)
+            imported += len(rows)
+        state["done"] = True
+        async with engine.begin() as conn:
+            await _reset_sequences(conn, table)
+            await _save_progress(conn, table, state)
+        results.append(TableResult(table.name, imported, time.perf_counter() - t0))
+        log.info("import %s: %d rows", table.name, state["rows"])
+    return results
+
+# ---------- verify ----------
+
+async def table_checksum(conn: AsyncConnection, table: Table, batch: int = 1000) -> tuple[int, int]:
+    rows = checksum = 0
+    async for chunk in iter_rows(conn, table, batch):
+        rows += len(chunk)
+        checksum = (checksum + sum(map(_row_hash, chunk))) % CHECKSUM_MOD
+    return rows, checksum
+
+async def verify_tables(engine: AsyncEngine, directory: str, batch: int = 1000,
+                        names: Optional[list[str]] = None) -> list[str]:
+    """Сверяет число строк и контрольные суммы БД с manifest.json; возвращает расхождения."""
+    manifest = _load_json(os.path.join(directory, MANIFEST))
+    problems = []
+    async with engine.connect() as conn:
+        for table in _tables(names):
+            expected = manifest.get("tables", {}).get(table.name)
+            if not expected:
+                continue
+            count = (await conn.execute(select(func.count()).select_from(table))).scalar()
+            rows, checksum = await table_checksum(conn, table, batch)
+            ok = count == expected["rows"] and rows == expected["rows"] and checksum == expected["checksum"]
+            log.info("verify %s: %d/%d rows, checksum %s", table.name, rows, expected["rows"], "ok" if ok else "MISMATCH")
+            if not ok:
+                problems.append(table.name)
+    return problems
+
+# ---------- CLI ----------
+
+def _report(results: list[TableResult]) -> None:
+    for r in results:
+        print(f"{r.table:<24} {r.rows:>10} rows {r.seconds:>8.2f}s {r.rate:>10.0f} rows/s")
+
+async def main(argv: Optional[list[str]] = None) -> int:
+    p = argparse.ArgumentParser(prog="python -m bot.migrate", description=__doc__.split("\n")[0])
+    p.add_argument("command", choices=["export", "import", "verify"])
+    p.add_argument("--url", default=None, help="database URL (default: DATABASE_URL)")
+    p.add_argument("--dir", required=True, help="dump directory")
+    p.add_argument("--format", choices=FORMATS, default="jsonl", help="export format")
+    p.add_argument("--batch", type=int, default=1000, help="rows per batch")
+    p.add_argument("--tables", nargs="*", help="only these tables")
+    p.add_argument("--copy", action="store_true", help="import with COPY (Postgres + asyncpg)")
+    args = p.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    url = args.url
+    if url is None:
+        from bot.config import settings
+        url = settings.DATABASE_URL
+    engine = create_async_engine(url)
+    try:
+        if args.command == "export":
+            _report(await export_tables(engine, args.dir, args.format, args.batch, args.tables))
+        elif args.command == "import":
+            _report(await import_tables(engine, args.dir, args.batch, args.copy, args.tables))
+            args.command = "verify"
+        if args.command == "verify":
+            problems = await verify_tables(engine, args.dir, args.batch, args.tables)
+            if problems:
+                print("verify FAILED: " + ", ".join(problems))
+                return 1
+            print("verify ok")
+    finally:
+        await engine.dispose()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
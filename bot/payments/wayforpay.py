@@ -1,17 +1,45 @@
 from __future__ import annotations
+import json
 import time
 import uuid
 import hmac
+import random
+import asyncio
 import hashlib
 import logging
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from urllib.parse import parse_qs
 import httpx
 from bot.config import settings
+from bot import metrics
 
 log = logging.getLogger("bot.payments")
 WFP_API = "https://api.wayforpay.com/api"
 
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Ошибки, при которых запрос точно не дошёл до WayForPay — повторять безопасно всегда
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+def _is_outage(e: httpx.HTTPError) -> bool:
+    # Брейкер считает только недоступность: сеть, 5xx и 429
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return True
+
+class WayForPayError(RuntimeError):
+    pass
+
+class CircuitOpenError(WayForPayError):
+    pass
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
 def money2(x: float | int | str) -> str:
     return str(Decimal(str(x)).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP))
 
@@ -67,13 +95,251 @@ def validate_wfp_signature(data: Dict[str, Any]) -> bool:
         log.exception("Error verifying callback signature: %s", data)
         return False
 
-async def create_invoice(
+# Поля подписи callback serviceUrl и ответа на него (документация WayForPay)
+CALLBACK_SIGNATURE_FIELDS = (
+    "merchantAccount", "orderReference", "amount", "currency",
+    "authCode", "cardPan", "transactionStatus", "reasonCode",
+)
+
+# Ключ HMAC подготавливается один раз; на каждый callback — только copy() и update()
+_callback_mac = hmac.new(settings.WFP_SECRET.strip().encode("utf-8"), digestmod=hashlib.md5)
+
+def _sign(message: str) -> str:
+    mac = _callback_mac.copy()
+    mac.update(message.encode("utf-8"))
+    return mac.hexdigest()
+
+def parse_callback(body: bytes) -> Dict[str, Any]:
+    """WayForPay шлёт JSON в теле, иногда как form-urlencoded с JSON в единственном ключе.
+    Дробные числа оставляем строками, чтобы подпись сверялась с исходным текстом суммы."""
+    try:
+        data = json.loads(body, parse_float=str)
+    except ValueError:
+        form = parse_qs(body.decode("utf-8", "replace"), keep_blank_values=True)
+        if len(form) != 1:
+            return {}
+        try:
+            data = json.loads(next(iter(form)), parse_float=str)
+        except ValueError:
+            return {}
+    return data if isinstance(data, dict) else {}
+
+def verify_callback_signature(data: Dict[str, Any]) -> bool:
+    signature = data.get("merchantSignature")
+    if not isinstance(signature, str):
+        return False
+    base = ";".join("" if data.get(k) is None else str(data.get(k)) for k in CALLBACK_SIGNATURE_FIELDS)
+    return hmac.compare_digest(_sign(base), signature)
+
+def build_check_status_payload(order_ref: str) -> Dict[str, Any]:
+    merchant = settings.WFP_MERCHANT.strip()
+    return {
+        "transactionType": "CHECK_STATUS",
+        "merchantAccount": merchant,
+        "orderReference": order_ref,
+        "merchantSignature": _sign(f"{merchant};{order_ref}"),
+        "apiVersion": 1,
+    }
+
+def callback_response(order_ref: str, status: str = "accept") -> Dict[str, Any]:
+    t = int(time.time())
+    return {"orderReference": order_ref, "status": status, "time": t, "signature": _sign(f"{order_ref};{status};{t}")}
+
+class CircuitBreaker:
+    """Размыкается после threshold подряд неудачных вызовов и пропускает
+    один пробный запрос не раньше чем через reset_after секунд."""
+
+    def __init__(self, threshold: int, reset_after: float):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        # Пробный запрос завершился без success/failure (отмена, неожиданное
+        # исключение) — разрешаем следующую пробу
+        self._probing = False
+
+class WayForPayClient:
+    """Долгоживущий клиент API WayForPay: пул keep-alive соединений (HTTP/2, если
+    установлен h2), ограничение параллельных запросов, повторы с джиттером
+    и circuit breaker. transport позволяет подменить сеть в тестах."""
+
+    def __init__(
+        self,
+        api_url: str | None = None,
+        *,
+        timeout: float | None = None,
+        connect_timeout: float | None = None,
+        max_connections: int | None = None,
+        concurrency: int | None = None,
+        retries: int | None = None,
+        backoff: float = 0.3,
+        breaker: CircuitBreaker | None = None,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.api_url = api_url or settings.WFP_API_URL
+        self.retries = settings.WFP_RETRIES if retries is None else retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker(settings.WFP_BREAKER_THRESHOLD, settings.WFP_BREAKER_RESET)
+        self._sem = asyncio.Semaphore(concurrency or settings.WFP_CONCURRENCY)
+        max_connections = max_connections or settings.WFP_MAX_CONNECTIONS
+        self._http = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                timeout or settings.WFP_TIMEOUT,
+                connect=connect_timeout or settings.WFP_CONNECT_TIMEOUT,
+            ),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60,
+            ),
+            http2=transport is None and _http2_available(),
+            transport=transport,
+        )
+
+    async def __aenter__(self) -> "WayForPayClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    def _delay(self, attempt: int) -> float:
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    async def request(self, payload: Dict[str, Any], idempotent: bool = False) -> Dict[str, Any]:
+        """POST в API. Таймаут чтения повторяется только для идемпотентных запросов
+        (CHECK_STATUS): иначе можно создать счёт дважды."""
+        kind = str(payload.get("transactionType", "?"))
+        probe = self.breaker.state == "half-open"
+        if not self.breaker.allow():
+            metrics.WFP_REQUESTS.inc(kind, "circuit_open")
+            raise CircuitOpenError("WayForPay API temporarily unavailable (circuit open)")
+        t0 = time.perf_counter()
+        try:
+            data = await self._request(payload, idempotent)
+        except WayForPayError:
+            metrics.WFP_REQUESTS.inc(kind, "error")
+            raise
+        finally:
+            if probe:
+                self.breaker.release()
+            metrics.WFP_SECONDS.observe(time.perf_counter() - t0, kind)
+        metrics.WFP_REQUESTS.inc(kind, "ok")
+        return data
+
+    async def _request(self, payload: Dict[str, Any], idempotent: bool) -> Dict[str, Any]:
+        attempt = 0
+        while True:
+            try:
+                async with self._sem:
+                    r = await self._http.post(self.api_url, json=payload)
+                if r.status_code in RETRY_STATUSES:
+                    raise httpx.HTTPStatusError(f"WayForPay HTTP {r.status_code}", request=r.request, response=r)
+                r.raise_for_status()
+                # Дробные числа строками, как в parse_callback: подпись считается по тексту суммы
+                data = json.loads(r.content, parse_float=str)
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                retryable = (
+                    isinstance(e, _NOT_SENT_ERRORS)
+                    or (isinstance(e, httpx.HTTPStatusError) and e.response.status_code in RETRY_STATUSES)
+                    or (idempotent and isinstance(e, httpx.TransportError))
+                )
+                if retryable and attempt < self.retries:
+                    delay = self._delay(attempt)
+                    attempt += 1
+                    log.warning("WayForPay request failed (%s), retry %d in %.2fs", e, attempt, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                if _is_outage(e):
+                    self.breaker.failure()
+                else:
+                    # 4xx — сервис ответил, ошибка в запросе: брейкер не размыкаем
+                    self.breaker.success()
+                raise WayForPayError(f"WayForPay request failed: {e}") from e
+            except ValueError as e:
+                self.breaker.failure()
+                raise WayForPayError(f"WayForPay returned invalid JSON: {e}") from e
+            self.breaker.success()
+            return data
+
+    async def create_invoice(
+        self,
+        user_id: int,
+        amount: float,
+        currency: str = "UAH",
+        product_name: str = "Access to course (1 month)",
+        start_token: str | None = None,
+        order_timeout: int | None = None,
+    ) -> tuple[str, str]:
+        payload = build_invoice_payload(user_id, amount, currency, product_name, start_token, order_timeout)
+        log.warning("📤 WFP payload ready: %s", {k: v for k, v in payload.items() if k != "merchantSignature"})
+        data = await self.request(payload)
+        url = data.get("invoiceUrl") or data.get("formUrl") or data.get("url")
+        if not url:
+            raise WayForPayError(f"WayForPay error: {data.get('reasonCode')} — {data.get('reason')}")
+        return url, payload["orderReference"]
+
+    async def check_status(self, order_ref: str) -> Dict[str, Any]:
+        """CHECK_STATUS по orderReference. Ответ подписан так же, как callback;
+        по нему выдаётся доступ, поэтому без подписи, с неверной подписью или
+        с чужим orderReference — WayForPayError."""
+        data = await self.request(build_check_status_payload(order_ref), idempotent=True)
+        if not verify_callback_signature(data):
+            raise WayForPayError(f"WayForPay CHECK_STATUS {order_ref}: missing or invalid signature")
+        if data.get("orderReference") != order_ref:
+            raise WayForPayError(f"WayForPay CHECK_STATUS {order_ref}: response for {data.get('orderReference')}")
+        return data
+
+_client: Optional[WayForPayClient] = None
+
+def set_client(client: Optional[WayForPayClient]) -> None:
+    global _client
+    _client = client
+
+def get_client() -> Optional[WayForPayClient]:
+    return _client
+
+def build_invoice_payload(
     user_id: int,
     amount: float,
     currency: str = "UAH",
     product_name: str = "Access to course (1 month)",
     start_token: str | None = None,
-) -> tuple[str, str]:
+    order_timeout: int | None = None,
+) -> Dict[str, Any]:
     order_date = int(time.time())
     order_ref = f"sub-{user_id}-{order_date}-{uuid.uuid4().hex[:6]}"
     merchant = settings.WFP_MERCHANT.strip()
@@ -108,15 +374,22 @@ async def create_invoice(
         "serviceUrl": service_url,
         "merchantSignature": signature,
     }
+    if order_timeout:
+        payload["orderTimeout"] = order_timeout
+    return payload
 
-    log.warning("📤 WFP payload ready: %s", {k: v for k, v in payload.items() if k != "merchantSignature"})
-
-    async with httpx.AsyncClient(timeout=25) as cli:
-        r = await cli.post(WFP_API, json=payload)
-        r.raise_for_status()
-        data = r.json()
-
-    url = data.get("invoiceUrl") or data.get("formUrl") or data.get("url")
-    if not url:
-        raise RuntimeError(f"WayForPay error: {data.get('reasonCode')} — {data.get('reason')}")
-    return url, order_ref
+async def create_invoice(
+    user_id: int,
+    amount: float,
+    currency: str = "UAH",
+    product_name: str = "Access to course (1 month)",
+    start_token: str | None = None,
+    client: WayForPayClient | None = None,
+    order_timeout: int | None = None,
+) -> tuple[str, str]:
+    client = client or _client
+    if client is None:
+        # Вне приложения (скрипты) — разовый клиент
+        async with WayForPayClient() as cli:
+            return await cli.create_invoice(user_id, amount, currency, product_name, start_token, order_timeout)
+    return await client.create_invoice(user_id, amount, currency, product_name, start_token, order_timeout)
@@ -0,0 +1,53 @@
+from __future__ import annotations
+import time
+import asyncio
+from typing import Optional
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас.
+
+    try_acquire() — неблокирующая проверка, acquire() — ждёт токен.
+    pause() останавливает выдачу всем ожидающим (например, после RetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self, moment: float) -> None:
+        if moment > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (moment - self.updated) * self.rate)
+            self.updated = moment
+
+    def delay(self, n: float = 1) -> float:
+        """Через сколько секунд будет доступно n токенов (без списания)."""
+        moment = time.monotonic()
+        self._refill(moment)
+        wait = max(0.0, self.blocked_until - moment)
+        if self.tokens < n:
+            wait = max(wait, (n - self.tokens) / self.rate)
+        return wait
+
+    def try_acquire(self, n: float = 1) -> bool:
+        if self.delay(n) > 0:
+            return False
+        self.tokens -= n
+        return True
+
+    async def acquire(self, n: float = 1) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                wait = self.delay(n)
+                if wait <= 0:
+                    self.tokens -= n
+                    return
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
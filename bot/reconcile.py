@@ -0,0 +1,114 @@
+from __future__ import annotations
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from aiogram import Bot
+from sqlalchemy import select, and_, or_
+from bot.db import Session, Payment
+from bot.billing import apply_payment_status, after_commit, notify_payment, PaymentTransition
+from bot.payments.wayforpay import WayForPayClient, WayForPayError, get_client
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+@dataclass
+class ReconcileStats:
+    checked: int = 0
+    changed: int = 0
+    paid: int = 0
+    errors: int = 0
+    batches: int = 0
+    duration: float = 0.0
+    started_at: datetime = field(default_factory=lambda: datetime.now(UTC))
+
+    @property
+    def affected(self) -> int:
+        return self.changed
+
+async def _pending_batch(since: datetime, until: datetime, after: Optional[tuple], limit: int) -> list:
+    # Диапазон по индексу (status, created_at), keyset по (created_at, id)
+    query = (
+        select(Payment.id, Payment.order_ref, Payment.created_at)
+        .where(Payment.status == "pending", Payment.created_at >= since, Payment.created_at < until)
+        .order_by(Payment.created_at, Payment.id)
+        .limit(limit)
+    )
+    if after is not None:
+        created_at, payment_id = after
+        query = query.where(or_(
+            Payment.created_at > created_at,
+            and_(Payment.created_at == created_at, Payment.id > payment_id),
+        ))
+    async with Session() as s:
+        return (await s.execute(query)).all()
+
+async def _check(client: WayForPayClient, sem: asyncio.Semaphore, order_ref: str) -> Optional[str]:
+    async with sem:
+        try:
+            data = await client.check_status(order_ref)
+        except WayForPayError as e:
+            log.warning("CHECK_STATUS %s: %s", order_ref, e)
+            return None
+    return data.get("transactionStatus")
+
+async def reconcile_payments(
+    bot: Optional[Bot] = None,
+    client: Optional[WayForPayClient] = None,
+    moment: Optional[datetime] = None,
+    batch_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+) -> ReconcileStats:
+    """Сверяет зависшие pending-платежи с WayForPay CHECK_STATUS.
+
+    Статусы пачки запрашиваются параллельно (не больше concurrency), переходы
+    применяются billing.apply_payment_status в одной транзакции на пачку.
+    """
+    client = client or get_client()
+    if client is None:
+        raise RuntimeError("WayForPay client is not configured")
+    moment = moment or datetime.now(UTC)
+    batch_size = batch_size or settings.PAYMENT_RECONCILE_BATCH
+    sem = asyncio.Semaphore(concurrency or settings.PAYMENT_RECONCILE_CONCURRENCY)
+    since = moment - timedelta(hours=settings.PAYMENT_RECONCILE_LOOKBACK_HOURS)
+    until = moment - timedelta(seconds=settings.PAYMENT_RECONCILE_MIN_AGE)
+    stats = ReconcileStats(started_at=moment)
+    t0 = time.perf_counter()
+    after = None
+    while True:
+        rows = await _pending_batch(since, until, after, batch_size)
+        if not rows:
+            break
+        after = (rows[-1].created_at, rows[-1].id)
+        statuses = await asyncio.gather(*(_check(client, sem, row.order_ref) for row in rows))
+        stats.checked += len(rows)
+        stats.errors += sum(1 for st in statuses if st is None)
+        transitions: list[PaymentTransition] = []
+        async with Session() as s:
+            for row, wfp_status in zip(rows, statuses):
+                if not wfp_status:
+                    continue
+                transition = await apply_payment_status(s, row.order_ref, wfp_status, moment)
+                if transition:
+                    transitions.append(transition)
+            await s.commit()
+        after_commit(transitions)
+        stats.batches += 1
+        stats.changed += len(transitions)
+        for t in transitions:
+            log.info("Сверка платежей: %s %s -> %s", t.order_ref, t.old, t.new)
+            if t.new == "paid":
+                stats.paid += 1
+                if bot is not None:
+                    await notify_payment(bot, t)
+        if len(rows) < batch_size:
+            break
+    stats.duration = time.perf_counter() - t0
+    log.info(
+        "Сверка платежей: проверено %d, изменено %d (оплачено %d), ошибок %d за %.3fs",
+        stats.checked, stats.changed, stats.paid, stats.errors, stats.duration,
+    )
+    return stats
@@ -0,0 +1,139 @@
+from __future__ import annotations
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import select, delete, and_, or_, text, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+from bot.db import engine, Session, Payment, PaymentToken, PaymentArchive, PaymentTokenArchive, UTCDateTime, dialect_insert
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+SETTLED_PAYMENTS = ("paid", "declined", "expired", "refunded")
+
+@dataclass
+class RetentionStats:
+    payments: int = 0
+    tokens: int = 0
+    batches: int = 0
+    vacuumed: bool = False
+    duration: float = 0.0
+    started_at: datetime = field(default_factory=lambda: datetime.now(UTC))
+
+    @property
+    def affected(self) -> int:
+        return self.payments + self.tokens
+
+def _payments_due(moment: datetime):
+    # Оба условия идут по индексу (status, created_at)
+    return or_(
+        and_(
+            Payment.status.in_(SETTLED_PAYMENTS),
+            Payment.created_at < moment - timedelta(days=settings.PAYMENT_RETENTION_DAYS),
+        ),
+        and_(
+            Payment.status == "pending",
+            Payment.created_at < moment - timedelta(days=settings.PENDING_PAYMENT_RETENTION_DAYS),
+        ),
+    )
+
+def _tokens_due(moment: datetime):
+    # Использованные и так и не погашенные токены хранятся одинаково долго
+    return PaymentToken.created_at < moment - timedelta(days=settings.TOKEN_RETENTION_DAYS)
+
+async def _move_batch(model, archive, key: str, condition, moment: datetime, limit: int, after: int) -> tuple[int, int, int]:
+    # Одна короткая транзакция на пачку. id горячих таблиц SQLite выдаёт повторно
+    # (INTEGER PRIMARY KEY без AUTOINCREMENT), поэтому у архива свой id, строки
+    # сопоставляются по уникальному ключу, а удаляются только реально перенесённые.
+    columns = [c.name for c in model.__table__.columns if c.name != "id"]
+    key_col = model.__table__.c[key]
+    async with Session() as s:
+        res = await s.execute(
+            select(model.id).where(condition, key_col.isnot(None), model.id > after).order_by(model.id).limit(limit)
+        )
+        ids = list(res.scalars())
+        if not ids:
+            return after, 0, 0
+        archived_at = literal(moment, UTCDateTime()).label("archived_at")
+        source = select(*(model.__table__.c[name] for name in columns), archived_at).where(model.id.in_(ids))
+        res = await s.execute(
+            dialect_insert(archive.__table__)
+            .from_select([*columns, "archived_at"], source)
+            .on_conflict_do_nothing(index_elements=[key])
+            .returning(archive.__table__.c[key])
+        )
+        moved = list(res.scalars())
+        if len(moved) < len(ids):
+            log.warning("Архивация %s: %d строк уже в архиве, оставлены в таблице", model.__tablename__, len(ids) - len(moved))
+        if moved:
+            await s.execute(
+                delete(model)
+                .where(model.id.in_(ids), key_col.in_(moved))
+                .execution_options(synchronize_session=False)
+            )
+        await s.commit()
+        return ids[-1], len(ids), len(moved)
+
+async def _incremental_vacuum() -> bool:
+    # Свободные страницы отдаются ОС только при auto_vacuum=INCREMENTAL;
+    # переключение режима требует полного VACUUM, его задача сама не делает.
+    if engine.dialect.name != "sqlite":
+        return False
+    async with engine.connect() as conn:
+        mode = (await conn.execute(text("PRAGMA auto_vacuum"))).scalar()
+        if mode != 2:
+            log.info("Архивация: auto_vacuum=%s, incremental_vacuum пропущен", mode)
+            return False
+        pages = int(settings.RETENTION_VACUUM_PAGES)
+        await conn.execute(text(f"PRAGMA incremental_vacuum({pages})" if pages > 0 else "PRAGMA incremental_vacuum"))
+        await conn.commit()
+    return True
+
+async def compact(moment: Optional[datetime] = None, batch_size: Optional[int] = None) -> RetentionStats:
+    """Переносит старые платежи и токены в архивные таблицы пачками, затем incremental VACUUM."""
+    moment = moment or datetime.now(UTC)
+    batch_size = batch_size or settings.RETENTION_BATCH
+    stats = RetentionStats(started_at=moment)
+    t0 = time.perf_counter()
+    for model, archive, key, condition, attr in (
+        (Payment, PaymentArchive, "order_ref", _payments_due(moment), "payments"),
+        (PaymentToken, PaymentTokenArchive, "token", _tokens_due(moment), "tokens"),
+    ):
+        # Keyset по id: строки, оставшиеся из-за конфликта, не выбираются повторно
+        after = 0
+        while True:
+            after, selected, moved = await _move_batch(model, archive, key, condition, moment, batch_size, after)
+            if not selected:
+                break
+            stats.batches += 1
+            setattr(stats, attr, getattr(stats, attr) + moved)
+            if selected < batch_size:
+                break
+            await asyncio.sleep(settings.RETENTION_PAUSE)
+    if stats.affected:
+        stats.vacuumed = await _incremental_vacuum()
+    stats.duration = time.perf_counter() - t0
+    log.info(
+        "Архивация: платежей %d, токенов %d, пачек %d за %.3fs",
+        stats.payments, stats.tokens, stats.batches, stats.duration,
+    )
+    return stats
+
+async def restore_payment(s: AsyncSession, order_ref: str) -> bool:
+    """Возвращает платёж из архива в горячую таблицу (поздний колбэк по архивному счёту).
+
+    Старый id не переносится: SQLite мог уже выдать его новому платежу.
+    """
+    columns = [c.name for c in Payment.__table__.columns if c.name != "id"]
+    source = select(*(PaymentArchive.__table__.c[name] for name in columns)).where(PaymentArchive.order_ref == order_ref)
+    res = await s.execute(
+        dialect_insert(Payment.__table__).from_select(columns, source).on_conflict_do_nothing(index_elements=["order_ref"])
+    )
+    if res.rowcount != 1:
+        return False
+    await s.execute(delete(PaymentArchive).where(PaymentArchive.order_ref == order_ref))
+    return True
@@ -1,11 +1,17 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from datetime import datetime, timezone, date
+from datetime import datetime, timezone, timedelta, date
 from typing import Optional
+import asyncio
 import logging
-from sqlalchemy import select, update
+from sqlalchemy import select, update, and_, or_
 from aiogram import Bot
-from bot.db import Session, User, Subscription
+from bot.db import Session, Subscription, Payment, PaymentToken
+from bot.users import registry
+from bot.expiry import ExpiryStats, iter_expirations
+from bot.cache import TTLCache
+from bot import stats
+from bot.config import settings
 
 log = logging.getLogger(__name__)
 UTC = timezone.utc
@@ -15,18 +21,98 @@ now = lambda: datetime.now(UTC)
 class SubInfo:
     status: str
     paid_until: Optional[datetime]
+    grace_until: Optional[datetime] = None
+
+    @property
+    def has_access(self) -> bool:
+        if self.status not in {"active", "grace"} or not self.paid_until:
+            return False
+        return now() <= (self.grace_until or self.paid_until)
+
+_sub_cache: TTLCache[int, SubInfo] = TTLCache(maxsize=settings.SUB_CACHE_SIZE, ttl=settings.SUB_CACHE_TTL)
+# Счётчик инвалидаций: чтение из БД, во время которого подписку поменяли,
+# не должно положить в кэш устаревшее значение.
+_sub_cache_epoch = 0
+
+def invalidate_subscription(user_id: int) -> None:
+    global _sub_cache_epoch
+    _sub_cache_epoch += 1
+    _sub_cache.pop(user_id)
+
+class SubscriptionCacheSync:
+    """Сбрасывает из локального кэша подписки, изменённые другими воркерами.
+
+    Каждый воркер раз в interval секунд читает user_id подписок с updated_at новее
+    метки (индекс ix_subscriptions_updated_at) — как deadlines.sync у лидера.
+    Без этого оплата, принятая в одном воркере, видна в другом только через SUB_CACHE_TTL.
+    """
+
+    def __init__(self, interval: float, batch: int = 1000):
+        self.interval = interval
+        self.batch = batch
+        self._mark: Optional[tuple[datetime, int]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def sync(self) -> int:
+        if self._mark is None:
+            # Записи кэша старше TTL и так уже истекли
+            self._mark = (now() - timedelta(seconds=settings.SUB_CACHE_TTL), 0)
+        count = 0
+        while True:
+            ts, uid = self._mark
+            async with Session() as s:
+                rows = (await s.execute(
+                    select(Subscription.user_id, Subscription.updated_at)
+                    .where(or_(
+                        Subscription.updated_at > ts,
+                        and_(Subscription.updated_at == ts, Subscription.user_id > uid),
+                    ))
+                    .order_by(Subscription.updated_at, Subscription.user_id)
+                    .limit(self.batch)
+                )).all()
+            for row in rows:
+                invalidate_subscription(row.user_id)
+            count += len(rows)
+            if rows:
+                self._mark = (rows[-1].updated_at, rows[-1].user_id)
+            if len(rows) < self.batch:
+                return count
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync()
+            except Exception:
+                log.exception("Ошибка синхронизации кэша подписок")
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+cache_sync = SubscriptionCacheSync(settings.SUB_CACHE_SYNC_INTERVAL)
+
+# Получатели (user_id, SubInfo) после изменения статуса или дат подписки
+subscription_listeners: list = []
+
+def subscription_changed(user_id: int, info: SubInfo) -> None:
+    invalidate_subscription(user_id)
+    _sub_cache.set(user_id, info)
+    for listener in subscription_listeners:
+        listener(user_id, info)
 
 async def ensure_user(tg_user) -> None:
-    async with Session() as s:
-        obj = await s.get(User, tg_user.id)
-        if obj:
-            if tg_user.username and obj.username != tg_user.username:
-                obj.username = tg_user.username
-                await s.commit()
-        else:
-            s.add(User(id=tg_user.id, username=tg_user.username))
-            s.add(Subscription(user_id=tg_user.id, status="expired"))
-            await s.commit()
+    # Горячий путь: без обращения к БД, запись уйдёт пачкой в фоне
+    registry.touch(tg_user.id, tg_user.username)
+
+async def ensure_user_row(tg_user) -> None:
+    """Гарантирует, что строка пользователя уже записана (нужно перед вставкой связанных строк)."""
+    await registry.ensure(tg_user.id, tg_user.username)
 
 def _tz_aware_utc(dt: Optional[datetime]) -> Optional[datetime]:
     if dt is None:
@@ -35,41 +121,100 @@ def _tz_aware_utc(dt: Optional[datetime]) -> Optional[datetime]:
         return dt.replace(tzinfo=UTC)
     return dt.astimezone(UTC)
 
+def _sub_info(sub: Optional[Subscription]) -> SubInfo:
+    if not sub:
+        return SubInfo(status="expired", paid_until=None)
+    return SubInfo(
+        status=sub.status,
+        paid_until=_tz_aware_utc(sub.paid_until),
+        grace_until=_tz_aware_utc(sub.grace_until),
+    )
+
 async def get_subscription_status(user_id: int) -> SubInfo:
+    info = _sub_cache.get(user_id)
+    if info is not None:
+        return info
+    epoch = _sub_cache_epoch
     async with Session() as s:
-        sub = await s.get(Subscription, user_id)
-        if not sub:
-            sub = Subscription(user_id=user_id, status="expired")
-            s.add(sub)
-            await s.commit()
-        return SubInfo(status=sub.status, paid_until=_tz_aware_utc(sub.paid_until))
+        # Строку подписки создаёт реестр пользователей; пока её нет — доступа нет
+        info = _sub_info(await s.get(Subscription, user_id))
+    if epoch == _sub_cache_epoch:
+        _sub_cache.set(user_id, info)
+    return info
+
+async def get_access(user_id: int) -> tuple[SubInfo, bool]:
+    """Статус подписки и наличие доступа за один поиск (обычно из кэша)."""
+    info = await get_subscription_status(user_id)
+    return info, info.has_access
 
 async def update_subscription(user_id: int, **fields) -> None:
+    if {"status", "paid_until", "grace_until"} & fields.keys():
+        fields.setdefault("updated_at", now())  # по updated_at работает сверка участников канала
     for key in ["paid_until", "grace_until", "updated_at"]:
         if key in fields:
             fields[key] = _tz_aware_utc(fields[key])
     async with Session() as s:
-        await s.execute(update(Subscription).where(Subscription.user_id == user_id).values(**fields))
+        old = None
+        if "status" in fields:
+            res = await s.execute(select(Subscription.status).where(Subscription.user_id == user_id))
+            old = res.scalar()
+        res = await s.execute(update(Subscription).where(Subscription.user_id == user_id).values(**fields))
+        if "status" in fields and res.rowcount:
+            await stats.status_changed(s, fields.get("updated_at") or now(), old, fields["status"])
         await s.commit()
+        if not {"status", "paid_until", "grace_until"} & fields.keys():
+            invalidate_subscription(user_id)
+            return
+        info = _sub_info(await s.get(Subscription, user_id))
+    subscription_changed(user_id, info)
 
 async def has_active_access(user_id: int) -> bool:
-    async with Session() as s:
-        sub = await s.get(Subscription, user_id)
-        if not sub or sub.status not in {"active", "grace"}:
-            return False
-        paid_until = _tz_aware_utc(sub.paid_until)
-        grace_until = _tz_aware_utc(sub.grace_until)
-        if not paid_until:
-            return False
-        return now() <= (grace_until or paid_until)
+    info = await get_subscription_status(user_id)
+    return info.has_access
+
+async def enforce_expirations(bot: Bot) -> ExpiryStats:
+    stats = ExpiryStats()
+    async for user_id, _ in iter_expirations(stats=stats):
+        invalidate_subscription(user_id)
+    log.info(
+        "Expiry run: expired=%d grace=%d batches=%d in %.3fs",
+        stats.expired, stats.graced, stats.batches, stats.duration,
+    )
+    return stats
+
+@dataclass
+class Redemption:
+    status: str  # ok | no_payment | no_token
+    user_id: Optional[int] = None
+    token: Optional[str] = None
 
-async def enforce_expirations(bot: Bot):
-    moment = now()
+async def redeem_payment_token(order_ref: str) -> Redemption:
+    """Находит последний pending-токен пользователя по orderReference и помечает его
+    оплаченным одним UPDATE … RETURNING: два параллельных редиректа не погасят токен дважды."""
+    pay_user = select(Payment.user_id).where(Payment.order_ref == order_ref).scalar_subquery()
+    newest = (
+        select(PaymentToken.id)
+        .where(PaymentToken.user_id == pay_user, PaymentToken.status == "pending")
+        .order_by(PaymentToken.created_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
     async with Session() as s:
-        res = await s.execute(select(Subscription))
-        subs = res.scalars().all()
-        for sub in subs:
-            paid_until = _tz_aware_utc(sub.paid_until)
-            if paid_until and paid_until < moment:
-                sub.status = "expired"
+        res = await s.execute(
+            update(PaymentToken)
+            .where(PaymentToken.id == newest, PaymentToken.status == "pending")
+            .values(status="paid")
+            .returning(PaymentToken.user_id, PaymentToken.token)
+            .execution_options(synchronize_session=False)
+        )
+        row = res.first()
         await s.commit()
+        if row:
+            invalidate_subscription(row.user_id)
+            return Redemption("ok", row.user_id, row.token)
+        # Промах — редкий путь, только здесь выясняем причину
+        res = await s.execute(select(Payment.user_id).where(Payment.order_ref == order_ref))
+        user_id = res.scalar()
+    if user_id is None:
+        return Redemption("no_payment")
+    return Redemption("no_token", user_id)
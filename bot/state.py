@@ -0,0 +1,25 @@
+from __future__ import annotations
+from datetime import datetime, timezone
+from typing import Optional
+from sqlalchemy import select
+from bot.db import Session, AppState, dialect_insert
+
+# Ключи app_state
+BOT_USERNAME = "bot_username"
+WEBHOOK_URL = "webhook_url"
+MEMBERSHIP_CURSOR = "membership_sweep_cursor"  # user_id, на котором остановился полный обход
+
+async def get_state(key: str) -> Optional[str]:
+    async with Session() as s:
+        res = await s.execute(select(AppState.value).where(AppState.key == key))
+        return res.scalar()
+
+async def set_state(key: str, value: Optional[str]) -> None:
+    moment = datetime.now(timezone.utc)
+    stmt = dialect_insert(AppState).values(key=key, value=value, updated_at=moment)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AppState.key], set_={"value": value, "updated_at": moment},
+    )
+    async with Session() as s:
+        await s.execute(stmt)
+        await s.commit()
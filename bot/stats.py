@@ -0,0 +1,151 @@
+from __future__ import annotations
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from bot.db import Session, DailyStats, StatCounter, Payment, PaymentArchive, Subscription, dialect_insert
+
+log = logging.getLogger(__name__)
+UTC = timezone.utc
+
+ACTIVE = "active"  # подписок в статусе active или grace
+ACCESS_STATUSES = ("active", "grace")
+FIELDS = ("payments", "revenue", "new_subs", "renewals", "refunds", "refunded", "declined", "graced", "expired")
+
+def _day(moment: datetime) -> date:
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(UTC)
+    return moment.date()
+
+async def bump(s: AsyncSession, moment: datetime, **deltas: int) -> None:
+    """Прибавляет к агрегатам дня в транзакции вызывающего (один upsert)."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    stmt = dialect_insert(DailyStats).values(day=_day(moment), **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DailyStats.day],
+        set_={k: getattr(DailyStats, k) + stmt.excluded[k] for k in deltas},
+    )
+    await s.execute(stmt)
+
+async def bump_counter(s: AsyncSession, name: str, delta: int) -> None:
+    if not delta:
+        return
+    stmt = dialect_insert(StatCounter).values(name=name, value=delta)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[StatCounter.name], set_={"value": StatCounter.value + stmt.excluded.value},
+    )
+    await s.execute(stmt)
+
+async def status_changed(s: AsyncSession, moment: datetime, old: Optional[str], new: str, count: int = 1) -> None:
+    # old=None — строки подписки не было
+    was = old in ACCESS_STATUSES
+    now = new in ACCESS_STATUSES
+    if was != now:
+        await bump_counter(s, ACTIVE, count if now else -count)
+    if new != old:
+        await bump(s, moment, graced=count if new == "grace" else 0, expired=count if new == "expired" and was else 0)
+
+@dataclass
+class Summary:
+    active: int
+    today: dict
+    week: dict
+    month: dict
+
+    @property
+    def renewal_rate(self) -> Optional[float]:
+        # Доля продлений среди подписок, дошедших до конца срока за 30 дней
+        ended = self.month["renewals"] + self.month["expired"]
+        return self.month["renewals"] / ended if ended else None
+
+async def summary(today: Optional[date] = None) -> Summary:
+    """Не более 30 строк daily_stats по первичному ключу и одна строка счётчика."""
+    today = today or datetime.now(UTC).date()
+    async with Session() as s:
+        active = (await s.execute(select(StatCounter.value).where(StatCounter.name == ACTIVE))).scalar() or 0
+        rows = (await s.execute(select(DailyStats).where(DailyStats.day > today - timedelta(days=30)))).scalars().all()
+
+    def total(days: int) -> dict:
+        since = today - timedelta(days=days)
+        return {f: sum(getattr(r, f) or 0 for r in rows if r.day > since) for f in FIELDS}
+
+    return Summary(active=active, today=total(1), week=total(7), month=total(30))
+
+async def rebuild() -> int:
+    """Пересчёт агрегатов по платежам (включая архив) и текущим подпискам.
+
+    Определения те же, что у billing.apply_payment_status: оплата, выручка и
+    new_subs/renewals — в день paid_at (new_subs — первый оплаченный платёж
+    пользователя), возврат — в день refunded_at, отказ — в день создания счёта.
+    У платежей, оплаченных до появления paid_at/refunded_at, берётся created_at.
+    Истечения восстанавливаются по paid_until/grace_until истёкших подписок.
+    Возвращает число дней с данными.
+    """
+    days: dict[date, dict[str, int]] = {}
+
+    def add(day: date, **deltas: int) -> None:
+        row = days.setdefault(day, dict.fromkeys(FIELDS, 0))
+        for k, v in deltas.items():
+            row[k] += v
+
+    seen_users: set[int] = set()
+    async with Session() as s:
+        def payments(model):
+            return select(
+                model.user_id, model.status, model.amount, model.created_at, model.refunded_at,
+                func.coalesce(model.paid_at, model.created_at).label("settled_at"),
+            ).where(model.status.in_(("paid", "refunded", "declined")))
+
+        query = payments(Payment).union_all(payments(PaymentArchive))
+        stream = await s.stream(query.order_by("settled_at").execution_options(yield_per=1000))
+        async for row in stream:
+            if row.created_at is None:
+                continue
+            amount = row.amount or 0
+            if row.status == "declined":
+                add(_day(row.created_at), declined=1)
+                continue
+            first = row.user_id not in seen_users
+            seen_users.add(row.user_id)
+            add(_day(row.settled_at), payments=1, revenue=amount, new_subs=int(first), renewals=int(not first))
+            if row.status == "refunded":
+                add(_day(row.refunded_at or row.settled_at), refunds=1, refunded=amount)
+
+        subs = await s.stream(
+            select(Subscription.status, Subscription.paid_until, Subscription.grace_until)
+            .where(Subscription.status.in_(("expired", "grace")), Subscription.paid_until.is_not(None))
+            .execution_options(yield_per=1000)
+        )
+        async for row in subs:
+            if row.status == "grace":
+                add(_day(row.paid_until), graced=1)
+            else:
+                add(_day(row.grace_until or row.paid_until), expired=1)
+                if row.grace_until:
+                    add(_day(row.paid_until), graced=1)
+
+        active = (await s.execute(
+            select(func.count()).select_from(Subscription).where(Subscription.status.in_(ACCESS_STATUSES))
+        )).scalar() or 0
+
+        await s.execute(delete(DailyStats))
+        await s.execute(delete(StatCounter).where(StatCounter.name == ACTIVE))
+        if days:
+            await s.execute(dialect_insert(DailyStats), [{"day": d, **v} for d, v in days.items()])
+        s.add(StatCounter(name=ACTIVE, value=active))
+        await s.commit()
+    log.info("Статистика пересчитана: %d дней, активных подписок %d", len(days), active)
+    return len(days)
+
+async def ensure_stats() -> bool:
+    """Первый запуск после появления агрегатов: заполняет их по существующим данным."""
+    async with Session() as s:
+        exists = (await s.execute(select(StatCounter.name).where(StatCounter.name == ACTIVE))).scalar()
+    if exists:
+        return False
+    await rebuild()
+    return True
@@ -0,0 +1,131 @@
+from __future__ import annotations
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Message, CallbackQuery
+from bot.ratelimit import TokenBucket
+from bot.metrics import Counter
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+
+POLICIES = ("drop", "delay", "reply_once")
+NOTICE = "⏳ Слишком часто, попробуйте через несколько секунд."
+EVICT_INTERVAL = 60.0
+
+THROTTLED = Counter("bot_throttled_total", "Updates rejected or delayed by the anti-flood middleware", ["policy"])
+
+def _command_key(event: TelegramObject) -> str:
+    # Кнопки клавиатуры приходят обычным текстом, команды — "/cmd args"
+    if isinstance(event, CallbackQuery):
+        return "cb:" + (event.data or "")[:32]
+    text = getattr(event, "text", None) or ""
+    if text.startswith("/"):
+        return text.split(None, 1)[0].split("@", 1)[0]
+    return text[:32]
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Outer-middleware антифлуда: token bucket на пользователя и на пару (пользователь, команда).
+
+    Отказ решается по словарям в памяти до хендлеров, без обращений к БД и HTTP.
+    Политики: drop — молча отбросить, delay — подождать до max_delay (дольше — отбросить),
+    reply_once — отбросить и один раз за окно ответить пользователю.
+    Бакеты, не использованные idle_ttl секунд, периодически удаляются.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        command_rate: Optional[float] = None,
+        command_burst: Optional[float] = None,
+        policy: Optional[str] = None,
+        max_delay: Optional[float] = None,
+        idle_ttl: Optional[float] = None,
+    ):
+        self.rate = rate or settings.THROTTLE_RATE
+        self.burst = burst or settings.THROTTLE_BURST
+        self.command_rate = command_rate or settings.THROTTLE_COMMAND_RATE
+        self.command_burst = command_burst or settings.THROTTLE_COMMAND_BURST
+        self.policy = policy or settings.THROTTLE_POLICY
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown throttling policy: {self.policy}")
+        self.max_delay = settings.THROTTLE_MAX_DELAY if max_delay is None else max_delay
+        self.idle_ttl = idle_ttl or settings.THROTTLE_IDLE_TTL
+        self._users: dict[int, TokenBucket] = {}
+        self._commands: dict[tuple[int, str], TokenBucket] = {}
+        self._warned: dict[int, float] = {}
+        self._next_evict = time.monotonic() + EVICT_INTERVAL
+
+    def __len__(self) -> int:
+        return len(self._users) + len(self._commands)
+
+    def _buckets(self, user_id: int, key: str) -> tuple[TokenBucket, TokenBucket]:
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = TokenBucket(self.rate, self.burst)
+        command = self._commands.get((user_id, key))
+        if command is None:
+            command = self._commands[(user_id, key)] = TokenBucket(self.command_rate, self.command_burst)
+        return user, command
+
+    def evict(self, moment: Optional[float] = None) -> int:
+        moment = time.monotonic() if moment is None else moment
+        cutoff = moment - self.idle_ttl
+        before = len(self)
+        self._users = {k: b for k, b in self._users.items() if b.updated >= cutoff}
+        self._commands = {k: b for k, b in self._commands.items() if b.updated >= cutoff}
+        self._warned = {k: t for k, t in self._warned.items() if t >= cutoff}
+        return before - len(self)
+
+    def _wait(self, user: TokenBucket, command: TokenBucket) -> float:
+        return max(user.delay(), command.delay())
+
+    async def _notify(self, event: TelegramObject, user_id: int, moment: float) -> None:
+        warned = self._warned.get(user_id)
+        if warned is not None and moment - warned < self.idle_ttl:
+            return
+        self._warned[user_id] = moment
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(NOTICE)
+            elif isinstance(event, Message):
+                await event.answer(NOTICE)
+        except Exception:
+            log.debug("Не удалось отправить предупреждение о флуде %s", user_id)
+
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user_obj = data.get("event_from_user")
+        if user_obj is None or user_obj.id in settings.ADMIN_IDS:
+            return await handler(event, data)
+        moment = time.monotonic()
+        if moment >= self._next_evict:
+            self._next_evict = moment + EVICT_INTERVAL
+            self.evict(moment)
+
+        user_id = user_obj.id
+        user, command = self._buckets(user_id, _command_key(event))
+        wait = self._wait(user, command)
+        if wait > 0 and self.policy == "delay" and wait <= self.max_delay:
+            THROTTLED.inc("delay")
+            deadline = moment + self.max_delay
+            while wait > 0 and time.monotonic() + wait <= deadline:
+                await asyncio.sleep(wait)
+                wait = self._wait(user, command)
+        if wait > 0:
+            THROTTLED.inc("drop" if self.policy == "delay" else self.policy)
+            if self.policy == "reply_once":
+                await self._notify(event, user_id, moment)
+            return None
+        user.try_acquire()
+        command.try_acquire()
+        self._warned.pop(user_id, None)
+        return await handler(event, data)
+
+def setup_dispatcher(dp) -> ThrottlingMiddleware:
+    middleware = ThrottlingMiddleware()
+    dp.message.outer_middleware(middleware)
+    dp.callback_query.outer_middleware(middleware)
+    return middleware
@@ -0,0 +1,143 @@
+from __future__ import annotations
+import asyncio
+import logging
+from contextlib import suppress
+from datetime import datetime
+from typing import Optional
+from sqlalchemy.exc import IntegrityError
+from bot.db import Session, User, Subscription, dialect_insert
+from bot.cache import TTLCache
+from bot.config import settings
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+class UserRegistry:
+    """Реестр известных пользователей с отложенной пакетной записью в БД.
+
+    Известные id и username живут в памяти; новые пользователи и смена username
+    копятся в очереди и сбрасываются одним многострочным upsert раз в
+    USER_FLUSH_INTERVAL секунд.
+    """
+
+    def __init__(self, interval: float, batch_size: int, maxsize: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._known: TTLCache[int, Optional[str]] = TTLCache(maxsize=maxsize, ttl=24 * 3600)
+        self._pending: dict[int, Optional[str]] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _is_current(self, user_id: int, username: Optional[str]) -> bool:
+        known = self._known.get(user_id, _MISSING)
+        if known is _MISSING:
+            return False
+        # Пустой username никогда не затирает сохранённый
+        return not username or known == username
+
+    def touch(self, user_id: int, username: Optional[str]) -> None:
+        if self._is_current(user_id, username):
+            return
+        if user_id in self._pending and not username:
+            return
+        self._pending[user_id] = username
+
+    async def ensure(self, user_id: int, username: Optional[str]) -> None:
+        """Синхронный вариант: по возвращении строка пользователя точно есть в БД."""
+        if self._is_current(user_id, username):
+            return
+        queued = self._pending.pop(user_id, None)
+        try:
+            await self._write({user_id: username or queued})
+        except BaseException:
+            self._requeue({user_id: username or queued})
+            raise
+
+    def forget(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._known.pop(user_id)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def flush(self) -> int:
+        written = 0
+        while self._pending:
+            batch = {}
+            for user_id in list(self._pending)[: self.batch_size]:
+                batch[user_id] = self._pending.pop(user_id)
+            try:
+                await self._write(batch)
+            except BaseException:
+                self._requeue(batch)
+                raise
+            written += len(batch)
+        return written
+
+    def _requeue(self, batch: dict[int, Optional[str]]) -> None:
+        # Пачка не записана (ошибка БД или отмена) — возвращаем в очередь до следующего сброса.
+        # Username, пришедший за время записи, новее — его не затираем.
+        for user_id, username in batch.items():
+            self._pending[user_id] = self._pending.get(user_id) or username
+
+    async def _write(self, batch: dict[int, Optional[str]]) -> None:
+        async with self._lock:
+            try:
+                await _upsert_users(batch)
+            except IntegrityError:
+                # Чаще всего конфликт уникального username — пишем по одному,
+                # чтобы одна строка не блокировала всю пачку.
+                for user_id, username in batch.items():
+                    try:
+                        await _upsert_users({user_id: username})
+                    except IntegrityError:
+                        log.warning("Не удалось сохранить пользователя %s (@%s)", user_id, username)
+                        await _upsert_users({user_id: None})
+            for user_id, username in batch.items():
+                self._known.set(user_id, username)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Ошибка записи пользователей")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            # Дожидаемся отмены: прерванный сброс успевает вернуть пачку в очередь
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+async def _upsert_users(batch: dict[int, Optional[str]]) -> None:
+    users = [{"id": user_id, "username": username} for user_id, username in batch.items()]
+    moment = datetime.utcnow()
+    subs = [{"user_id": user_id, "status": "expired", "updated_at": moment} for user_id in batch]
+    async with Session() as s:
+        stmt = dialect_insert(User).values(users)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.id],
+            set_={"username": stmt.excluded.username},
+            where=stmt.excluded.username.is_not(None),
+        )
+        await s.execute(stmt)
+        await s.execute(
+            dialect_insert(Subscription).values(subs).on_conflict_do_nothing(index_elements=[Subscription.user_id])
+        )
+        await s.commit()
+
+registry = UserRegistry(
+    interval=settings.USER_FLUSH_INTERVAL,
+    batch_size=settings.USER_FLUSH_BATCH,
+    maxsize=settings.USER_REGISTRY_SIZE,
+)
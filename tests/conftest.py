@@ -0,0 +1,50 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix="bot-tests-")
+
+# bot.config читает настройки при импорте
+os.environ.update({
+    "BOT_TOKEN": "42:TEST",
+    "CHANNEL_ID": "-1001",
+    "BASE_URL": "https://bot.test",
+    "WFP_MERCHANT": "test_merchant",
+    "WFP_SECRET": "test-secret",
+    "WFP_DOMAIN": "bot.test",
+    "TG_JOIN_REQUEST_URL": "https://t.me/+test",
+    "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(_tmp, 'test.sqlite3')}",
+    "METRICS_ENABLED": "false",
+})
+
+
+def _run(coro):
+    # Соединения aiosqlite привязаны к циклу: закрываем пул в том же asyncio.run
+    from bot.db import engine
+
+    async def main():
+        try:
+            return await coro
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def run():
+    """Чистая схема в temp SQLite и функция, выполняющая корутину в новом цикле."""
+    from bot.db import Base, engine, init_db
+    from bot import billing, invoices, membership, services
+
+    async def reset():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await init_db()
+
+    _run(reset())
+    for cache in (services._sub_cache, billing._seen, invoices._cache, membership._cache):
+        cache.clear()
+    return _run
@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, func
+
+from bot import billing
+from bot.billing import apply_payment_status, process_callback
+from bot.config import settings
+from bot.db import Session, User, Payment, PaymentArchive, Subscription
+from bot.retention import compact
+
+UTC = timezone.utc
+
+
+async def _seed(*payments):
+    async with Session() as s:
+        s.add(User(id=1))
+        await s.flush()
+        s.add_all(Payment(user_id=1, amount=100, status="pending", **p) for p in payments)
+        await s.commit()
+
+
+async def _payment(order_ref):
+    async with Session() as s:
+        return (await s.execute(select(Payment).where(Payment.order_ref == order_ref))).scalar()
+
+
+async def _subscription():
+    async with Session() as s:
+        return (await s.execute(select(Subscription).where(Subscription.user_id == 1))).scalar()
+
+
+def _aware(dt):
+    return dt.replace(tzinfo=UTC) if dt.tzinfo is None else dt
+
+
+def test_process_callback_applies_each_status_once(run, monkeypatch):
+    calls = []
+    apply = billing.apply_payment_status
+
+    async def counting(s, order_ref, wfp_status, moment=None):
+        calls.append((order_ref, wfp_status))
+        return await apply(s, order_ref, wfp_status, moment)
+
+    monkeypatch.setattr(billing, "apply_payment_status", counting)
+
+    async def go():
+        await _seed({"order_ref": "o-1"})
+        first = await process_callback("o-1", "Approved")
+        repeat = await process_callback("o-1", "Approved")
+        return first, repeat, await _payment("o-1")
+
+    first, repeat, payment = run(go())
+    assert first.old == "pending" and first.new == "paid"
+    assert repeat is None
+    assert calls == [("o-1", "Approved")]  # повтор отсечён кэшем, БД не трогали
+    assert payment.status == "paid" and payment.paid_at is not None
+
+
+def test_repeated_status_is_not_applied_twice_without_cache(run):
+    async def go():
+        await _seed({"order_ref": "o-1"})
+        results = []
+        for _ in range(2):
+            async with Session() as s:
+                results.append(await apply_payment_status(s, "o-1", "Approved"))
+                await s.commit()
+        return results, await _subscription()
+
+    (first, second), sub = run(go())
+    assert first is not None and second is None
+    assert _aware(sub.paid_until) == first.paid_until
+
+
+def test_payment_extends_from_current_paid_until(run):
+    now = datetime.now(UTC)
+    days = timedelta(days=settings.SUBSCRIPTION_DAYS)
+
+    async def go():
+        await _seed({"order_ref": "o-1"}, {"order_ref": "o-2"})
+        async with Session() as s:
+            first = await apply_payment_status(s, "o-1", "Approved", now)
+            await s.commit()
+        # Продление до окончания срока прибавляется к paid_until, а не к моменту оплаты
+        async with Session() as s:
+            second = await apply_payment_status(s, "o-2", "Approved", now + timedelta(days=5))
+            await s.commit()
+        return first, second, await _subscription()
+
+    first, second, sub = run(go())
+    assert first.paid_until == now + days
+    assert second.paid_until == now + 2 * days
+    assert sub.status == "active" and _aware(sub.paid_until) == second.paid_until
+
+
+def test_payment_after_expiry_starts_from_payment_moment(run):
+    now = datetime.now(UTC)
+
+    async def go():
+        await _seed({"order_ref": "o-1"}, {"order_ref": "o-2"})
+        async with Session() as s:
+            await apply_payment_status(s, "o-1", "Approved", now - timedelta(days=100))
+            second = await apply_payment_status(s, "o-2", "Approved", now)
+            await s.commit()
+        return second
+
+    assert run(go()).paid_until == now + timedelta(days=settings.SUBSCRIPTION_DAYS)
+
+
+def test_refund_only_from_paid(run):
+    async def go():
+        await _seed({"order_ref": "o-1"}, {"order_ref": "o-2"})
+        async with Session() as s:
+            early = await apply_payment_status(s, "o-2", "Refunded")
+            await apply_payment_status(s, "o-1", "Approved")
+            refund = await apply_payment_status(s, "o-1", "Voided")
+            again = await apply_payment_status(s, "o-1", "Approved")
+            await s.commit()
+        return early, refund, again, await _payment("o-1"), await _payment("o-2")
+
+    early, refund, again, paid, pending = run(go())
+    assert early is None and pending.status == "pending"
+    assert refund.old == "paid" and refund.new == "refunded" and refund.amount == 100
+    assert again is None  # возвращённый платёж повторно не оплачивается
+    assert paid.status == "refunded" and paid.refunded_at is not None
+
+
+def test_late_callback_restores_archived_payment(run):
+    now = datetime.now(UTC)
+    old = now - timedelta(days=settings.PAYMENT_RETENTION_DAYS + 1)
+
+    async def go():
+        await _seed({"order_ref": "o-1", "created_at": old})
+        async with Session() as s:
+            await apply_payment_status(s, "o-1", "Declined", old)
+            await s.commit()
+        moved = (await compact(now)).payments
+        hot = await _payment("o-1")
+        transition = await process_callback("o-1", "Approved")
+        async with Session() as s:
+            archived = (await s.execute(select(func.count()).select_from(PaymentArchive))).scalar()
+        return moved, hot, transition, await _payment("o-1"), archived
+
+    moved, hot, transition, payment, archived = run(go())
+    assert moved == 1 and hot is None
+    assert transition.old == "declined" and transition.new == "paid"
+    assert payment.status == "paid" and _aware(payment.created_at) == old
+    assert archived == 0
+
+
+def test_unknown_order_is_ignored(run):
+    async def go():
+        await _seed({"order_ref": "o-1"})
+        return await process_callback("missing", "Approved"), await _subscription()
+
+    transition, sub = run(go())
+    assert transition is None and sub is None
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from bot.db import Session, User, Subscription
+from bot.membership import MembershipReconciler
+from bot.state import get_state, MEMBERSHIP_CURSOR
+
+
+class FakeBot:
+    """Все пользователи числятся участниками канала; бан/разбан записываются."""
+
+    def __init__(self):
+        self.banned = []
+
+    async def get_chat_member(self, chat_id, user_id):
+        return SimpleNamespace(status="member")
+
+    async def ban_chat_member(self, chat_id, user_id):
+        self.banned.append(user_id)
+
+    async def unban_chat_member(self, chat_id, user_id, only_if_banned=False):
+        pass
+
+
+def test_sweep_removes_old_expired_members_across_runs(run):
+    old = datetime.utcnow() - timedelta(days=90)
+
+    async def go():
+        async with Session() as s:
+            s.add_all(User(id=uid) for uid in range(1, 8))
+            await s.flush()
+            # Истекли давно: updated_at за пределами lookback, инкрементальный проход их не видит
+            s.add_all(Subscription(user_id=uid, status="expired", paid_until=old, updated_at=old) for uid in range(1, 6))
+            s.add_all(
+                Subscription(user_id=uid, status="active", paid_until=datetime.utcnow() + timedelta(days=10), updated_at=old)
+                for uid in (6, 7)
+            )
+            await s.commit()
+        bot = FakeBot()
+        reconciler = MembershipReconciler(bot, rate=1000, batch=2, sweep_limit=4)
+        first = await reconciler.run()
+        cursor = await get_state(MEMBERSHIP_CURSOR)
+        second = await reconciler.run()
+        return bot.banned, first, cursor, second, await get_state(MEMBERSHIP_CURSOR)
+
+    banned, first, cursor, second, final_cursor = run(go())
+    assert (first.checked, first.swept, first.removed) == (0, 4, 4)
+    assert cursor == "4"
+    assert (second.swept, second.removed) == (3, 1)
+    assert sorted(banned) == [1, 2, 3, 4, 5]
+    assert final_cursor == "0"
@@ -0,0 +1,23 @@
+from bot import metrics
+from bot.db import QueryStats
+
+
+def test_statement_histogram_renders_query_stats():
+    stats = QueryStats(max_statements=2)
+    stats.record("SELECT 1", 0.0005)
+    stats.record("SELECT 1", 0.02)
+    stats.record("SELECT\n    2", 0.2)
+    stats.record("SELECT 3", 7.0)  # сверх max_statements — в <other>
+    metric = metrics.StatementHistogram("db_statement_seconds", "test", source=stats.snapshot)
+    try:
+        lines = metric.render()
+    finally:
+        metrics.REGISTRY.remove(metric)
+
+    assert 'db_statement_seconds_bucket{statement="SELECT 1",le="0.001"} 1' in lines
+    assert 'db_statement_seconds_bucket{statement="SELECT 1",le="0.025"} 2' in lines
+    assert 'db_statement_seconds_count{statement="SELECT 1"} 2' in lines
+    assert 'db_statement_seconds_count{statement="SELECT 2"} 1' in lines
+    assert 'db_statement_seconds_bucket{statement="<other>",le="5.0"} 0' in lines
+    assert 'db_statement_seconds_bucket{statement="<other>",le="+Inf"} 1' in lines
+    assert 'db_statement_seconds_sum{statement="<other>"} 7.0' in lines
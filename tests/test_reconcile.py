@@ -0,0 +1,51 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from sqlalchemy import select
+
+from bot.db import Session, User, Subscription, Payment
+from bot.reconcile import reconcile_payments
+from bot.payments.wayforpay import CircuitBreaker, WayForPayClient
+from tests.test_wayforpay import signed_status
+
+UTC = timezone.utc
+
+
+def test_reconcile_applies_only_verified_statuses(run):
+    moment = datetime.now(UTC)
+    bodies = {
+        "paid-1": signed_status("paid-1"),
+        "declined-1": signed_status("declined-1", status="Declined"),
+        "unsigned-1": httpx.Response(200, json={"orderReference": "unsigned-1", "transactionStatus": "Approved"}).content,
+        "forged-1": signed_status("forged-1", secret="other-secret"),
+    }
+
+    async def handler(request):
+        return httpx.Response(200, content=bodies[json.loads(request.content)["orderReference"]])
+
+    async def go():
+        async with Session() as s:
+            s.add_all(User(id=uid) for uid in range(1, 5))
+            for uid, ref in enumerate(bodies, start=1):
+                s.add(Payment(
+                    user_id=uid, order_ref=ref, amount=100, currency="UAH", status="pending",
+                    created_at=moment - timedelta(hours=1),
+                ))
+            await s.commit()
+        client = WayForPayClient(
+            "https://wfp.test/api", retries=0, breaker=CircuitBreaker(100, 30),
+            transport=httpx.MockTransport(handler),
+        )
+        async with client:
+            stats = await reconcile_payments(client=client, moment=moment, batch_size=10)
+        async with Session() as s:
+            statuses = dict((await s.execute(select(Payment.order_ref, Payment.status))).all())
+            sub = await s.get(Subscription, 1)
+        return stats, statuses, sub
+
+    stats, statuses, sub = run(go())
+    assert (stats.checked, stats.changed, stats.paid, stats.errors, stats.batches) == (4, 2, 1, 2, 1)
+    assert statuses == {"paid-1": "paid", "declined-1": "declined", "unsigned-1": "pending", "forged-1": "pending"}
+    assert sub is not None and sub.status == "active"
+    assert sub.paid_until > moment.replace(tzinfo=None) + timedelta(days=25)
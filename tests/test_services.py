@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+from bot.db import Session, User, Subscription, Payment, PaymentToken
+from bot.services import SubscriptionCacheSync, get_subscription_status, redeem_payment_token
+
+UTC = timezone.utc
+
+
+def test_cache_sync_drops_entries_changed_by_another_worker(run):
+    async def go():
+        async with Session() as s:
+            s.add(User(id=1))
+            await s.flush()
+            s.add(Subscription(user_id=1, status="expired", updated_at=datetime.utcnow() - timedelta(days=1)))
+            await s.commit()
+        sync = SubscriptionCacheSync(interval=0)
+        await sync.sync()
+        before = await get_subscription_status(1)
+        # Оплату принял другой воркер: строка изменена мимо кэша этого процесса
+        async with Session() as s:
+            await s.execute(
+                update(Subscription).where(Subscription.user_id == 1)
+                .values(status="active", paid_until=datetime.now(UTC) + timedelta(days=30), updated_at=datetime.now(UTC))
+            )
+            await s.commit()
+        stale = await get_subscription_status(1)
+        changed = await sync.sync()
+        fresh = await get_subscription_status(1)
+        return before, stale, changed, fresh
+
+    before, stale, changed, fresh = run(go())
+    assert before.status == stale.status == "expired"
+    assert changed == 1
+    assert fresh.status == "active" and fresh.has_access
+
+
+def test_concurrent_redirects_redeem_token_once(run):
+    async def go():
+        async with Session() as s:
+            s.add(User(id=1))
+            await s.flush()
+            s.add_all([
+                Payment(user_id=1, order_ref="o-1", amount=100, status="paid"),
+                PaymentToken(user_id=1, token="old", status="pending", created_at=datetime.utcnow() - timedelta(hours=1)),
+                PaymentToken(user_id=1, token="new", status="pending"),
+            ])
+            await s.commit()
+        results = await asyncio.gather(*(redeem_payment_token("o-1") for _ in range(5)))
+        async with Session() as s:
+            tokens = dict((await s.execute(select(PaymentToken.token, PaymentToken.status))).all())
+        return results, tokens, await redeem_payment_token("missing")
+
+    results, tokens, missing = run(go())
+    # Два pending-токена — ровно два погашения, каждый токен один раз
+    assert sorted(r.token for r in results if r.status == "ok") == ["new", "old"]
+    assert [r.status for r in results].count("no_token") == 3
+    assert all(r.user_id == 1 for r in results)
+    assert tokens == {"old": "paid", "new": "paid"}
+    assert missing.status == "no_payment"
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+
+from bot import stats
+from bot.billing import apply_payment_status
+from bot.db import Session, User, Payment, DailyStats
+
+UTC = timezone.utc
+
+
+async def _daily():
+    async with Session() as s:
+        rows = (await s.execute(select(DailyStats))).scalars().all()
+    return {r.day: {f: getattr(r, f) or 0 for f in stats.FIELDS} for r in rows if any(getattr(r, f) for f in stats.FIELDS)}
+
+
+def test_rebuild_matches_incremental_aggregates(run):
+    now = datetime.now(UTC)
+    ago = lambda days: now - timedelta(days=days)
+
+    async def go():
+        async with Session() as s:
+            s.add_all([User(id=1), User(id=2)])
+            await s.flush()
+            s.add_all([
+                Payment(user_id=1, order_ref="old", amount=100, status="pending", created_at=ago(200)),
+                Payment(user_id=1, order_ref="retry", amount=100, status="pending", created_at=ago(10)),
+                Payment(user_id=2, order_ref="late", amount=300, status="pending", created_at=ago(5)),
+            ])
+            await s.commit()
+        # Счёт оплачен в день создания, возврат — через 200 дней
+        for order_ref, status, moment in (
+            ("old", "Approved", ago(200)),
+            ("retry", "Declined", ago(10)),
+            ("retry", "Approved", ago(9)),
+            ("late", "Approved", ago(3)),
+            ("old", "Refunded", now),
+        ):
+            async with Session() as s:
+                assert await apply_payment_status(s, order_ref, status, moment) is not None
+                await s.commit()
+        incremental = await _daily()
+        await stats.rebuild()
+        return incremental, await _daily()
+
+    incremental, rebuilt = run(go())
+    assert incremental == rebuilt
+    day = lambda days: ago(days).date()
+    assert rebuilt[day(200)]["new_subs"] == 1 and rebuilt[day(200)]["revenue"] == 100
+    assert rebuilt[now.date()]["refunds"] == 1 and rebuilt[now.date()]["refunded"] == 100
+    assert rebuilt[day(9)]["renewals"] == 1
+    assert rebuilt[day(3)]["new_subs"] == 1
+    assert day(10) not in rebuilt  # отказ снят оплатой того же счёта
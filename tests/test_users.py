@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from bot import users
+from bot.db import Session, User
+from bot.users import UserRegistry
+
+
+async def _usernames():
+    async with Session() as s:
+        return dict((await s.execute(select(User.id, User.username))).all())
+
+
+def test_failed_flush_keeps_users_queued(run, monkeypatch):
+    upsert = users._upsert_users
+    failures = [OperationalError("INSERT", {}, Exception("database is locked"))]
+
+    async def flaky(batch):
+        if failures:
+            raise failures.pop()
+        await upsert(batch)
+
+    monkeypatch.setattr(users, "_upsert_users", flaky)
+    registry = UserRegistry(interval=3600, batch_size=2, maxsize=100)
+
+    async def go():
+        for user_id in (1, 2, 3):
+            registry.touch(user_id, None)
+        with pytest.raises(OperationalError):
+            await registry.flush()
+        queued = registry.pending
+        registry.touch(1, "alice")  # пришёл во время сбоя — не затирается старым значением
+        written = await registry.flush()
+        return queued, written, await _usernames()
+
+    queued, written, stored = run(go())
+    assert queued == 3
+    assert written == 3
+    assert stored == {1: "alice", 2: None, 3: None}
+
+
+def test_stop_waits_for_cancelled_flush_and_writes_batch(run, monkeypatch):
+    upsert = users._upsert_users
+    started = asyncio.Event()
+
+    async def slow(batch):
+        started.set()
+        await asyncio.sleep(3600)
+
+    registry = UserRegistry(interval=0, batch_size=10, maxsize=100)
+
+    async def go():
+        monkeypatch.setattr(users, "_upsert_users", slow)
+        registry.touch(1, "alice")
+        registry.start()
+        await started.wait()
+        # Фоновый сброс завис на записи; останов отменяет его и пишет пачку сам
+        monkeypatch.setattr(users, "_upsert_users", upsert)
+        await registry.stop()
+        return registry.pending, await _usernames()
+
+    pending, stored = run(go())
+    assert pending == 0
+    assert stored == {1: "alice"}
@@ -0,0 +1,334 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import quote_plus
+
+import httpx
+import pytest
+
+from bot.payments.wayforpay import (
+    CALLBACK_SIGNATURE_FIELDS, CircuitBreaker, CircuitOpenError, WayForPayClient, WayForPayError,
+    parse_callback, verify_callback_signature,
+)
+
+PAYLOAD = {"transactionType": "CHECK_STATUS", "orderReference": "order-1"}
+
+
+def make_client(handler, *, retries=2, threshold=3, reset_after=30.0):
+    return WayForPayClient(
+        "https://wfp.test/api",
+        retries=retries,
+        backoff=0,
+        breaker=CircuitBreaker(threshold, reset_after),
+        transport=httpx.MockTransport(handler),
+    )
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class Responses:
+    """Отдаёт заготовленные ответы по очереди и считает вызовы."""
+
+    def __init__(self, *items):
+        self.items = list(items)
+        self.calls = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        item = self.items.pop(0) if len(self.items) > 1 else self.items[0]
+        if isinstance(item, BaseException):
+            raise item
+        if callable(item):
+            return await item(request)
+        return item
+
+
+def ok(data=None):
+    return httpx.Response(200, json=data or {"transactionStatus": "Approved"})
+
+
+def test_retries_retryable_status_then_succeeds():
+    handler = Responses(httpx.Response(503), httpx.Response(429), ok())
+
+    async def go():
+        async with make_client(handler) as client:
+            return await client.request(PAYLOAD)
+
+    assert run(go()) == {"transactionStatus": "Approved"}
+    assert handler.calls == 3
+
+
+def test_gives_up_after_retries():
+    handler = Responses(httpx.Response(502))
+
+    async def go():
+        async with make_client(handler, retries=2) as client:
+            await client.request(PAYLOAD)
+
+    with pytest.raises(WayForPayError):
+        run(go())
+    assert handler.calls == 3
+
+
+def test_read_timeout_retried_only_when_idempotent():
+    async def go(idempotent):
+        handler = Responses(httpx.ReadTimeout("slow"), ok())
+        async with make_client(handler) as client:
+            try:
+                await client.request(PAYLOAD, idempotent=idempotent)
+            except WayForPayError:
+                pass
+        return handler.calls
+
+    assert run(go(True)) == 2
+    assert run(go(False)) == 1
+
+
+def test_connect_error_always_retried():
+    handler = Responses(httpx.ConnectError("refused"), ok())
+
+    async def go():
+        async with make_client(handler) as client:
+            return await client.request(PAYLOAD)
+
+    run(go())
+    assert handler.calls == 2
+
+
+def test_client_error_not_retried():
+    handler = Responses(httpx.Response(400))
+
+    async def go():
+        async with make_client(handler) as client:
+            await client.request(PAYLOAD)
+
+    with pytest.raises(WayForPayError):
+        run(go())
+    assert handler.calls == 1
+
+
+@pytest.mark.parametrize("status", [400, 401, 404])
+def test_client_errors_do_not_open_breaker(status):
+    handler = Responses(httpx.Response(status))
+
+    async def go():
+        async with make_client(handler, retries=0, threshold=2) as client:
+            for _ in range(5):
+                with pytest.raises(WayForPayError):
+                    await client.request(PAYLOAD)
+            return client.breaker.state, client.breaker.failures
+
+    assert run(go()) == ("closed", 0)
+    assert handler.calls == 5
+
+
+@pytest.mark.parametrize("status", [429, 501])
+def test_429_and_any_5xx_open_breaker(status):
+    handler = Responses(httpx.Response(status))
+
+    async def go():
+        async with make_client(handler, retries=0, threshold=2) as client:
+            for _ in range(2):
+                with pytest.raises(WayForPayError):
+                    await client.request(PAYLOAD)
+            return client.breaker.state
+
+    assert run(go()) == "open"
+
+
+def test_breaker_opens_after_threshold_and_rejects_without_network():
+    handler = Responses(httpx.Response(500))
+
+    async def go():
+        async with make_client(handler, retries=0, threshold=3) as client:
+            for _ in range(3):
+                with pytest.raises(WayForPayError):
+                    await client.request(PAYLOAD)
+            with pytest.raises(CircuitOpenError):
+                await client.request(PAYLOAD)
+            return client.breaker.state
+
+    assert run(go()) == "open"
+    assert handler.calls == 3
+
+
+def test_half_open_allows_single_probe_and_closes_on_success():
+    gate = asyncio.Event()
+
+    async def slow_ok(request):
+        await gate.wait()
+        return ok()
+
+    handler = Responses(httpx.Response(500), slow_ok)
+
+    async def go():
+        async with make_client(handler, retries=0, threshold=1, reset_after=0.01) as client:
+            with pytest.raises(WayForPayError):
+                await client.request(PAYLOAD)
+            await asyncio.sleep(0.02)
+            assert client.breaker.state == "half-open"
+            probe = asyncio.create_task(client.request(PAYLOAD))
+            await asyncio.sleep(0)
+            with pytest.raises(CircuitOpenError):
+                await client.request(PAYLOAD)
+            gate.set()
+            await probe
+            return client.breaker.state
+
+    assert run(go()) == "closed"
+    assert handler.calls == 2
+
+
+def test_failed_probe_reopens_breaker():
+    handler = Responses(httpx.Response(500))
+
+    async def go():
+        async with make_client(handler, retries=0, threshold=1, reset_after=0.01) as client:
+            with pytest.raises(WayForPayError):
+                await client.request(PAYLOAD)
+            await asyncio.sleep(0.02)
+            with pytest.raises(WayForPayError):
+                await client.request(PAYLOAD)
+            return client.breaker.state
+
+    assert run(go()) == "open"
+
+
+def test_cancelled_probe_releases_half_open_slot():
+    hang = asyncio.Event()
+
+    async def never(request):
+        await hang.wait()
+        return ok()
+
+    handler = Responses(httpx.Response(500), never, ok())
+
+    async def go():
+        async with make_client(handler, retries=0, threshold=1, reset_after=0.01) as client:
+            with pytest.raises(WayForPayError):
+                await client.request(PAYLOAD)
+            await asyncio.sleep(0.02)
+            probe = asyncio.create_task(client.request(PAYLOAD))
+            await asyncio.sleep(0)
+            probe.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+            # Бэкенд снова здоров: следующий запрос становится пробой и замыкает цепь
+            data = await client.request(PAYLOAD)
+            return data, client.breaker.state
+
+    data, state = run(go())
+    assert data == {"transactionStatus": "Approved"}
+    assert state == "closed"
+
+
+def test_unexpected_httpx_error_in_probe_releases_slot():
+    handler = Responses(httpx.Response(500), httpx.TooManyRedirects("loop"), ok())
+
+    async def go():
+        async with make_client(handler, retries=0, threshold=1, reset_after=0.01) as client:
+            with pytest.raises(WayForPayError):
+                await client.request(PAYLOAD)
+            await asyncio.sleep(0.02)
+            with pytest.raises(httpx.TooManyRedirects):
+                await client.request(PAYLOAD)
+            return await client.request(PAYLOAD)
+
+    assert run(go()) == {"transactionStatus": "Approved"}
+
+
+def test_breaker_state_transitions():
+    breaker = CircuitBreaker(threshold=2, reset_after=0.01)
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    time.sleep(0.02)
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+
+
+def signed_status(order_ref, status="Approved", amount="100.10", secret="test-secret", **overrides):
+    """Тело ответа CHECK_STATUS с подписью по исходному тексту суммы."""
+    data = {
+        "merchantAccount": "test_merchant", "orderReference": order_ref, "amount": amount,
+        "currency": "UAH", "authCode": "", "cardPan": "", "transactionStatus": status, "reasonCode": 1100,
+    }
+    data.update(overrides)
+    base = ";".join(str(data[k]) for k in CALLBACK_SIGNATURE_FIELDS)
+    data["merchantSignature"] = hmac.new(secret.encode(), base.encode(), hashlib.md5).hexdigest()
+    # Сумма уходит числом 100.10, как у WayForPay; float превратил бы её в "100.1"
+    return json.dumps(data).replace(f'"amount": "{amount}"', f'"amount": {amount}').encode()
+
+
+def status_client(body: bytes):
+    async def handler(request):
+        return httpx.Response(200, content=body, headers={"content-type": "application/json"})
+    return make_client(handler)
+
+
+def check_status(body: bytes, order_ref="order-1"):
+    async def go():
+        async with status_client(body) as client:
+            return await client.check_status(order_ref)
+    return run(go())
+
+
+def test_check_status_accepts_signed_response_with_decimal_amount():
+    data = check_status(signed_status("order-1"))
+    assert data["transactionStatus"] == "Approved"
+    assert data["amount"] == "100.10"
+
+
+def test_check_status_rejects_unsigned_response():
+    body = json.dumps({"orderReference": "order-1", "transactionStatus": "Approved", "reasonCode": 1100}).encode()
+    with pytest.raises(WayForPayError, match="signature"):
+        check_status(body)
+
+
+def test_check_status_rejects_wrong_signature():
+    with pytest.raises(WayForPayError, match="signature"):
+        check_status(signed_status("order-1", secret="other-secret"))
+
+
+def test_check_status_rejects_response_for_another_order():
+    with pytest.raises(WayForPayError, match="order-2"):
+        check_status(signed_status("order-2"), order_ref="order-1")
+
+
+def test_parse_callback_keeps_json_amount_as_text():
+    data = parse_callback(signed_status("order-1"))
+    assert data["amount"] == "100.10"
+    assert verify_callback_signature(data)
+
+
+def test_parse_callback_accepts_form_encoded_json_key():
+    # Форма вида <json>= — весь JSON в имени единственного поля
+    body = (quote_plus(signed_status("order-1").decode()) + "=").encode()
+    data = parse_callback(body)
+    assert data["orderReference"] == "order-1" and data["amount"] == "100.10"
+    assert verify_callback_signature(data)
+
+
+@pytest.mark.parametrize("body", [b"", b"not json", b"a=1&b=2", b"[1, 2]", b"%7Bbroken="])
+def test_parse_callback_returns_empty_dict_for_garbage(body):
+    assert parse_callback(body) == {}
+
+
+def test_verify_callback_signature_rejects_tampering():
+    data = parse_callback(signed_status("order-1"))
+    assert verify_callback_signature(data)
+    assert not verify_callback_signature({**data, "amount": "1.00"})
+    assert not verify_callback_signature({**data, "transactionStatus": "Refunded"})
+    assert not verify_callback_signature({k: v for k, v in data.items() if k != "merchantSignature"})
+    assert not verify_callback_signature(parse_callback(signed_status("order-1", secret="other-secret")))